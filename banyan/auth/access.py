@@ -16,13 +16,15 @@ import os
 import sys
 sys.path.insert(1, os.path.join(sys.path[0], '../..'))
 
-from banyan.common import make_token, authorization_key
+from banyan.common import make_token, authorization_key, invalidate_credentials
 
 def parse_args():
 	ap = ArgumentParser(description="Manages access privileges for users and workers.")
 	ap.add_argument('--action', type=str, choices=['add', 'remove', 'list'], required=True)
 	ap.add_argument('--name',   type=str)
 	ap.add_argument('--role',   type=str, choices=['provider', 'worker'])
+	ap.add_argument('--share',  type=float, default=1, help="Relative share of the workers "
+		"that a provider is entitled to under fair-share scheduling.")
 
 	args = ap.parse_args()
 	add_or_remove = args.action in ['add', 'remove']
@@ -31,20 +33,23 @@ def parse_args():
 		raise ValueError("Argument '--name' is required for '--add' or '--remove'.")
 	if args.action == 'add' and not args.role:
 		raise ValueError("Argument '--role' is required for '--add'.")
+	if args.share <= 0:
+		raise ValueError("Argument '--share' must be positive.")
 	return args
 
 def ensure_indices(db):
 	db.users.create_index('name', unique=True)
-	db.users.create_index('token')
+	db.users.create_index('request_token')
 
-def add_provider(name, request_token, db):
+def add_provider(name, request_token, db, share=1):
 	if db.users.find_one({'name': name}):
 		raise RuntimeError("User with name '{}' already exists.".format(name))
 
 	return db.users.insert({
 		'name': name,
 		'request_token': request_token,
-		'role': 'provider'
+		'role': 'provider',
+		'share': share
 	})
 
 def add_worker(name, request_token, response_token, db):
@@ -73,6 +78,7 @@ def remove_user(name, db):
 	"""
 
 	db.users.delete_one({'name': name})
+	invalidate_credentials(db)
 
 def list_users(db):
 	for u in db.users.find().sort('name', DESCENDING):
@@ -86,7 +92,7 @@ if __name__ == '__main__':
 
 	if args.action == 'add':
 		if args.role == 'provider':
-			add_provider(args.name, make_token(), db)
+			add_provider(args.name, make_token(), db, args.share)
 		else:
 			add_worker(args.name, make_token(), make_token(), db)
 	elif args.action == 'remove':
@@ -48,10 +48,19 @@ def authorization_key(token):
 	username = token + ':'
 	return b64encode(username.encode()).decode('utf-8')
 
+def invalidate_credentials(db):
+	"""
+	Notifies all server processes using ``db`` that the set of users or registered workers has
+	changed, so that they discard the credentials that they have cached (see ``AuthCache`` in
+	``banyan/server/authentication.py``).
+	"""
+
+	db.auth_revisions.update_one({'_id': 'credentials'}, {'$inc': {'revision': 1}}, upsert=True)
+
 
 class EntryPoint:
-	def __init__(self):
-		self.ip = socket.gethostbyname(socket.gethostname())
+	def __init__(self, ip=None):
+		self.ip = ip or socket.gethostbyname(socket.gethostname())
 		self.base_url = 'http://' + self.ip + ':' + str(banyan_port)
 
 def make_url(entry_point, resource, item=None, virtual_subresource=None):
@@ -12,6 +12,7 @@ import struct
 cancellation_notice    = 0
 deregistration_notice  = 1
 resource_usage_request = 2
+tasks_available_notice = 3
 
 """
 - 16 bytes for the token sent by the server to the worker to authenticate itself.
@@ -21,15 +22,25 @@ resource_usage_request = 2
 msg_len = 33
 padding = bytearray(16)
 
+"""
+Format of a ``tasks_available_notice``. The data is the number of tasks that have just become
+available and that fit in the resources of the worker, as an unsigned 64-bit integer, followed by
+padding.
+"""
+tasks_available_format = '>16sBQ8x'
+
 class ProtocolError(Exception):
 	pass
 
-def format_message(msg_type, request_token, data):
+def format_message(msg_type, request_token, data=None):
 	if msg_type == cancellation_notice:
-		msg = struct.pack('sBs', request_token.encode('utf-8'), msg_type,
+		msg = struct.pack('16sB16s', request_token.encode('utf-8'), msg_type,
 			data.encode('utf-8'))
 	elif msg_type in [deregistration_notice, resource_usage_request]:
-		msg = struct.pack('sB', request_token.encode('utf-8'), msg_type) + padding
+		msg = struct.pack('16sB', request_token.encode('utf-8'), msg_type) + padding
+	elif msg_type == tasks_available_notice:
+		msg = struct.pack(tasks_available_format, request_token.encode('utf-8'), msg_type,
+			data)
 	else:
 		raise ProtocolError("Unknown message type.")
 
@@ -38,7 +49,7 @@ def format_message(msg_type, request_token, data):
 
 def parse_message(msg):
 	if len(msg) != msg_len:
-		return ProtocolError("Message must be exactly 17 bytes long.")
+		raise ProtocolError("Message must be exactly {} bytes long.".format(msg_len))
 
 	token = msg[:16].decode('utf-8')
 	msg_type = msg[16]
@@ -47,5 +58,7 @@ def parse_message(msg):
 		return (token, msg_type, msg[17:].decode('utf-8'))
 	elif msg_type in [deregistration_notice, resource_usage_request]:
 		return (token, msg_type, None)
+	elif msg_type == tasks_available_notice:
+		return (token, msg_type, struct.unpack(tasks_available_format, msg)[2])
 	else:
 		raise ProtocolError("Unknown message type.")
@@ -6,16 +6,167 @@ banyan.server.authentication
 
 Implements a simple, token-based authentication scheme. See ``banyan/auth/access.py`` for more
 information.
+
+The user and worker registration associated with each token are cached by ``auth_cache``, so that
+most requests can be authenticated without querying the database.
 """
 
+from threading import Lock
+from time import monotonic
+
 from flask import g, current_app as app
 from eve.auth import TokenAuth as TokenAuthBase
 from eve.utils import config
 
+from banyan.common import invalidate_credentials
+from banyan.server.constants import auth_cache_seconds, auth_revision_poll_seconds
+
+# Request tokens are nonempty, so this key never collides with one.
+registered_workers_entry = ''
+
+class AuthCache:
+	"""
+	Maps request tokens to the corresponding users and worker registrations. An entry is discarded
+	``ttl_seconds`` after it is created. All entries are discarded when the credential revision
+	stored in the database changes (see ``invalidate_credentials`` in ``banyan/common.py``); the
+	revision is read at most once every ``poll_seconds``.
+	"""
+
+	def __init__(self, ttl_seconds, poll_seconds):
+		self.ttl_seconds  = ttl_seconds
+		self.poll_seconds = poll_seconds
+
+		self.lock       = Lock()
+		self.entries    = {}
+		self.revision   = None
+		self.next_poll  = 0
+
+		# Incremented whenever the entries are cleared, so that a thread that read stale
+		# credentials from the database before the entries were cleared does not cache them.
+		self.generation = 0
+
+	def _clear(self):
+		self.entries.clear()
+		self.generation += 1
+
+	def _check_revision(self, db):
+		now = monotonic()
+
+		with self.lock:
+			if now < self.next_poll:
+				return
+			self.next_poll = now + self.poll_seconds
+
+		res = db.auth_revisions.find_one({'_id': 'credentials'})
+		revision = res['revision'] if res else 0
+
+		with self.lock:
+			if revision != self.revision:
+				self.revision = revision
+				self._clear()
+
+	def _get(self, token, field, generation):
+		with self.lock:
+			if generation != self.generation:
+				return False, None
+
+			entry = self.entries.get(token)
+			if entry is None or entry['expires_at'] < monotonic() or field not in entry:
+				return False, None
+			return True, entry[field]
+
+	def _put(self, token, field, value, generation):
+		with self.lock:
+			if generation != self.generation:
+				return
+
+			entry = self.entries.get(token)
+			if entry is None or entry['expires_at'] < monotonic():
+				entry = {'expires_at': monotonic() + self.ttl_seconds}
+				self.entries[token] = entry
+			entry[field] = value
+
+	def user(self, token, db):
+		"""
+		Returns the user with the given request token, or ``None`` if no such user exists.
+		"""
+
+		self._check_revision(db)
+		generation = self.generation
+
+		found, user = self._get(token, 'user', generation)
+		if found:
+			return user
+
+		user = db.users.find_one({'request_token': token}, {'role': True})
+
+		# We don't cache failed lookups, so that new users are accepted immediately.
+		if user is not None:
+			self._put(token, 'user', user, generation)
+		return user
+
+	def worker_info(self, token, user, db):
+		"""
+		Returns the registration of the worker with the given request token, or ``None`` if
+		the worker is not registered.
+		"""
+
+		self._check_revision(db)
+		generation = self.generation
+
+		found, user_info = self._get(token, 'user_info', generation)
+		if found:
+			return user_info
+
+		user_info = db.registered_workers.find_one({'worker_id': user[config.ID_FIELD]},
+			projection={'permissions': True})
+		self._put(token, 'user_info', user_info, generation)
+		return user_info
+
+	def registered_workers(self, db):
+		"""
+		Returns the list of registered workers, along with the request token of each worker.
+		The list is cached under ``registered_workers_entry``, which cannot be a request token.
+		"""
+
+		self._check_revision(db)
+		generation = self.generation
+
+		found, workers = self._get(registered_workers_entry, 'workers', generation)
+		if found:
+			return workers
+
+		workers = list(db.registered_workers.find({}, projection={
+			'worker_id': True, 'address': True, 'permissions': True, 'resources': True
+		}))
+
+		tokens = {user[config.ID_FIELD]: user['request_token'] for user in
+			db.users.find({config.ID_FIELD: {'$in': [w['worker_id'] for w in workers]}},
+			projection={'request_token': True})}
+
+		for worker in workers:
+			worker['request_token'] = tokens.get(worker['worker_id'])
+
+		self._put(registered_workers_entry, 'workers', workers, generation)
+		return workers
+
+	def invalidate(self, db):
+		"""
+		Discards all cached credentials, both in this process and in the other server processes
+		using ``db``.
+		"""
+
+		invalidate_credentials(db)
+
+		with self.lock:
+			self._clear()
+
+auth_cache = AuthCache(auth_cache_seconds, auth_revision_poll_seconds)
+
 class TokenAuth(TokenAuthBase):
 	def check_auth(self, token, allowed_roles, resource, method):
 		db = app.data.driver.db
-		res = db.users.find_one({'request_token': token}, {'role': True})
+		res = auth_cache.user(token, db)
 
 		"""
 		Save the token and associated user, in case they will be needed later during
@@ -39,7 +190,7 @@ class TokenAuth(TokenAuthBase):
 class RestrictCreationToProviders(TokenAuthBase):
 	def check_auth(self, token, allowed_roles, resource, method):
 		db = app.data.driver.db
-		res = db.users.find_one({'request_token': token}, {'role': True})
+		res = auth_cache.user(token, db)
 
 		"""
 		Save the token and associated user, in case they will be needed later during
@@ -56,8 +207,7 @@ class RestrictCreationToProviders(TokenAuthBase):
 		validation is performed by the validator.
 		"""
 		if resource == 'tasks' and res['role'] == 'worker':
-			user_info = db.registered_workers.find_one({'worker_id': res['_id']},
-				projection={'permissions': True})
+			user_info = auth_cache.worker_info(token, res, db)
 			if not user_info or len(user_info['permissions']) == 0:
 				return False
 			g.user_info = user_info
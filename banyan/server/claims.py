@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.claims
+--------------------
+
+Implements the ``claim`` virtual resource, which allows workers to claim available tasks without
+going through the PATCH endpoint, along with the virtual actions that find the available tasks that
+fit in the free resources of a worker.
+
+Claiming a task via PATCH requires acquiring the task lock, running the full validator on the task,
+and issuing several database operations. This serializes all workers that are contending for the
+same queue. Here, ownership of a task is instead decided by a single conditional
+``find_one_and_update`` that changes the state from ``available`` to ``running``. Since only one
+worker can win this update, no lock is required.
+"""
+
+import hashlib
+import math
+import random
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+from flask import abort, g
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from eve.utils import config
+
+from banyan.common import make_token
+from banyan.server.critical_path import level_field
+from banyan.server.leases import make_lease
+from banyan.server.validation import BulkUpdateValidator, RequestValidator
+from config.settings import max_task_set_size
+
+"""
+Fields of the task that are returned to the worker after a successful claim, so that it can start
+running the task without making another request.
+"""
+claim_projection = {
+	'command': True,
+	'requested_resources': True,
+	'estimated_runtime_milliseconds': True,
+	'max_shutdown_time_milliseconds': True,
+	'attempt_count': True,
+	'execution_data_id': True,
+	'owner': True
+}
+
+"""
+The number of candidate tasks that are considered by ``make_claims_by_resources`` for each task
+that the worker asks for. Some of the candidates may be claimed by other workers before we get to
+them, or may not fit alongside the tasks that were chosen before them.
+"""
+candidate_factor = 4
+
+"""
+Each task is assigned a random ``offer_key`` in ``[0, offer_key_range)`` when it is created. Among
+the tasks with the same effective priority (see ``fair_share.py``) and critical path level (see
+``critical_path.py``), workers are offered tasks in order of ``offer_key``, starting from an offset
+derived from the worker's id, and wrapping around to the beginning if necessary. Workers that poll
+at the same time are therefore offered different tasks, rather than all racing for the same first
+page.
+"""
+offer_key_range = 2 ** 31
+
+"""
+The maximum number of groups of tasks with the same effective priority and critical path level
+that ``offered_tasks`` visits in one call. Each group costs up to three queries, so this bounds the
+number of round trips when the groups are small, at the cost of returning fewer tasks than were
+asked for. The tasks in the groups that are skipped are offered once the ones before them have
+been claimed.
+"""
+max_offer_groups = 8
+
+def make_offer_key():
+	return random.randrange(offer_key_range)
+
+def offer_offset(worker_id):
+	digest = hashlib.sha1(str(worker_id).encode()).digest()
+	return int.from_bytes(digest[:4], 'big') % offer_key_range
+
+def offered_after(priority, level):
+	"""
+	Returns a query that matches the tasks that are offered after the ones with the given
+	effective priority and critical path level. Tasks created before these fields were
+	introduced do not have them, and are offered last.
+	"""
+
+	conditions = []
+
+	if priority is not None:
+		conditions.append({'effective_priority': {'$not': {'$gte': priority}}})
+	if level is not None:
+		conditions.append({
+			'effective_priority': priority,
+			level_field: {'$not': {'$gte': level}}
+		})
+
+	return {'$or': conditions} if len(conditions) != 0 else None
+
+def offered_tasks(query, worker_id, count, projection, db):
+	"""
+	Returns up to ``count`` tasks that match ``query``, in the order in which they are offered
+	to the worker with id ``worker_id``. The tasks are taken from one effective priority and
+	critical path level at a time, starting with the highest, and from at most
+	``max_offer_groups`` of them.
+	"""
+
+	offset = offer_offset(worker_id)
+	sort   = [('offer_key', ASCENDING)]
+	tasks  = []
+	remaining_query = query
+
+	for _ in range(max_offer_groups):
+		if len(tasks) == count:
+			break
+
+		top = db.tasks.find_one(remaining_query,
+			projection={'effective_priority': True, level_field: True},
+			sort=[('effective_priority', DESCENDING), (level_field, DESCENDING)])
+		if top is None:
+			break
+
+		priority = top.get('effective_priority')
+		level    = top.get(level_field)
+		level_query = dict(query, effective_priority=priority, **{level_field: level})
+
+		tasks.extend(db.tasks.find(dict(level_query, offer_key={'$gte': offset}),
+			projection=projection, sort=sort, limit=count - len(tasks)))
+
+		# This also matches tasks created before the ``offer_key`` field was introduced.
+		if len(tasks) < count:
+			tasks.extend(db.tasks.find(dict(level_query,
+				offer_key={'$not': {'$gte': offset}}), projection=projection, sort=sort,
+				limit=count - len(tasks)))
+
+		after = offered_after(priority, level)
+		if after is None:
+			break
+		remaining_query = {'$and': [query, after]}
+
+	return tasks
+
+def ensure_worker_can_claim(validator):
+	assert g.user is not None
+
+	if g.user['role'] != 'worker':
+		abort(403, description="Only workers can claim tasks.")
+
+	validator.ensure_worker_has_permission('claim')
+
+class ClaimValidator(BulkUpdateValidator):
+	def __init__(self, schema, resource=None, allow_unknown=False,
+		transparent_schema_rules=False):
+
+		super().__init__(schema, resource)
+
+	def validate_update(self, updates):
+		ensure_worker_can_claim(self)
+
+		if not super().validate_update(updates):
+			return False
+
+		for i, update in enumerate(updates):
+			if update['values']['worker_id'] != g.user[config.ID_FIELD]:
+				self._error('update {}'.format(i), "Workers can only claim tasks on "
+					"their own behalf.")
+
+		return len(self._errors) == 0
+
+def claim(task_id, values, db):
+	"""
+	Attempts to claim the task with id ``task_id``. The state change is made by a single
+	conditional update, so at most one worker can succeed. The same update leases the task to
+	the worker (see ``leases.py``), and, for the first attempt, increments the attempt count and
+	sets the id of the execution data record, which is allocated in advance. The record is
+	inserted (or, if the task is being retried, updated) afterwards. If that fails, then the
+	claim is undone, so that the task is never left running without a matching record.
+
+	Returns a ``dict`` with the information the worker needs to run the task, or ``None`` if the
+	task was not in the ``available`` state.
+
+	Args:
+		task_id: ``ObjectId`` of the task.
+		values: Fields of the execution data to set, e.g. ``worker_id``. If ``time_started``
+			is omitted, then the time of the claim is used, so that the attempt is counted
+			by ``fair_share.usage_by_owner``.
+		db: Handle to the ``banyan`` database.
+	"""
+
+	if 'time_started' not in values:
+		values = dict(values, time_started=datetime.utcnow())
+
+	lease   = make_lease(values['worker_id'])
+	data_id = ObjectId()
+
+	"""
+	This mirrors the logic in ``event_hooks.update_execution_data``: the execution data for the
+	first attempt is created when the task is claimed, whereas the execution data for subsequent
+	attempts is created when the task is put back on the queue. Most claims are for first
+	attempts, so we try that case first.
+	"""
+	task = db.tasks.find_one_and_update(
+		{config.ID_FIELD: task_id, 'state': 'available', 'attempt_count': 0},
+		{
+			'$set': {'state': 'running', 'lease': lease, 'execution_data_id': data_id},
+			'$inc': {'attempt_count': 1},
+			'$currentDate': {config.LAST_UPDATED: True}
+		},
+		projection=claim_projection
+	)
+
+	if task is None:
+		task = db.tasks.find_one_and_update(
+			{config.ID_FIELD: task_id, 'state': 'available', 'attempt_count': {'$gt': 0}},
+			{
+				'$set': {'state': 'running', 'lease': lease},
+				'$currentDate': {config.LAST_UPDATED: True}
+			},
+			projection=claim_projection
+		)
+
+		if task is None:
+			return None
+
+		data_id = task['execution_data_id']
+
+	try:
+		if task['attempt_count'] == 0:
+			data = {
+				config.ID_FIELD: data_id,
+				'task_id': task_id,
+				'attempt_count': 1,
+				'token': make_token()
+			}
+
+			if 'owner' in task:
+				data['owner'] = task['owner']
+
+			data.update(values)
+			db.execution_info.insert_one(data)
+		else:
+			data = db.execution_info.find_one_and_update(
+				{config.ID_FIELD: data_id},
+				{'$set': values},
+				projection={'token': True},
+				return_document=ReturnDocument.AFTER
+			)
+
+			assert data is not None
+	except:
+		unclaim(task, data_id, db)
+		raise
+
+	result = {
+		config.ID_FIELD: str(task_id),
+		'token': data['token']
+	}
+
+	for field in claim_projection:
+		if field in task and field not in ['attempt_count', 'execution_data_id', 'owner']:
+			result[field] = task[field]
+	return result
+
+def unclaim(task, data_id, db):
+	"""
+	Puts back a task that was claimed by ``claim``, but whose execution data record could not be
+	written. ``task`` is the document as it was before the claim. The update is conditional on
+	the task still being running with the same execution data, so that it has no effect if the
+	task has since been reclaimed or terminated.
+	"""
+
+	updates = {
+		'$set': {'state': 'available'},
+		'$unset': {'lease': True},
+		'$currentDate': {config.LAST_UPDATED: True}
+	}
+
+	if task['attempt_count'] == 0:
+		updates['$inc'] = {'attempt_count': -1}
+		updates['$unset']['execution_data_id'] = True
+
+	db.tasks.update_one({
+		config.ID_FIELD: task[config.ID_FIELD],
+		'state': 'running',
+		'execution_data_id': data_id
+	}, updates)
+
+def make_claims(updates, db):
+	"""
+	Called after validation in order to claim the targets of each update. Tasks that could not
+	be claimed (e.g. because another worker claimed them first) are reported to the worker, but
+	do not cause the request to fail.
+	"""
+
+	claimed   = []
+	unclaimed = []
+
+	for update in updates:
+		for target in update['targets']:
+			result = claim(target, update['values'], db)
+
+			if result is None:
+				unclaimed.append(str(target))
+			else:
+				claimed.append(result)
+
+	return {'claimed': claimed, 'unclaimed': unclaimed}
+
+class ClaimByResourcesValidator(RequestValidator):
+	def __init__(self, schema, resource=None, allow_unknown=False,
+		transparent_schema_rules=False):
+
+		super().__init__(schema, resource)
+
+	def validate_request(self, document):
+		ensure_worker_can_claim(self)
+		return super().validate_request(document)
+
+def core_demand(requested_resources, total_cores):
+	"""
+	Returns the number of cores that a worker with ``total_cores`` cores would reserve for a
+	task. This is the same computation as the one performed by ``reserved_resources`` in
+	``banyan/worker/task.py``.
+	"""
+
+	cores = requested_resources.get('cpu_cores', {})
+	return max(cores.get('count', 0), math.ceil(cores.get('percent', 0) / 100 * total_cores))
+
+def resource_query(resources):
+	"""
+	Returns a query that matches the available tasks that would individually fit in the given
+	free resources. The GPU constraints are the same as the ones used by ``test_gpu_filter`` in
+	``test_server.py``.
+	"""
+
+	query = {
+		'state': 'available',
+		'requested_resources.cpu_memory_bytes': {'$lte': resources['memory_bytes']},
+		'requested_resources.cpu_cores.count': {'$lte': resources['cpu_cores']},
+		'requested_resources.gpu_count': {'$lte': resources['gpus']}
+	}
+
+	conditions = []
+
+	if 'gpu_memory_bytes' in resources:
+		conditions.append({'$or': [
+			{'requested_resources.gpu_memory_bytes': {'$exists': False}},
+			{'requested_resources.gpu_memory_bytes':
+				{'$lte': resources['gpu_memory_bytes']}}
+		]})
+
+	if 'gpu_compute_capability_major' in resources:
+		cc_major = resources['gpu_compute_capability_major']
+		cc_minor = resources.get('gpu_compute_capability_minor', 0)
+
+		conditions.append({'$or': [
+			{'requested_resources.gpu_compute_capability_major': {'$exists': False}},
+			{'requested_resources.gpu_compute_capability_major': {'$lt': cc_major}},
+			{'$and': [
+				{'requested_resources.gpu_compute_capability_major': {'$eq': cc_major}},
+				{'$or': [
+					{'requested_resources.gpu_compute_capability_minor':
+						{'$exists': False}},
+					{'requested_resources.gpu_compute_capability_minor':
+						{'$lte': cc_minor}}
+				]}
+			]}
+		]})
+
+	if len(conditions) != 0:
+		query['$and'] = conditions
+	return query
+
+def task_fits(requested_resources, resources):
+	"""
+	Returns whether a task with the given requested resources would fit in ``resources``. This
+	applies the same constraints as ``resource_query``, along with the core percentages.
+	"""
+
+	total_cores = resources.get('total_cpu_cores', resources['cpu_cores'])
+	requested   = requested_resources
+
+	if requested.get('cpu_memory_bytes', 0) > resources['memory_bytes'] or \
+		core_demand(requested, total_cores) > resources['cpu_cores'] or \
+		requested.get('gpu_count', 0) > resources['gpus']:
+		return False
+
+	if 'gpu_memory_bytes' in resources and \
+		requested.get('gpu_memory_bytes', 0) > resources['gpu_memory_bytes']:
+		return False
+
+	if 'gpu_compute_capability_major' in resources and \
+		'gpu_compute_capability_major' in requested:
+		have = (resources['gpu_compute_capability_major'],
+			resources.get('gpu_compute_capability_minor', 0))
+		need = (requested['gpu_compute_capability_major'],
+			requested.get('gpu_compute_capability_minor', 0))
+
+		if need > have:
+			return False
+
+	return True
+
+def candidate_priority(task):
+	"""
+	Candidates are considered in order of decreasing effective priority and critical path level,
+	and then in order of decreasing resource requirements, so that the tasks with the largest
+	requirements that fit are claimed first.
+	"""
+
+	requested = task['requested_resources']
+	priority  = task.get('effective_priority')
+
+	return (
+		priority is not None,
+		priority or 0,
+		task.get(level_field, -1),
+		requested.get('gpu_count', 0),
+		requested.get('cpu_cores', {}).get('count', 0),
+		requested.get('cpu_memory_bytes', 0)
+	)
+
+def make_claims_by_resources(request, db):
+	"""
+	Called after validation in order to claim a set of available tasks that can run
+	simultaneously using the free resources reported by the worker.
+
+	The candidates are the tasks offered to the worker (see ``offered_tasks``). They are packed
+	greedily: we iterate over the candidates in order of decreasing resource requirements, and
+	attempt to claim each one that still fits. If another worker claims a candidate first, we
+	simply move on to the next one.
+	"""
+
+	resources   = request['resources']
+	max_count   = request.get('max_count', 1)
+	total_cores = resources.get('total_cpu_cores', resources['cpu_cores'])
+
+	values = {'worker_id': g.user[config.ID_FIELD]}
+	if 'time_started' in request:
+		values['time_started'] = request['time_started']
+
+	free_memory = resources['memory_bytes']
+	free_cores  = resources['cpu_cores']
+	free_gpus   = resources['gpus']
+	claimed     = []
+
+	"""
+	A task that requests zero cores still requires at least one core not to be reserved by any
+	other task (see the comment for ``cpu_cores`` in ``schema.py``).
+	"""
+	if free_cores == 0:
+		return {'claimed': claimed}
+
+	candidates = offered_tasks(resource_query(resources), g.user[config.ID_FIELD],
+		candidate_factor * max_count, {'requested_resources': True,
+		'effective_priority': True, level_field: True}, db)
+	candidates.sort(key=candidate_priority, reverse=True)
+
+	for task in candidates:
+		if len(claimed) == max_count or free_cores == 0:
+			break
+
+		requested = task['requested_resources']
+		memory    = requested.get('cpu_memory_bytes', 0)
+		cores     = core_demand(requested, total_cores)
+		gpus      = requested.get('gpu_count', 0)
+
+		if memory > free_memory or cores > free_cores or gpus > free_gpus:
+			continue
+
+		result = claim(task[config.ID_FIELD], values, db)
+		if result is None:
+			continue
+
+		claimed.append(result)
+		free_memory -= memory
+		free_cores  -= cores
+		free_gpus   -= gpus
+
+	return {'claimed': claimed}
+
+"""
+Fields of the available tasks that are returned by ``find_available_tasks``. These are the fields
+that a worker needs in order to decide which tasks to claim.
+"""
+available_projection = {
+	'effective_priority': True,
+	'requested_resources': True,
+	'max_shutdown_time_milliseconds': True,
+	'estimated_runtime_milliseconds': True
+}
+
+"""
+Eve stores ``_updated`` with a precision of one second, and computes it before the document is
+written. The time returned by ``find_available_tasks`` is moved back by this margin, so that a
+worker that passes it back as ``updated_since`` sees every task that changed after its previous
+request. Tasks that changed within the margin are returned again, which is harmless.
+"""
+updated_since_margin = timedelta(seconds=2)
+
+def find_available_tasks(request, db):
+	"""
+	Called after validation in order to list the available tasks that would individually fit in
+	the free resources reported by the worker. Only the fields in ``available_projection`` are
+	returned, in the order in which they are offered to the worker (see ``offered_tasks``).
+
+	This also supports incremental refreshes of the worker's task cache:
+
+	- The response includes the time ``as_of``. If the worker passes it back as
+	  ``updated_since``, then only the tasks that have been updated since are returned.
+	- If the worker passes the ids of the tasks in its cache as ``cached``, then the response
+	  lists the ones that are no longer available (e.g. because other workers have claimed them)
+	  as ``withdrawn``.
+	"""
+
+	resources   = request['resources']
+	max_count   = request.get('max_count', max_task_set_size)
+	total_cores = resources.get('total_cpu_cores', resources['cpu_cores'])
+	as_of       = datetime.utcnow().replace(microsecond=0) - updated_since_margin
+	tasks       = []
+	result      = {'tasks': tasks, 'as_of': as_of}
+
+	if 'cached' in request:
+		available = set(task[config.ID_FIELD] for task in db.tasks.find(
+			{config.ID_FIELD: {'$in': request['cached']}, 'state': 'available'},
+			projection={config.ID_FIELD: True}))
+		result['withdrawn'] = [str(_id) for _id in request['cached'] if _id not in available]
+
+	if resources['cpu_cores'] == 0:
+		return result
+
+	query = resource_query(resources)
+	if 'updated_since' in request:
+		query[config.LAST_UPDATED] = {'$gte': request['updated_since']}
+
+	"""
+	The query only accounts for the core counts of the tasks, so some of the candidates may not
+	fit once the percentages are taken into account.
+	"""
+	candidates = offered_tasks(query, g.user[config.ID_FIELD], candidate_factor * max_count,
+		available_projection, db)
+
+	for task in candidates:
+		if len(tasks) == max_count:
+			break
+
+		if core_demand(task['requested_resources'], total_cores) > resources['cpu_cores']:
+			continue
+
+		task[config.ID_FIELD] = str(task[config.ID_FIELD])
+		tasks.append(task)
+
+	return result
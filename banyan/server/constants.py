@@ -34,3 +34,63 @@ max_name_string_length = 256
 max_command_string_length = 1024
 
 default_max_attempts = 1
+
+"""
+Limits on the size of a graph submitted to ``tasks/submit_graph``. Unlike the updates described
+above, the tasks are inserted using ``insert_many``, which splits the documents into batches that
+respect the BSON size limit.
+"""
+max_graph_task_count = 65536
+max_graph_edge_count = 262144
+
+"""
+The amount of time after which a lock held by a server process is considered to be abandoned (see
+``LeaseLock`` in ``locks.py``). This should be much longer than the time required to process any
+request. The leases of the locks that are still held are renewed every ``lock_renewal_seconds``, so
+that a slow request does not lose its locks as long as its process is alive.
+"""
+lock_lease_seconds   = 60
+lock_renewal_seconds = 15
+
+"""
+The credentials associated with a token are cached by each server process for at most
+``auth_cache_seconds`` (see ``AuthCache`` in ``authentication.py``). Each process also checks for
+revocations at most once every ``auth_revision_poll_seconds``, so a removed user or unregistered
+worker stops being accepted after this amount of time.
+"""
+auth_cache_seconds = 30
+auth_revision_poll_seconds = 1
+
+"""
+Parameters for fair-share scheduling (see ``fair_share.py``). Priorities are restricted to a range
+that keeps the effective priorities well within the range of 64-bit integers.
+"""
+min_priority = -2 ** 20
+max_priority = 2 ** 20
+fair_share_levels = 16
+fair_share_window_seconds = 24 * 60 * 60
+fair_share_update_seconds = 30
+
+"""
+After failing to connect to a worker, a server process waits this long before trying again (see
+``WorkerNotifier`` in ``worker_notifier.py``).
+"""
+notice_retry_seconds = 30
+
+"""
+The maximum number of messages queued by ``WorkerNotifier`` for a single worker. This bounds the
+memory used for workers whose connections are slow or still being established.
+"""
+max_queued_messages = 1024
+
+# The time allowed for establishing a connection to a worker.
+worker_connect_timeout_seconds = 10
+
+"""
+A claimed task is leased to the worker that claimed it for ``task_lease_seconds`` (see
+``leases.py``). Workers should renew their leases several times within this period. The server
+process that checks the availability of the workers looks for expired leases every
+``lease_sweep_seconds``.
+"""
+task_lease_seconds = 90
+lease_sweep_seconds = 15
@@ -7,15 +7,30 @@ banyan.server.continuations
 Implements the bookkeeping to manage dependency chains.
 
 **Note that none of the functions in this file is thread-safe.** It is the responsibility of the
-request handlers to ensure that access to resources is synchronized as needed. See
-`specification.md` for details about when synchronization is necessary.
+request handlers to ensure that access to resources is synchronized as needed, by acquiring the
+locks in ``task_locks`` for the affected tasks. See `specification.md` for details about when
+synchronization is necessary.
+
+The locks only cover the tasks named by a request and their direct continuations, whereas the
+propagation of releases and cancellations may reach tasks further down the graph, whose locks are
+held by other requests. Every write that changes the structure of the graph, or the state or
+dependency count of a task, is therefore conditional on the state that it expects (e.g.
+continuations are only added to a parent that is still inactive, and tasks are only made available
+if they are still inactive with no pending dependencies). A write whose condition no longer holds is
+skipped, since it lost the race with a concurrent propagation that already dealt with the task.
 """
 
+from collections import Counter
+
 from flask import current_app as app
+from pymongo import UpdateOne
 from eve.utils import config
 
 from banyan.server.mongo_common import find_by_id, update_by_id
 from banyan.server.validation import BulkUpdateValidator
+from banyan.server.topological_order import DependencyGraph
+import banyan.server.critical_path as critical_path
+from banyan.server.dispatch import dispatcher
 
 def is_inactive(task_id, db):
 	task = find_by_id('tasks', task_id, db, ['state'])
@@ -47,17 +62,30 @@ class AddContinuationValidator(BulkUpdateValidator):
 
 		ensure_arguments_inactive(updates, self)
 
-		"""
-		We don't perform a full cyclic dependency check, because doing so while holding a
-		lock could cause severe performance degradations. But even in the case that a cyclic
-		dependency occurs, data corruption should not occur.
-		"""
 		for i, update in enumerate(updates):
 			targets, values = update['targets'], update['values']
 			if len(set(values) - set(targets)) != len(values):
 				self._error('update {}'.format(i), "Field 'values' contains ids "
 					"from 'targets'. This would cause self-loops.")
 
+		if len(self._errors) != 0:
+			return False
+
+		"""
+		Checks for cyclic dependencies using the topological order of the tasks. In the
+		common case, this only requires the positions of the tasks in the order. See
+		``topological_order.py`` for details.
+		"""
+		graph = DependencyGraph(app.data.driver.db)
+
+		for i, update in enumerate(updates):
+			for parent in update['targets']:
+				for child in update['values']:
+					if not graph.add_edge(parent, child):
+						self._error('update {}'.format(i), "Adding '{}' as a "
+							"continuation of '{}' would create a cyclic "
+							"dependency.".format(child, parent))
+
 		return len(self._errors) == 0
 
 class RemoveContinuationValidator(BulkUpdateValidator):
@@ -73,89 +101,166 @@ class RemoveContinuationValidator(BulkUpdateValidator):
 		ensure_arguments_inactive(updates, self)
 		return len(self._errors) == 0
 
-def acquire(child_id, db):
+def add_parent(child_id, db, parent_id):
 	"""
-	Invoked each time a continuation is added to a parent task.
+	Records ``parent_id`` in the ``parents`` field of the continuations, without acquiring them.
 
 	Args:
-		child_id: ``ObjectId`` of the continuation.
+		child_id: ``ObjectId`` or list of ``ObjectId``s of the continuations.
 		db: Handle to the ``banyan`` database.
+		parent_id: ``ObjectId`` of the parent task.
 	"""
 
-	update_by_id('tasks', child_id, db, {
-		'$inc': {'pending_dependency_count': 1},
-		'$currentDate': {config.LAST_UPDATED: True}
-	})
+	update_by_id('tasks', child_id, db, {'$addToSet': {'parents': parent_id}})
 
-def release(child_id, db):
+def acquire(child_id, db, parent_id):
 	"""
-	Invoked for each child continuation when a parent task is terminated.
+	Invoked each time a continuation is added to a parent task. In addition to incrementing the
+	dependency count of the continuation, we record the parent in its ``parents`` field, so that
+	the edge can be found without scanning the continuation lists of all tasks. Continuations
+	that are no longer inactive (e.g. because they were cancelled concurrently) are skipped.
 
 	Args:
-		child_id: ``ObjectId`` of the continuation.
+		child_id: ``ObjectId`` or list of ``ObjectId``s of the continuations.
 		db: Handle to the ``banyan`` database.
+		parent_id: ``ObjectId`` of the parent task.
 	"""
 
-	child = find_by_id('tasks', child_id, db, {
-		'state': True,
-		'command': True,
-		'continuations': True,
-		'pending_dependency_count': True
+	ids = child_id if isinstance(child_id, list) else [child_id]
+
+	db.tasks.update_many({config.ID_FIELD: {'$in': ids}, 'state': 'inactive'}, {
+		'$inc': {'pending_dependency_count': 1},
+		'$addToSet': {'parents': parent_id},
+		'$currentDate': {config.LAST_UPDATED: True}
 	})
 
-	assert child['state'] == 'inactive'
-	assert child['pending_dependency_count'] >= 1
-
-	if child['pending_dependency_count'] == 1:
-		if 'command' in child:
-			update_by_id('tasks', child_id, db, {
-				'$set': {
-					'state': 'available',
-					'pending_dependency_count': 0
-				},
-				'$currentDate': {config.LAST_UPDATED: True}
-			})
+def _finish_ready(ids, db):
+	"""
+	Changes the state of each inactive task in ``ids`` whose dependency count is zero. Tasks with
+	commands are made available, and the workers that they fit are notified (see
+	``dispatch.py``). Tasks without commands are terminated immediately, and their continuations
+	are returned, since they must be released in turn.
+
+	The state changes are conditional on the tasks still being inactive with no pending
+	dependencies, so that a task that is concurrently cancelled or given a new parent is never
+	made available, and a task without a command is only terminated (and its continuations only
+	released) once.
+	"""
+
+	if len(ids) == 0:
+		return []
+
+	ready = db.tasks.find({
+		config.ID_FIELD: {'$in': ids},
+		'state': 'inactive',
+		'pending_dependency_count': 0
+	}, projection={'command': True, 'continuations': True, 'requested_resources': True})
+
+	runnable = []
+	groups   = []
+
+	for task in ready:
+		if 'command' in task:
+			runnable.append(task)
 		else:
-			update_by_id('tasks', child_id, db, {
-				'$set': {
-					'state': 'terminated',
-					'pending_dependency_count': 0
-				},
-				'$currentDate': {config.LAST_UPDATED: True}
-			})
-
-			for cont in child['continuations']:
-				try_make_available(cont, db)
-	else:
-		update_by_id('tasks', child_id, db, {
-			'$inc': {'pending_dependency_count': -1},
+			groups.append(task)
+
+	if len(runnable) != 0:
+		db.tasks.update_many({
+			config.ID_FIELD: {'$in': [task[config.ID_FIELD] for task in runnable]},
+			'state': 'inactive',
+			'pending_dependency_count': 0
+		}, {
+			'$set': {'state': 'available'},
+			'$currentDate': {config.LAST_UPDATED: True}
+		})
+
+		dispatcher.tasks_available(runnable, db)
+
+	"""
+	Tasks without commands are only used to group continuations together, so there are usually
+	far fewer of them. We terminate them individually, so that we know exactly which ones we
+	terminated.
+	"""
+	released = []
+
+	for task in groups:
+		res = db.tasks.update_one({
+			config.ID_FIELD: task[config.ID_FIELD],
+			'state': 'inactive',
+			'pending_dependency_count': 0
+		}, {
+			'$set': {'state': 'terminated'},
 			'$currentDate': {config.LAST_UPDATED: True}
 		})
 
-def release_keep_inactive(child_id, db):
+		if res.modified_count == 1:
+			released.extend(task['continuations'])
+
+	return released
+
+def _propagate(release_ids, ready_ids, db):
+	"""
+	Propagates the termination of a set of tasks through the dependency graph, one level at a
+	time. Each level is processed using a constant number of queries, so the number of round
+	trips to the database is proportional to the depth of the graph rather than to its size,
+	and no recursion is used.
+
+	Args:
+		release_ids: Ids of the tasks whose dependency counts must be decremented. An id
+			occurs once for each parent that released it.
+		ready_ids: Ids of tasks that were never acquired by the parent that released
+			them. These are only made available if their dependency counts are already
+			zero.
+		db: Handle to the ``banyan`` database.
+	"""
+
+	while len(release_ids) != 0 or len(ready_ids) != 0:
+		counts = Counter(release_ids)
+
+		if len(counts) != 0:
+			db.tasks.bulk_write([
+				UpdateOne({config.ID_FIELD: _id, 'state': 'inactive'}, {
+					'$inc': {'pending_dependency_count': -n},
+					'$currentDate': {config.LAST_UPDATED: True}
+				}) for _id, n in counts.items()
+			], ordered=False)
+
+		ids = list(set(counts.keys()) | set(ready_ids))
+		release_ids, ready_ids = _finish_ready(ids, db), []
+
+def release(child_ids, db):
+	"""
+	Invoked with the continuations of a parent task when it terminates successfully.
+
+	Args:
+		child_ids: List of ``ObjectId``s of the continuations.
+		db: Handle to the ``banyan`` database.
+	"""
+
+	_propagate(list(child_ids), [], db)
+
+def release_keep_inactive(child_id, db, parent_id):
 	"""
 	The parent task should call this function when a continuation is removed from it.
+	Continuations that are no longer inactive (i.e. because they were cancelled concurrently)
+	are skipped.
 
 	Args:
-		child_id`: ``ObjectId`` of the continuation.
+		child_id`: ``ObjectId`` or list of ``ObjectId``s of the continuations.
 		db: Handle to the Banyan database.
+		parent_id: ``ObjectId`` of the parent task.
 	"""
 
-	cursor = find_by_id('tasks', child_id, db, {
-		'state': True,
-		'pending_dependency_count': True
-	})
+	ids = child_id if isinstance(child_id, list) else [child_id]
 
-	for child in cursor:
-		assert child['state'] == 'inactive'
-		assert child['pending_dependency_count'] >= 1
-
-	update_by_id('tasks', child_id, db, {
+	db.tasks.update_many({config.ID_FIELD: {'$in': ids}, 'state': 'inactive'}, {
 		'$inc': {'pending_dependency_count': -1},
+		'$pull': {'parents': parent_id},
 		'$currentDate': {config.LAST_UPDATED: True}
 	})
 
-def try_make_available(child_id, db):
+def try_make_available(child_ids, db):
 	"""
 	This function is called when a parent task is created with no command, directly in the
 	'available' state. We could handle this event exactly as we do for regular tasks, by first
@@ -164,75 +269,134 @@ def try_make_available(child_id, db):
 	dependency counts by a net sum of zero.
 
 	This function collapses the ``acquire`` and ``release`` operations together by running only
-	those continuations that already have dependency counts of zero.
+	those continuations that already have dependency counts of zero. The continuations of any
+	continuations without commands were acquired as usual, so they are released as usual.
 
 	Args:
-		child_id: ``ObjectId`` of the continuation.
+		child_ids: List of ``ObjectId``s of the continuations.
 		db: Handle to the ``banyan`` database.
 	"""
 
-	child = find_by_id('tasks', child_id, db, {
-		'state': True,
-		'command': True,
-		'continuations': True,
-		'pending_dependency_count': True
-	})
-
-	assert child['state'] == 'inactive'
-
-	if child['pending_dependency_count'] == 0:
-		if 'command' in child:
-			update_by_id('tasks', child_id, db, {'$set': {'state': 'available'}})
-		else:
-			update_by_id('tasks', child_id, db, {'$set': {'state': 'terminated'}})
+	_propagate([], list(child_ids), db)
 
-			for cont in child['continuations']:
-				try_make_available(cont, db)
-
-def cancel(task_id, db, assert_inactive=False):
+def cancel(task_ids, db, assert_inactive=False):
 	"""
-	Cancels a task, and recursively cancels all its continuations.
+	Cancels a set of tasks, along with all of their descendants. The dependency graph is
+	traversed one level at a time, using one query to fetch the continuations of the current
+	level and one update to cancel it.
+
+	All edges into the cancelled tasks are removed. The ``parents`` fields of the cancelled tasks
+	tell us which tasks mention them, so the edges are removed from the continuation lists of
+	those tasks using a single update at the end. The critical path lengths of the remaining
+	parents are updated afterwards, since they may have lost their longest continuations.
 
 	Args:
-		task_id: ID of the task to be cancelled.
+		task_ids: IDs of the tasks to be cancelled.
 		db: Handle to the ``banyan`` database.
 		assert_inactive: Flag used to ensure that continuations further down the tree are
 			inactive.
 	"""
 
-	update_by_id('tasks', task_id, db, {'$set': {'state': 'cancelled'}})
+	if len(task_ids) == 0:
+		return
+
+	frontier  = list(set(task_ids))
+	cancelled = set(frontier)
+	parents   = set()
+
+	while len(frontier) != 0:
+		db.tasks.update_many(
+			{config.ID_FIELD: {'$in': frontier}, 'state': {'$in': ['inactive', 'available']}},
+			{'$set': {'state': 'cancelled'}, '$currentDate': {config.LAST_UPDATED: True}}
+		)
+
+		"""
+		The continuations are read after the tasks are cancelled. Continuations are only added
+		to inactive tasks (see ``make_additions``), so any continuation added concurrently is
+		seen here.
+		"""
+		tasks = db.tasks.find({config.ID_FIELD: {'$in': frontier}},
+			projection={'continuations': True, 'parents': True, 'state': True})
+		next_frontier = []
 
-	if assert_inactive:
-		task = find_by_id('tasks', task_id, db, {'continuations': True, 'state': True})
-		assert task['state'] == 'inactive' or task['state'] == 'cancelled'
-	else:
-		task = find_by_id('tasks', task_id, db, {'continuations': True})
+		for task in tasks:
+			if assert_inactive:
+				assert task['state'] == 'cancelled'
 
-	for child in task['continuations']:
-		cancel(child, db, assert_inactive=True)
+			parents.update(task.get('parents', []))
 
-	# Remove the continuation from all tasks that mention it.
-	db.tasks.update({'continuations': {'$in': [task_id]}},
-		{'$pull': {'continuations': {'$in': [task_id]}}}, multi=True)
+			for child in task['continuations']:
+				if child not in cancelled:
+					cancelled.add(child)
+					next_frontier.append(child)
+
+		# Everything below the first level should have been inactive.
+		frontier, assert_inactive = next_frontier, True
+
+	# Remove the cancelled tasks from all continuation lists that mention them.
+	cancelled = list(cancelled)
+	db.tasks.update_many({config.ID_FIELD: {'$in': list(parents)}},
+		{'$pull': {'continuations': {'$in': cancelled}}})
+	db.tasks.update_many({config.ID_FIELD: {'$in': cancelled}}, {'$set': {'parents': []}})
+	critical_path.update(parents - set(cancelled), db)
+
+def rebuild_parents(db):
+	"""
+	Recomputes the ``parents`` field of every task from the continuation lists. This only needs
+	to be run once, on databases created before the ``parents`` field was introduced.
+	"""
+
+	parents = {}
+	for task in db.tasks.find({}, projection={'continuations': True}):
+		for child in task.get('continuations', []):
+			parents.setdefault(child, []).append(task[config.ID_FIELD])
+
+	db.tasks.update_many({}, {'$set': {'parents': []}})
+
+	if len(parents) != 0:
+		db.tasks.bulk_write([UpdateOne({config.ID_FIELD: child}, {'$set': {'parents': p}})
+			for child, p in parents.items()], ordered=False)
 
 def make_additions(updates, db):
 	"""
 	Called after validation in order to perform bulk addition of continuations. If validation
 	was successful, this operation should not fail.
+
+	The continuations are acquired before they are added to the parent, and the parent is only
+	updated if it is still inactive. If a parent or a continuation was concurrently made
+	available or cancelled by a propagation that does not hold its lock, then the corresponding
+	edges are not added, and the continuations that were acquired for them are released.
 	"""
 
+	changed = []
+
 	for update in updates:
 		for parent in update['targets']:
 			parent_task = find_by_id('tasks', parent, db, ['state', 'continuations'])
-			assert parent_task['state'] == 'inactive'
+			if parent_task['state'] != 'inactive':
+				continue
 
 			cur = parent_task['continuations']
 			new = list(set(update['values']) - set(cur))
+			if len(new) == 0:
+				continue
 
-			if len(new) != 0:
-				update_by_id('tasks', parent, db,
-					{'$push': {'continuations': {'$each': new}}})
-				acquire(new, db)
+			acquire(new, db, parent)
+			acquired = [task[config.ID_FIELD] for task in db.tasks.find(
+				{config.ID_FIELD: {'$in': new}, 'parents': parent},
+				projection={config.ID_FIELD: True})]
+			if len(acquired) == 0:
+				continue
+
+			res = db.tasks.update_one({config.ID_FIELD: parent, 'state': 'inactive'},
+				{'$push': {'continuations': {'$each': acquired}}})
+
+			if res.modified_count == 1:
+				changed.append(parent)
+			else:
+				release_keep_inactive(acquired, db, parent)
+
+	critical_path.update(changed, db)
 
 def make_removals(updates, db):
 	"""
@@ -243,17 +407,29 @@ def make_removals(updates, db):
 	child is **not** put in the 'available' state automatically. This would complicate the
 	design, because we would need to protect against the child task being made available
 	inadvertently by the user.
+
+	The edges are removed from the parent only if it is still inactive, and the continuations
+	are released only if they were removed by this update, since a concurrent cancellation may
+	have removed them already.
 	"""
 
+	changed = []
+
 	for update in updates:
 		for parent in update['targets']:
-			parent_task = find_by_id('tasks', parent, db, ['state', 'continuations'])
-			assert parent_task['state'] == 'inactive'
+			parent_task = db.tasks.find_one_and_update(
+				{config.ID_FIELD: parent, 'state': 'inactive'},
+				{'$pull': {'continuations': {'$in': update['values']}}},
+				projection={'continuations': True}
+			)
 
-			cur = parent_task['continuations']
-			rm = list(set(update['values']) & set(cur))
+			if parent_task is None:
+				continue
+
+			rm = list(set(update['values']) & set(parent_task['continuations']))
 
 			if len(rm) != 0:
-				update_by_id('tasks', parent, db,
-					{'$pull': {'continuations': {'$in': rm}}})
-				release_keep_inactive(rm, db)
+				release_keep_inactive(rm, db, parent)
+				changed.append(parent)
+
+	critical_path.update(changed, db)
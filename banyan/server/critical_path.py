@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.critical_path
+---------------------------
+
+Maintains the length of the critical path that starts at each task, so that the tasks on the
+longest remaining chains of the dependency graph can be offered to workers first.
+
+The critical path length of a task is its own ``estimated_runtime_milliseconds`` (zero if it is not
+given, e.g. for tasks without commands), plus the largest critical path length among its
+continuations. Since it only depends on the descendants of the task, it only needs to be recomputed
+for a task and its ancestors when its runtime estimate or its continuations change. This is done one
+level of the graph at a time, following the ``parents`` field, and stopping at the tasks whose
+lengths do not change.
+
+Offering tasks strictly in order of critical path length would make all workers race for the same
+few tasks (see ``offered_tasks`` in ``claims.py``). Tasks are therefore grouped by
+``critical_path_level``, which is the number of bits in the critical path length, so that the tasks
+whose lengths are within a factor of two of each other are offered in order of ``offer_key``.
+
+The lengths are scheduling hints: they are recomputed from the current lengths of the
+continuations each time they are updated, so a length that is briefly out of date due to concurrent
+updates does not affect correctness.
+"""
+
+from collections import deque
+
+from flask import current_app as app
+from pymongo import UpdateOne
+from eve.utils import config
+
+length_field  = 'critical_path_milliseconds'
+level_field   = 'critical_path_level'
+runtime_field = 'estimated_runtime_milliseconds'
+
+def path_fields(length):
+	return {length_field: length, level_field: length.bit_length()}
+
+def path_length(task, lengths):
+	"""
+	Returns the critical path length of ``task``, where ``lengths`` maps the ids of its
+	continuations to their critical path lengths.
+	"""
+
+	return task.get(runtime_field, 0) + max((lengths.get(c, 0) for c in
+		task.get('continuations', [])), default=0)
+
+def lengths_of(ids, db):
+	if len(ids) == 0:
+		return {}
+
+	return {task[config.ID_FIELD]: task.get(length_field, 0) for task in
+		db.tasks.find({config.ID_FIELD: {'$in': list(ids)}}, projection={length_field: True})}
+
+def assign_critical_paths(items):
+	"""
+	Sets the critical path lengths of new tasks. New tasks have no parents, so no other task needs
+	to be updated.
+	"""
+
+	children = set(c for item in items for c in item.get('continuations', []))
+	lengths  = lengths_of(children, app.data.driver.db)
+
+	for item in items:
+		item.update(path_fields(path_length(item, lengths)))
+
+def update(task_ids, db):
+	"""
+	Recomputes the critical path lengths of the tasks in ``task_ids``, whose runtime estimates or
+	continuations have changed, and of their ancestors. Each level uses one query for the tasks,
+	one for their continuations, and one bulk write.
+	"""
+
+	frontier = list(set(task_ids))
+
+	while len(frontier) != 0:
+		tasks = list(db.tasks.find({config.ID_FIELD: {'$in': frontier}}, projection={
+			'continuations': True, 'parents': True, runtime_field: True, length_field: True
+		}))
+
+		lengths = lengths_of(set(c for task in tasks for c in task['continuations']), db)
+		changed = set()
+		ops     = []
+
+		for task in tasks:
+			length = path_length(task, lengths)
+			if length == task.get(length_field):
+				continue
+
+			ops.append(UpdateOne({config.ID_FIELD: task[config.ID_FIELD]},
+				{'$set': path_fields(length)}))
+			changed.update(task.get('parents', []))
+
+		if len(ops) != 0:
+			db.tasks.bulk_write(ops, ordered=False)
+
+		frontier = list(changed)
+
+def rebuild(db):
+	"""
+	Recomputes the critical path lengths of all tasks. This only needs to be run once, on
+	databases created before the ``critical_path_milliseconds`` field was introduced. It assumes
+	that the dependency graph is acyclic.
+	"""
+
+	tasks = {task[config.ID_FIELD]: task for task in db.tasks.find({},
+		projection={'continuations': True, runtime_field: True})}
+
+	# Kahn's algorithm on the reversed graph, so that each task is processed after all of its
+	# continuations.
+	out_degree = {id_: len(task['continuations']) for id_, task in tasks.items()}
+	parents    = {}
+
+	for id_, task in tasks.items():
+		for child in task['continuations']:
+			parents.setdefault(child, []).append(id_)
+
+	queue   = deque(id_ for id_, n in out_degree.items() if n == 0)
+	lengths = {}
+	ops     = []
+
+	while len(queue) != 0:
+		id_ = queue.popleft()
+		lengths[id_] = path_length(tasks[id_], lengths)
+		ops.append(UpdateOne({config.ID_FIELD: id_}, {'$set': path_fields(lengths[id_])}))
+
+		for parent in parents.get(id_, []):
+			out_degree[parent] -= 1
+			if out_degree[parent] == 0:
+				queue.append(parent)
+
+	assert len(ops) == len(tasks), "Dependency graph contains a cycle."
+
+	if len(ops) != 0:
+		db.tasks.bulk_write(ops, ordered=False)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.dispatch
+----------------------
+
+Pushes a ``tasks_available_notice`` to the registered workers when tasks become available because
+their dependencies have terminated, so that the workers can claim them immediately rather than at
+their next poll of the task queue. Without this, each level of a dependency chain would wait for up
+to ``task_cache_update_period_ms`` before being claimed.
+
+A worker is only notified if at least one of the new tasks fits in the ``resources`` that it gave
+when it was registered; workers that did not give their resources are notified of all tasks. The
+notices are sent through ``WorkerNotifier``. Each server process connects to a worker the first
+time that it has a notice for it, using the address in ``registered_workers``, so this also works
+when the server runs as several processes.
+
+The request thread only looks up the registered workers, which are usually cached (see
+``auth_cache``), and hands them to the event loop of the notifier along with the requested resources
+of the tasks. The tasks are matched against the workers on the loop, so the cost of matching is not
+added to requests that may be holding task locks.
+
+Notices are only hints: a worker that cannot be reached is skipped for ``notice_retry_seconds``
+(see ``WorkerNotifier``), and will find the tasks at its next poll.
+"""
+
+from banyan.notification_protocol import tasks_available_notice, format_message
+from banyan.server.authentication import auth_cache
+from banyan.server.claims import task_fits
+
+class TaskDispatcher:
+	def __init__(self):
+		self.notifier = None
+
+	def start(self, notifier):
+		"""
+		Enables the notices. Until this is called, ``tasks_available`` does nothing.
+		"""
+
+		self.notifier = notifier
+
+	def _connect(self, worker):
+		"""
+		Messages sent before the connection is established are queued by the notifier, so
+		we can notify the worker right away.
+		"""
+
+		id_ = worker['worker_id']
+		if not self.notifier.is_registered(id_):
+			self.notifier.register(id_, (worker['address']['ip'], worker['address']['port']))
+
+	def tasks_available(self, tasks, db):
+		"""
+		Notifies the workers in whose resources at least one of ``tasks`` fits. Each task must
+		include its ``requested_resources``. The notices are sent asynchronously.
+		"""
+
+		if self.notifier is None or len(tasks) == 0:
+			return
+
+		workers  = auth_cache.registered_workers(db)
+		requests = [task.get('requested_resources', {}) for task in tasks]
+		self.notifier.event_loop.call(self._dispatch, requests, workers)
+
+	def _dispatch(self, requests, workers):
+		"""
+		Runs on the event loop of the notifier.
+		"""
+
+		worker_ids = set(w['worker_id'] for w in workers)
+
+		for id_ in self.notifier.registered_ids - worker_ids:
+			self.notifier.unregister(id_)
+
+		for worker in workers:
+			if 'claim' not in worker.get('permissions', []) or worker['request_token'] is None:
+				continue
+
+			resources = worker.get('resources')
+			if resources is None:
+				count = len(requests)
+			else:
+				count = sum(1 for req in requests if task_fits(req, resources))
+
+			if count != 0:
+				self._connect(worker)
+				self.notifier.notify(worker['worker_id'], format_message(
+					tasks_available_notice, worker['request_token'], count))
+
+dispatcher = TaskDispatcher()
@@ -8,18 +8,26 @@ Provides the event hooks that implement the server-side functionality.
 """
 
 import json
+from datetime import datetime
 from bson import ObjectId
 from werkzeug.exceptions import HTTPException
-from flask import g, current_app as app
+from flask import abort, g, current_app as app
 from eve.utils import config
 
 from banyan.common import make_token
-from banyan.server.locks import task_lock, registered_workers_lock
+from banyan.server.authentication import auth_cache
+from banyan.server.locks import task_locks, registered_workers_lock, registered_workers_key, \
+	topological_order_key
 from banyan.server.state import legal_provider_transitions
 from banyan.server.schema import virtual_resources
 from banyan.server.mongo_common import find_by_id, update_by_id
 from banyan.server.execution_data import is_exit_success
+from banyan.server.claims import make_offer_key
 import banyan.server.continuations as continuations
+import banyan.server.topological_order as topological_order
+import banyan.server.fair_share as fair_share
+import banyan.server.critical_path as critical_path
+import banyan.server.leases as leases
 
 item_level_virtual_resources = set()
 for parent_res, virtuals in virtual_resources.items():
@@ -27,36 +35,109 @@ for parent_res, virtuals in virtual_resources.items():
 		if 'item' in schema['granularity']:
 			item_level_virtual_resources.add(virtual_res)
 
-def acquire_lock(lock):
-	def impl(request, lookup=None):
-		lock.acquire()
-		g.lock_owner = True
+def acquire_registered_workers_lock(request, lookup=None):
+	g.registered_workers_guard = registered_workers_lock.acquire([registered_workers_key])
 
-	return impl
+def release_registered_workers_lock(request=None, payload=None):
+	guard = getattr(g, 'registered_workers_guard', None)
 
-def release_lock(lock):
-	def impl(request, payload):
-		"""
-		If an error occurred in the validator, then the lock will not have been acquired.
-		"""
-		if lock.locked():
-			lock.release()
+	if guard is not None:
+		guard.release()
+		g.registered_workers_guard = None
 
-	return impl
+def invalidate_credentials(*args):
+	"""
+	Called after a worker is registered or unregistered, since this changes the permissions
+	associated with the worker's token.
+	"""
+
+	auth_cache.invalidate(app.data.driver.db)
+
+def acquire_task_locks(keys):
+	g.task_lock_guard = task_locks.acquire(keys)
+
+def release_task_locks(request=None, payload=None):
+	guard = getattr(g, 'task_lock_guard', None)
+
+	if guard is not None:
+		guard.release()
+		g.task_lock_guard = None
+
+def acquire_task_locks_for_creation(request, lookup=None):
+	"""
+	Acquires the locks for the continuations of the tasks being created, since their dependency
+	counts will be modified. We also lock the names of the tasks, so that two tasks with the same
+	name cannot pass the uniqueness check concurrently.
+	"""
+
+	docs = request.json
+	if isinstance(docs, dict):
+		docs = [docs]
+	if not isinstance(docs, list):
+		return
+
+	keys = []
+	for doc in docs:
+		if not isinstance(doc, dict):
+			continue
+
+		if isinstance(doc.get('continuations'), list):
+			keys.extend(doc['continuations'])
+		if 'name' in doc:
+			keys.append('name:' + str(doc['name']))
+
+	acquire_task_locks(keys)
 
-def acquire_task_lock_if_necessary(request, lookup):
-	if not request.json:
+def acquire_task_locks_if_necessary(request, lookup):
+	"""
+	Acquires the locks for the task being updated, along with all of the tasks whose state or
+	dependency counts could be changed as a result of the update: the continuations being added
+	or removed, and, in the case of a state change, the current continuations of the task.
+	"""
+
+	updates = request.json
+	if not updates or config.ID_FIELD not in lookup:
 		return
 
 	synchronized_fields = ['state', 'add_continuations', 'remove_continuations']
+	if not any(field in updates for field in synchronized_fields):
+		return
+
+	id_  = lookup[config.ID_FIELD]
+	keys = [id_]
+
+	for field in ['add_continuations', 'remove_continuations']:
+		if isinstance(updates.get(field), list):
+			keys.extend(updates[field])
+
+	if 'add_continuations' in updates:
+		keys.append(topological_order_key)
+
+	if 'state' not in updates:
+		acquire_task_locks(keys)
+		return
+
+	"""
+	The list of continuations may change between the time that we read it and the time that we
+	acquire the locks. Once we hold the lock for the task itself, the list can no longer change,
+	so we retry until the list that we locked is up to date.
+	"""
+	db = app.data.driver.db
+	locked = None
+
+	while True:
+		task = db.tasks.find_one({config.ID_FIELD: ObjectId(id_)}, {'continuations': True})
+		if task is None:
+			# The error will be reported by Eve.
+			return
 
-	for field in synchronized_fields:
-		if field in request.json:
-			task_lock.acquire()
-			g.lock_owner = True
+		conts = set(str(c) for c in task['continuations'])
+		if locked is not None and conts <= locked:
 			return
 
-	g.lock_owner = False
+		release_task_locks()
+		acquire_task_locks(keys + list(conts))
+		locked = conts
 
 def modify_state_changes(request, lookup):
 	"""
@@ -108,20 +189,56 @@ def terminate_empty_tasks(items, original=None):
 		if 'command' not in item and item['state'] == 'available':
 			item['state'] = 'terminated'
 
+def assign_topological_order(items):
+	db = app.data.driver.db
+	positions = topological_order.allocate(len(items), db)
+
+	for item, pos in zip(items, positions):
+		item[topological_order.order_field] = pos
+
+def assign_offer_keys(items):
+	for item in items:
+		item['offer_key'] = make_offer_key()
+
+def apply_claimable_state_change(updates, original):
+	"""
+	Tasks in the ``available`` state can be claimed through the ``claim`` virtual resource,
+	which does not acquire the task lock. This means that the state of the task may have changed
+	after it was validated, but before Eve writes the update. To guard against this, we make the
+	state change using a conditional update, and fail the request if the task is no longer
+	``available``.
+	"""
+
+	if 'state' not in updates or original['state'] != 'available':
+		return
+
+	db = app.data.driver.db
+	res = db.tasks.update_one({config.ID_FIELD: original[config.ID_FIELD], 'state': 'available'},
+		{'$set': {'state': updates['state']}})
+
+	if res.matched_count == 0:
+		abort(409, description="Task is no longer in the 'available' state.")
+
 def acquire_continuations(items):
 	db = app.data.driver.db
+	ready = []
 
 	for item in items:
+		if len(item['continuations']) == 0:
+			continue
+
 		if item['state'] == 'terminated':
 			assert 'command' not in item, "This branch should be entered iff " \
 				"the user creates a task with no command directly in the " \
 				"'available' state."
 
-			for cont_id in item['continuations']:
-				continuations.try_make_available(cont_id, db)
+			continuations.add_parent(item['continuations'], db, item[config.ID_FIELD])
+			ready.extend(item['continuations'])
 		else:
-			for cont_id in item['continuations']:
-				continuations.acquire(cont_id, db)
+			continuations.acquire(item['continuations'], db, item[config.ID_FIELD])
+
+	if len(ready) != 0:
+		continuations.try_make_available(ready, db)
 
 def filter_virtual_resources(updates, original):
 	"""
@@ -164,16 +281,14 @@ def process_continuations(updates, original):
 	cont_list = original['continuations']
 
 	if updates['state'] == 'cancelled':
-		for x in cont_list:
-			continuations.cancel(x, db)
+		continuations.cancel(cont_list, db)
 	elif updates['state'] == 'terminated':
 		if 'execution_data_id' in original:
 			execution_data = g.virtual_resource_updates['update_execution_data']
 			exit_status    = execution_data['exit_status']
 
 			if is_exit_success(exit_status):
-				for x in cont_list:
-					continuations.release(x, db)
+				continuations.release(cont_list, db)
 				return
 
 			attempt_count     = original['attempt_count']
@@ -183,8 +298,7 @@ def process_continuations(updates, original):
 			if attempt_count < max_attempt_count:
 				return
 			else:
-				for x in cont_list:
-					continuations.cancel(x, db, assert_inactive=True)
+				continuations.cancel(cont_list, db, assert_inactive=True)
 		else:
 			"""
 			If this branch is taken, then it means that the terminated task had no
@@ -192,8 +306,16 @@ def process_continuations(updates, original):
 			continuations). In this case, termination is always considered successful,
 			and we release all of the continuations.
 			"""
-			for x in cont_list:
-				continuations.release(x, db)
+			continuations.release(cont_list, db)
+
+def update_critical_path(updates, original):
+	"""
+	Changing the runtime estimate of a task changes the critical path lengths of the task and its
+	ancestors. Changes to the continuations are handled by ``process_continuations``.
+	"""
+
+	if critical_path.runtime_field in updates:
+		critical_path.update([original[config.ID_FIELD]], app.data.driver.db)
 
 def update_execution_data(updates, original):
 	"""
@@ -211,6 +333,10 @@ def update_execution_data(updates, original):
 	- A new instance of execution data is inserted into `execution_info`.
 
 	Otherwise, the changes given in `update_execution_data` are applied independently.
+
+	When a task is set to 'running', the `time_started` of the execution data is set to the
+	current time if the client did not provide it, so that the attempt is counted towards the
+	fair-share usage of the owner (see `fair_share.py`).
 	"""
 
 	db = app.data.driver.db
@@ -230,12 +356,23 @@ def update_execution_data(updates, original):
 					'token': make_token()
 				}
 
+				if 'owner' in original:
+					new_data['owner'] = original['owner']
+
 				new_data.update(data_updates)
+				new_data.setdefault('time_started', datetime.utcnow())
 				data_id = db.execution_info.insert(new_data)
 
 				update_by_id('tasks', id_, db, {
 					'$set': {'attempt_count': 1, 'execution_data_id': data_id}
 				})
+			else:
+				db.execution_info.update_one({
+					config.ID_FIELD: original['execution_data_id'],
+					'time_started': {'$exists': False}
+				}, {
+					'$set': {'time_started': datetime.utcnow()}
+				})
 			return
 
 		if updates['state'] == 'terminated' and attempt_count < max_attempt_count:
@@ -250,6 +387,9 @@ def update_execution_data(updates, original):
 					'token': make_token()
 				}
 
+				if 'owner' in original:
+					new_data['owner'] = original['owner']
+
 				data_id = db.execution_info.insert(new_data)
 				update_by_id('tasks', id_, db, {
 					'$inc': {'attempt_count': 1},
@@ -275,31 +415,43 @@ def append_execution_data_token(request, payload):
 	payload.set_data(json.dumps(parsed_payload))
 
 def register(app):
-	app.on_pre_POST_tasks  += acquire_lock(task_lock)
-	app.on_post_POST_tasks += release_lock(task_lock)
+	app.on_pre_POST_tasks  += acquire_task_locks_for_creation
+	app.on_post_POST_tasks += release_task_locks
 
 	"""
 	We also need to synchronize registration/unregistration of workers, since this could
 	potentially trigger races with authentication or validation when checking worker
 	permissions.
 	"""
-	app.on_pre_POST_registered_workers    += acquire_lock(registered_workers_lock)
-	app.on_post_POST_registered_workers   += release_lock(registered_workers_lock)
-	app.on_pre_DELETE_registered_workers  += acquire_lock(registered_workers_lock)
-	app.on_post_DELETE_registered_workers += release_lock(registered_workers_lock)
+	app.on_pre_POST_registered_workers    += acquire_registered_workers_lock
+	app.on_post_POST_registered_workers   += release_registered_workers_lock
+	app.on_pre_DELETE_registered_workers  += acquire_registered_workers_lock
+	app.on_post_DELETE_registered_workers += release_registered_workers_lock
+
+	app.on_inserted_registered_workers     += invalidate_credentials
+	app.on_deleted_item_registered_workers += invalidate_credentials
 
-	app.on_pre_PATCH_tasks  += acquire_task_lock_if_necessary
+	app.on_pre_PATCH_tasks  += acquire_task_locks_if_necessary
 	app.on_pre_PATCH_tasks  += modify_state_changes
 	app.on_post_PATCH_tasks += append_execution_data_token
-	app.on_post_PATCH_tasks += release_lock(task_lock)
+	app.on_post_PATCH_tasks += release_task_locks
 
 	app.on_insert_tasks   += terminate_empty_tasks
+	app.on_insert_tasks   += assign_topological_order
+	app.on_insert_tasks   += assign_offer_keys
+	app.on_insert_tasks   += fair_share.assign_priorities
+	app.on_insert_tasks   += critical_path.assign_critical_paths
 	app.on_inserted_tasks += acquire_continuations
 
 	app.on_update_tasks  += terminate_empty_tasks
+	app.on_update_tasks  += fair_share.update_effective_priority
+	app.on_update_tasks  += apply_claimable_state_change
+	app.on_update_tasks  += leases.assign_lease
 	app.on_update_tasks  += filter_virtual_resources
 	app.on_updated_tasks += process_continuations
+	app.on_updated_tasks += update_critical_path
 	app.on_updated_tasks += update_execution_data
+	app.on_updated_tasks += leases.release_lease
 
 	"""
 	When this flag is false (the default value), exceptions which are instances of
@@ -313,8 +465,8 @@ def register(app):
 
 	@app.errorhandler(Exception)
 	def handle_error(error):
-		release_lock(task_lock)(None, None)
-		release_lock(registered_workers_lock)(None, None)
+		release_task_locks()
+		release_registered_workers_lock()
 
 		if isinstance(error, HTTPException):
 			return error
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.event_loop
+------------------------
+
+Runs the ``asyncio`` event loop shared by ``WorkerNotifier`` and ``WorkerAvailabilityChecker`` in a
+background thread of the server process. The connections to the workers and the timers for the
+health checks are all managed by this loop, so their number is not limited by the number of threads.
+
+Request threads interact with the loop only through ``call``, which is safe to use from any thread.
+Blocking work, such as database queries, is moved off the loop using ``run_blocking``. If the loop
+is given the application, then this work runs in its application context, so that it can use the
+locks in ``locks.py``.
+"""
+
+import asyncio
+import sys
+
+from threading import Thread
+
+class EventLoopThread:
+	def __init__(self, app=None):
+		self.app  = app
+		self.loop = asyncio.new_event_loop()
+		self.loop.set_exception_handler(self._handle_exception)
+		Thread(target=self._run, daemon=True).start()
+
+	def _run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+
+	def _handle_exception(self, loop, context):
+		print("Error in event loop: {}".format(context.get('exception',
+			context['message'])), file=sys.stderr, flush=True)
+
+	def call(self, fn, *args):
+		"""
+		Schedules ``fn(*args)`` to run on the loop. Can be called from any thread.
+		"""
+
+		self.loop.call_soon_threadsafe(fn, *args)
+
+	def call_later(self, delay, fn, *args):
+		"""
+		Schedules ``fn(*args)`` to run on the loop after ``delay`` seconds. Must be called from
+		the loop thread.
+		"""
+
+		return self.loop.call_later(delay, fn, *args)
+
+	def spawn(self, coro):
+		"""
+		Runs the coroutine ``coro`` as a task on the loop. Must be called from the loop thread.
+		"""
+
+		return self.loop.create_task(coro)
+
+	def run_blocking(self, fn, *args):
+		"""
+		Returns a future for the result of ``fn(*args)``, which is run in the default executor
+		of the loop. Must be called from the loop thread.
+		"""
+
+		if self.app is not None:
+			return self.loop.run_in_executor(None, self._run_in_context, fn, *args)
+		return self.loop.run_in_executor(None, fn, *args)
+
+	def _run_in_context(self, fn, *args):
+		with self.app.app_context():
+			return fn(*args)
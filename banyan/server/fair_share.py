@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.fair_share
+------------------------
+
+Implements priorities and fair-share scheduling between providers.
+
+Each task has a ``priority`` chosen by the provider that created it (its ``owner``), and each
+provider has a ``fair_share_level`` computed from its recent usage. Providers that have used less
+than their share of the workers over the last ``fair_share_window_seconds`` get higher levels. The
+two are combined into the ``effective_priority`` of the task: ::
+
+	effective_priority = priority * fair_share_levels + fair_share_level
+
+so the priority chosen by the provider always takes precedence, and the fair-share level orders
+tasks with the same priority. Tasks are offered to workers in order of decreasing effective
+priority (see ``offered_tasks`` in ``claims.py``), using an index on this field, so a large sweep
+submitted by one provider cannot starve the tasks of another.
+
+The fair-share level of the owner is stored in each task, so that when the level changes, the
+effective priorities of the owner's pending tasks can be updated using one ``$inc`` per distinct
+old level.
+"""
+
+import time
+
+from datetime import datetime, timedelta
+from threading import Thread
+
+from flask import g, current_app as app
+from pymongo.errors import PyMongoError
+from eve.utils import config
+
+from banyan.server.constants import fair_share_levels, fair_share_window_seconds, \
+	fair_share_update_seconds
+
+"""
+States of the tasks whose effective priorities are kept up to date. Tasks in the other states have
+already been claimed.
+"""
+pending_states = ['inactive', 'available']
+
+def effective_priority(priority, level):
+	return priority * fair_share_levels + level
+
+def current_level(owner, db):
+	user = db.users.find_one({config.ID_FIELD: owner}, projection={'fair_share_level': True})
+
+	# Providers that have not been seen by ``update_levels`` yet have not used any resources.
+	return (user or {}).get('fair_share_level', fair_share_levels - 1)
+
+def priority_fields(priority, owner, level):
+	"""
+	Returns the fields managed by the server that should be set for a new task with the given
+	priority and owner, where ``level`` is the current fair-share level of the owner.
+	"""
+
+	return {
+		'owner': owner,
+		'fair_share_level': level,
+		'effective_priority': effective_priority(priority, level)
+	}
+
+def assign_priorities(items):
+	"""
+	Sets the priority fields of new tasks. The owner of the tasks is the provider that created
+	them.
+	"""
+
+	owner = g.user[config.ID_FIELD]
+	level = current_level(owner, app.data.driver.db)
+
+	for item in items:
+		item.update(priority_fields(item['priority'], owner, level))
+
+def update_effective_priority(updates, original):
+	if 'priority' in updates and 'fair_share_level' in original:
+		updates['effective_priority'] = effective_priority(updates['priority'],
+			original['fair_share_level'])
+
+def usage_by_owner(db, since, now):
+	"""
+	Returns a dict mapping the id of each provider to the number of milliseconds of execution
+	time used by its tasks since ``since``. Tasks that are still running are counted up to
+	``now``.
+	"""
+
+	pipeline = [
+		{'$match': {
+			'owner': {'$exists': True},
+			'time_started': {'$exists': True},
+			'$or': [
+				{'time_terminated': {'$exists': False}},
+				{'time_terminated': {'$gte': since}}
+			]
+		}},
+		{'$project': {
+			'owner': True,
+			'usage': {'$subtract': [
+				{'$ifNull': ['$time_terminated', now]},
+				{'$max': ['$time_started', since]}
+			]}
+		}},
+		{'$group': {config.ID_FIELD: '$owner', 'usage': {'$sum': '$usage'}}}
+	]
+
+	return {res[config.ID_FIELD]: res['usage'] for res in db.execution_info.aggregate(pipeline)}
+
+def update_levels(db):
+	"""
+	Recomputes the fair-share level of each provider, and updates the effective priorities of the
+	pending tasks of the providers whose levels have changed.
+
+	The load of a provider is its usage divided by its ``share``. The provider with the highest
+	load gets level zero, idle providers get the highest level, and the other providers are
+	spread linearly in between.
+	"""
+
+	now   = datetime.utcnow()
+	usage = usage_by_owner(db, now - timedelta(seconds=fair_share_window_seconds), now)
+
+	providers = list(db.users.find({'role': 'provider'},
+		projection={'share': True, 'fair_share_level': True}))
+	loads = {p[config.ID_FIELD]: usage.get(p[config.ID_FIELD], 0) / p.get('share', 1)
+		for p in providers}
+	max_load = max(loads.values(), default=0)
+
+	for p in providers:
+		id_ = p[config.ID_FIELD]
+		top = fair_share_levels - 1
+
+		if max_load == 0:
+			level = top
+		else:
+			level = top - int(top * loads[id_] / max_load)
+
+		if p.get('fair_share_level') != level:
+			db.users.update_one({config.ID_FIELD: id_}, {'$set': {'fair_share_level': level}})
+
+		query = {'owner': id_, 'state': {'$in': pending_states}}
+		stale = db.tasks.distinct('fair_share_level',
+			dict(query, fair_share_level={'$ne': level}))
+
+		for old in stale:
+			db.tasks.update_many(dict(query, fair_share_level=old), {
+				'$inc': {'effective_priority': level - old},
+				'$set': {'fair_share_level': level}
+			})
+
+class FairShareUpdater:
+	"""
+	Periodically calls ``update_levels``. When the server runs as several processes, each process
+	runs its own updater; this is harmless, since the updates only depend on the state of the
+	database.
+	"""
+
+	def __init__(self, db):
+		self.db = db
+		Thread(target=self._update_levels, daemon=True).start()
+
+	def _update_levels(self):
+		while True:
+			try:
+				update_levels(self.db)
+			except PyMongoError:
+				# We try again during the next period.
+				pass
+
+			time.sleep(fair_share_update_seconds)
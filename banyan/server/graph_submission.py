@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.graph_submission
+------------------------------
+
+Implements the ``submit_graph`` virtual action, which creates a set of tasks along with the
+dependencies between them using a single request.
+
+Creating the same tasks through the ``tasks`` endpoint requires one POST per task, and one update
+per continuation to maintain ``pending_dependency_count``. Here, the tasks refer to each other using
+temporary ids chosen by the client. The whole graph is validated at once, the dependency counts,
+states, and positions in the topological order are computed in memory, and the tasks are written
+using a single ``insert_many``.
+
+Since the tasks in the graph can only refer to each other, no existing task is modified. However, we
+still lock the names of the tasks in the same way as ``acquire_task_locks_for_creation`` in
+``event_hooks.py``, so that a task with the same name cannot be created concurrently through either
+endpoint after the uniqueness check.
+"""
+
+from collections import Counter, deque
+from datetime import datetime
+
+from bson import ObjectId
+from flask import g, current_app as app
+from eve.defaults import resolve_default_values
+from eve.methods.common import resolve_document_etag
+from eve.utils import config
+
+import banyan.server.topological_order as topological_order
+import banyan.server.fair_share as fair_share
+import banyan.server.critical_path as critical_path
+from banyan.server.claims import make_offer_key
+from banyan.server.constants import max_item_list_length
+from banyan.server.validation import RequestValidator
+
+def topological_sort(task_count, edges):
+	"""
+	Returns the indices of the tasks in topological order, or ``None`` if the graph has a cycle.
+	``edges`` is a list of ``(parent, child)`` pairs of task indices.
+	"""
+
+	children  = [[] for _ in range(task_count)]
+	in_degree = [0] * task_count
+
+	for parent, child in edges:
+		children[parent].append(child)
+		in_degree[child] += 1
+
+	queue = deque(i for i in range(task_count) if in_degree[i] == 0)
+	order = []
+
+	while len(queue) != 0:
+		i = queue.popleft()
+		order.append(i)
+
+		for child in children[i]:
+			in_degree[child] -= 1
+			if in_degree[child] == 0:
+				queue.append(child)
+
+	if len(order) != task_count:
+		return None
+	return order
+
+def edge_indices(request):
+	"""
+	Returns the edges of the submitted graph as ``(parent, child)`` pairs of task indices.
+	"""
+
+	index = {task['id']: i for i, task in enumerate(request['tasks'])}
+	return [(index[e['parent']], index[e['child']]) for e in request.get('edges', [])]
+
+def graph_lock_keys(request):
+	"""
+	Returns the keys for the names of the tasks in the submitted graph. This function is called
+	before validation, so malformed requests are ignored here and reported by the validator
+	later.
+	"""
+
+	keys = []
+	if not isinstance(request, dict) or not isinstance(request.get('tasks'), list):
+		return keys
+
+	for task in request['tasks']:
+		if isinstance(task, dict) and 'name' in task:
+			keys.append('name:' + str(task['name']))
+
+	return keys
+
+class SubmitGraphValidator(RequestValidator):
+	def __init__(self, schema, resource=None, allow_unknown=False,
+		transparent_schema_rules=False):
+
+		super().__init__(schema, resource)
+
+	def validate_request(self, document):
+		document = super().validate_request(document)
+		if document is None:
+			return None
+
+		tasks = document['tasks']
+		edges = document.get('edges', [])
+		ids   = set()
+
+		for task in tasks:
+			if task['id'] in ids:
+				self._error('tasks', "Duplicate task id '{}'.".format(task['id']))
+			ids.add(task['id'])
+
+		for i, edge in enumerate(edges):
+			for field in ['parent', 'child']:
+				if edge[field] not in ids:
+					self._error('edge {}'.format(i), "Unknown task id '{}'.".
+						format(edge[field]))
+
+			if edge['parent'] == edge['child']:
+				self._error('edge {}'.format(i), "Task cannot have itself as a "
+					"continuation.")
+
+		if len(set((e['parent'], e['child']) for e in edges)) != len(edges):
+			self._error('edges', "Field contains duplicates.")
+
+		"""
+		The tasks created through the ``tasks`` endpoint have at most ``max_item_list_length``
+		continuations, and the rest of the server relies on this (e.g. to bound the sizes of
+		updates and ``$in`` queries), so the same limit applies to the continuations and the
+		parents of each task in the graph.
+		"""
+		for field, degrees in [('continuations', Counter(e['parent'] for e in edges)),
+			('parents', Counter(e['child'] for e in edges))]:
+			for id_, count in degrees.items():
+				if count > max_item_list_length:
+					self._error('edges', "Task '{}' has {} {}, but at most {} are "
+						"allowed.".format(id_, count, field, max_item_list_length))
+
+		if len(self._errors) != 0:
+			return None
+
+		"""
+		The uniqueness of task names is checked here rather than by the schema, so that we
+		only need one query for the whole graph.
+		"""
+		names = [task['name'] for task in tasks if 'name' in task]
+
+		if len(set(names)) != len(names):
+			self._error('tasks', "Task names must be unique.")
+			return None
+
+		existing = self.db.tasks.find({'name': {'$in': names}}, projection={'name': True})
+		for task in existing:
+			self._error('tasks', "Task with name '{}' already exists.".format(task['name']))
+
+		children = set(e['child'] for e in edges)
+		for task in tasks:
+			if task.get('state') == 'available' and task['id'] in children:
+				self._error('tasks', "Task '{}' has parents, so it can only be created "
+					"in the 'inactive' state.".format(task['id']))
+
+		if len(self._errors) != 0:
+			return None
+
+		if topological_sort(len(tasks), edge_indices(document)) is None:
+			self._error('edges', "The graph contains a cyclic dependency.")
+			return None
+
+		return document
+
+def make_graph(request, db):
+	"""
+	Called after validation in order to create the tasks in the submitted graph. The response
+	maps the temporary id of each task to the id of the task that was created.
+
+	The tasks are processed in topological order, so that the state of each task is known by the
+	time that its continuations are processed. As in ``acquire_continuations``, a task with no
+	command created in the ``available`` state is terminated immediately, and its continuations
+	are released. The critical path lengths are computed in the reverse order.
+	"""
+
+	tasks    = request['tasks']
+	edges    = edge_indices(request)
+	order    = topological_sort(len(tasks), edges)
+	children = [[] for _ in tasks]
+	parents  = [[] for _ in tasks]
+
+	for parent, child in edges:
+		children[parent].append(child)
+		parents[child].append(parent)
+
+	local_ids = [task.pop('id') for task in tasks]
+	ids       = [ObjectId() for _ in tasks]
+	positions = topological_order.allocate(len(tasks), db)
+	defaults  = app.config['DOMAIN']['tasks']['defaults']
+	now       = datetime.utcnow().replace(microsecond=0)
+	owner     = g.user[config.ID_FIELD]
+	level     = fair_share.current_level(owner, db)
+	lengths   = [0] * len(tasks)
+
+	for i in reversed(order):
+		lengths[i] = tasks[i].get(critical_path.runtime_field, 0) + \
+			max((lengths[c] for c in children[i]), default=0)
+
+	for pos, i in zip(positions, order):
+		task = tasks[i]
+		resolve_default_values(task, defaults)
+
+		pending = sum(1 for p in parents[i] if tasks[p]['state'] != 'terminated')
+		if len(parents[i]) != 0:
+			task['state'] = 'inactive' if pending != 0 else 'available'
+		if task['state'] == 'available' and 'command' not in task:
+			task['state'] = 'terminated'
+
+		task.update({
+			config.ID_FIELD: ids[i],
+			config.DATE_CREATED: now,
+			config.LAST_UPDATED: now,
+			'continuations': [ids[c] for c in children[i]],
+			'parents': [ids[p] for p in parents[i]],
+			'pending_dependency_count': pending,
+			'offer_key': make_offer_key(),
+			topological_order.order_field: pos
+		})
+		task.update(fair_share.priority_fields(task['priority'], owner, level))
+		task.update(critical_path.path_fields(lengths[i]))
+
+	resolve_document_etag(tasks, 'tasks')
+
+	if len(tasks) != 0:
+		db.tasks.insert_many(tasks)
+
+	return {'ids': {local_id: str(id_) for local_id, id_ in zip(local_ids, ids)}}
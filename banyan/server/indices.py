@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.indices
+---------------------
+
+Declares the indexes used by the queries that the server performs frequently, so that they can be
+created when the server starts. ``index_report`` compares the declared indexes against the ones
+that exist in the database, and reports the ones that are missing or have not been used since the
+server last started.
+"""
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+"""
+Maps each collection to the list of indexes that should exist for it. The indexes use the default
+names generated by MongoDB, so that they match the ones created by ``access.py``.
+"""
+declared_indices = {
+	'tasks': [
+		# Used by workers polling for tasks that fit their resources. The first index is
+		# used to offer the tasks in order of effective priority, critical path level, and
+		# ``offer_key`` (see ``offered_tasks`` in ``claims.py``), and the second when the
+		# resource constraints are selective.
+		IndexModel([
+			('state', ASCENDING),
+			('effective_priority', DESCENDING),
+			('critical_path_level', DESCENDING),
+			('offer_key', ASCENDING)
+		]),
+		IndexModel([
+			('state', ASCENDING),
+			('requested_resources.gpu_count', DESCENDING),
+			('requested_resources.cpu_cores.count', DESCENDING),
+			('requested_resources.cpu_memory_bytes', DESCENDING)
+		]),
+
+		# Used by workers refreshing their task caches incrementally (see
+		# ``find_available_tasks`` in ``claims.py``).
+		IndexModel([('state', ASCENDING), ('_updated', ASCENDING)]),
+
+		# Used to traverse the dependency graph in both directions (see ``continuations.py``).
+		IndexModel([('continuations', ASCENDING)]),
+		IndexModel([('parents', ASCENDING)]),
+
+		# Used to update effective priorities (see ``fair_share.py``).
+		IndexModel([('owner', ASCENDING), ('fair_share_level', ASCENDING)]),
+
+		# Used to find the expired leases (see ``leases.py``). Only the tasks that are
+		# leased to a worker have this field.
+		IndexModel([('lease.expires_at', ASCENDING)], sparse=True)
+	],
+
+	'users': [
+		IndexModel([('name', ASCENDING)], unique=True),
+		IndexModel([('request_token', ASCENDING)])
+	],
+
+	'registered_workers': [
+		IndexModel([('worker_id', ASCENDING)])
+	],
+
+	'execution_info': [
+		# Used to find the most recent reports from each worker, and the tasks that it is
+		# running (see ``recovery.py``).
+		IndexModel([
+			('worker_id', ASCENDING),
+			('last_update', DESCENDING)
+		]),
+
+		IndexModel([('task_id', ASCENDING)]),
+
+		# Used to compute the recent usage of each provider (see ``fair_share.py``).
+		IndexModel([('time_terminated', ASCENDING)])
+	]
+}
+
+def ensure_indices(db):
+	"""
+	Creates all of the declared indexes that do not already exist. This is a no-op for the indexes
+	that do.
+	"""
+
+	for coll, indices in declared_indices.items():
+		db[coll].create_indexes(indices)
+
+def index_usage(db, coll):
+	"""
+	Returns a dict mapping the name of each index of ``coll`` to the number of times it has been
+	used since the database server last started, or ``None`` if the statistics are unavailable.
+	"""
+
+	try:
+		stats = db[coll].aggregate([{'$indexStats': {}}])
+		return {s['name']: s['accesses']['ops'] for s in stats}
+	except OperationFailure:
+		return None
+
+def index_report(db):
+	"""
+	Returns a dict mapping each collection to a dict with the following keys:
+	- ``missing``: Names of the declared indexes that do not exist.
+	- ``unused``: Names of the existing indexes that have not been used since the database server
+	  last started. This list is empty if index statistics are unavailable.
+	- ``undeclared``: Names of the existing indexes that are not declared above, other than the
+	  index on the id field.
+	"""
+
+	report = {}
+
+	for coll, indices in declared_indices.items():
+		declared = [index.document['name'] for index in indices]
+		existing = list(db[coll].index_information().keys())
+		usage    = index_usage(db, coll) or {}
+
+		report[coll] = {
+			'missing': [name for name in declared if name not in existing],
+			'unused': [name for name in existing if usage.get(name, 1) == 0],
+			'undeclared': [name for name in existing if name not in declared and
+				name != '_id_']
+		}
+
+	return report
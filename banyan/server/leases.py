@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.leases
+--------------------
+
+Each claimed task is leased to the worker that claimed it. The ``lease`` field of the task records
+the id of the worker and the time at which the lease expires, ``task_lease_seconds`` after it was
+last renewed. Workers renew the leases of all of their running tasks using a single request to
+``tasks/renew_leases``, so the server learns that a worker is alive without having to connect to it.
+
+Leases that have expired are reclaimed by the server (see ``reclaim_expired_leases`` in
+``recovery.py``), in the same way as the tasks of a worker that cannot be reached. The ``lease``
+field is removed once the task leaves the ``running`` and ``pending_cancellation`` states, so the
+sparse index on the expiry times only contains the leases that are held.
+"""
+
+from datetime import datetime, timedelta
+
+from flask import g, abort, current_app as app
+from eve.utils import config
+
+from banyan.server.constants import task_lease_seconds
+from banyan.server.validation import RequestValidator
+
+# States of the tasks that are leased to a worker.
+leased_states = ['running', 'pending_cancellation']
+
+def lease_expiry():
+	"""
+	The time is truncated to milliseconds, which is the precision with which MongoDB stores it,
+	so that it can be compared with the stored times.
+	"""
+
+	t = datetime.utcnow() + timedelta(seconds=task_lease_seconds)
+	return t.replace(microsecond=t.microsecond // 1000 * 1000)
+
+def make_lease(worker_id):
+	return {'worker_id': worker_id, 'expires_at': lease_expiry()}
+
+def assign_lease(updates, original):
+	"""
+	Leases a task to the worker that claims it using a PATCH request. Claims made through the
+	``claim`` and ``claim_by_resources`` resources are leased by ``claims.claim``.
+	"""
+
+	if updates.get('state') == 'running':
+		updates['lease'] = make_lease(g.user[config.ID_FIELD])
+
+def release_lease(updates, original):
+	if 'state' not in updates or updates['state'] in leased_states or 'lease' not in original:
+		return
+
+	app.data.driver.db.tasks.update_one({
+		config.ID_FIELD: original[config.ID_FIELD],
+		'state': {'$nin': leased_states}
+	}, {'$unset': {'lease': ''}})
+
+class RenewLeasesValidator(RequestValidator):
+	def __init__(self, schema, resource=None, allow_unknown=False,
+		transparent_schema_rules=False):
+
+		super().__init__(schema, resource)
+
+	def validate_request(self, document):
+		assert g.user is not None
+
+		if g.user['role'] != 'worker':
+			abort(403, description="Only workers can renew leases.")
+
+		self.ensure_worker_has_permission('report')
+		return super().validate_request(document)
+
+def renew_leases(request, db):
+	"""
+	Called after validation in order to renew the leases that the worker holds on the tasks in
+	``request['tasks']``. The response lists the tasks whose leases were renewed, and the ones
+	whose leases are no longer held by the worker (e.g. because they expired and the tasks were
+	reclaimed). The worker should stop running the latter.
+	"""
+
+	worker_id  = g.user[config.ID_FIELD]
+	expires_at = lease_expiry()
+	held_query = {
+		config.ID_FIELD: {'$in': request['tasks']},
+		'state': {'$in': leased_states},
+		'lease.worker_id': worker_id
+	}
+
+	db.tasks.update_many(held_query, {'$set': {'lease.expires_at': expires_at}})
+
+	renewed = set(task[config.ID_FIELD] for task in db.tasks.find(
+		dict(held_query, **{'lease.expires_at': {'$gte': expires_at}}),
+		projection={config.ID_FIELD: True}))
+
+	return {
+		'renewed': [str(_id) for _id in request['tasks'] if _id in renewed],
+		'lost': [str(_id) for _id in request['tasks'] if _id not in renewed]
+	}
@@ -7,9 +7,317 @@ banyan.server.lock
 Defines locks for resources that require synchronized access. A request may result in the execution
 of several database operations, so we cannot rely on atomicity of individual database operations to
 enforce this.
+
+Access to tasks is synchronized using ``task_locks``, which maintains one lock per task id. A
+request acquires the locks for all of the tasks that it may modify, so requests that involve
+disjoint sets of tasks (e.g. requests for independent task chains) can proceed in parallel.
+
+When the server is run using several processes (see ``run.py``), in-process locks are no longer
+sufficient. If the ``DISTRIBUTED_LOCKS`` setting is enabled, the locks are instead implemented as
+leases stored in MongoDB, so that they are shared by all processes using the same database.
 """
 
-from threading import Lock
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from uuid import uuid4
+
+from flask import current_app as app
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from banyan.server.constants import lock_lease_seconds, lock_renewal_seconds
+
+def log(msg):
+	print(msg, file=sys.stderr, flush=True)
+
+class KeyedLock:
+	"""
+	Manages a collection of locks indexed by arbitrary keys. The lock for a key is created when it
+	is first acquired, and destroyed once no thread holds or is waiting for it.
+
+	To prevent deadlocks, a thread must acquire all of the keys that it needs at once, using a
+	single call to ``acquire``. The keys are always acquired in sorted order.
+	"""
+
+	def __init__(self):
+		self.lock    = Lock()
+		self.entries = {}
+
+	def acquire(self, keys):
+		"""
+		Acquires the locks for all of the given keys, and returns a ``KeyedLockGuard`` that
+		can be used to release them.
+		"""
+
+		keys = sorted(set(str(key) for key in keys))
+		acquired = []
+
+		try:
+			for key in keys:
+				with self.lock:
+					entry = self.entries.get(key)
+					if entry is None:
+						entry = [Lock(), 0]
+						self.entries[key] = entry
+					entry[1] += 1
+
+				try:
+					entry[0].acquire()
+				except:
+					self._unref(key)
+					raise
+
+				acquired.append(key)
+		except:
+			self.release(acquired)
+			raise
+
+		return KeyedLockGuard(self, acquired)
+
+	def release(self, keys):
+		for key in reversed(keys):
+			self.entries[key][0].release()
+			self._unref(key)
+
+	def _unref(self, key):
+		with self.lock:
+			entry = self.entries[key]
+			entry[1] -= 1
+
+			if entry[1] == 0:
+				self.entries.pop(key)
+
+	def __len__(self):
+		with self.lock:
+			return len(self.entries)
+
+class KeyedLockGuard:
+	"""
+	Represents a set of keys held by a thread. Releasing the guard more than once has no effect,
+	so that error handlers can release the guard unconditionally.
+	"""
+
+	def __init__(self, keyed_lock, keys):
+		self.keyed_lock = keyed_lock
+		self.keys       = keys
+		self.released   = False
+
+	def release(self):
+		if self.released:
+			return
+
+		self.released = True
+		self.keyed_lock.release(self.keys)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+class LeaseLock:
+	"""
+	Provides the same interface as ``KeyedLock``, but stores the locks as leases in a MongoDB
+	collection. A lock is held by inserting a document whose id is the key. If the holder dies
+	before releasing the lock, then the lease expires after ``lock_lease_seconds``, after which
+	it can be taken over by another process. Expired leases that are never taken over are
+	removed by a TTL index.
+
+	While a guard is alive, the leases of its keys are renewed every ``lock_renewal_seconds`` by
+	a background thread, which is shared by all of the guards of the process. If a lease is lost
+	anyway (e.g. because the process was stalled), then this is logged when the guard is
+	released, since mutual exclusion may have been violated.
+	"""
+
+	min_backoff_seconds = 0.001
+	max_backoff_seconds = 0.05
+
+	def __init__(self, collection):
+		self.collection = collection
+		self.lock       = Lock()
+		self.guards     = set()
+		self.renewer    = None
+
+	def _add_guard(self, guard):
+		"""
+		The renewal thread is started when the first guard is created rather than in the
+		constructor, so that it is started after the server processes are forked.
+		"""
+
+		with self.lock:
+			self.guards.add(guard)
+
+			if self.renewer is None:
+				self.renewer = Thread(target=self._renew_leases, daemon=True)
+				self.renewer.start()
+
+	def _remove_guard(self, guard):
+		with self.lock:
+			self.guards.discard(guard)
+
+	def _renew_leases(self):
+		while True:
+			time.sleep(lock_renewal_seconds)
+
+			with self.lock:
+				guards = list(self.guards)
+
+			for guard in guards:
+				try:
+					guard.renew()
+				except PyMongoError as e:
+					log("Failed to renew leases for locks {}: {}".format(guard.keys, e))
+
+	def ensure_indices(self, db):
+		db[self.collection].create_index('expires_at', expireAfterSeconds=0)
 
-task_lock = Lock()
-registered_workers_lock = Lock()
+	def _try_acquire(self, coll, key, owner):
+		now = datetime.utcnow()
+		lease = {'owner': owner, 'expires_at': now + timedelta(seconds=lock_lease_seconds)}
+
+		try:
+			coll.insert_one(dict(lease, _id=key))
+			return True
+		except DuplicateKeyError:
+			pass
+
+		# Take over the lease if it has expired.
+		res = coll.update_one({'_id': key, 'expires_at': {'$lt': now}}, {'$set': lease})
+		return res.modified_count == 1
+
+	def acquire(self, keys):
+		keys  = sorted(set(str(key) for key in keys))
+		coll  = app.data.driver.db[self.collection]
+		owner = uuid4().hex
+		guard = LeaseLockGuard(self, coll, owner, [])
+		self._add_guard(guard)
+
+		try:
+			for key in keys:
+				backoff = self.min_backoff_seconds
+
+				while not self._try_acquire(coll, key, owner):
+					time.sleep(random.uniform(0, backoff))
+					backoff = min(2 * backoff, self.max_backoff_seconds)
+
+				guard.keys.append(key)
+		except:
+			guard.release()
+			raise
+
+		return guard
+
+class LeaseLockGuard:
+	"""
+	Same as ``KeyedLockGuard``, but for ``LeaseLock``.
+	"""
+
+	def __init__(self, lease_lock, collection, owner, keys):
+		self.lease_lock = lease_lock
+		self.collection = collection
+		self.owner      = owner
+		self.keys       = keys
+		self.released   = False
+
+		# Prevents a renewal from racing with the release of the guard.
+		self.lock = Lock()
+
+	def renew(self):
+		with self.lock:
+			if self.released or len(self.keys) == 0:
+				return
+
+			keys = list(self.keys)
+			expires_at = datetime.utcnow() + timedelta(seconds=lock_lease_seconds)
+			res = self.collection.update_many({'_id': {'$in': keys}, 'owner': self.owner},
+				{'$set': {'expires_at': expires_at}})
+
+		if res.matched_count != len(keys):
+			log("Leases for locks {} were lost before they could be renewed.".format(keys))
+
+	def release(self):
+		with self.lock:
+			if self.released:
+				return
+			self.released = True
+
+		self.lease_lock._remove_guard(self)
+		if len(self.keys) == 0:
+			return
+
+		res = self.collection.delete_many({'_id': {'$in': self.keys}, 'owner': self.owner})
+		if res.deleted_count != len(self.keys):
+			log("Leases for some of the locks {} expired while they were held; mutual "
+				"exclusion may have been violated.".format(self.keys))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+class ConfiguredLock:
+	"""
+	Delegates to a ``KeyedLock`` or a ``LeaseLock``, depending on whether the
+	``DISTRIBUTED_LOCKS`` setting of the application is enabled. This allows the schema and the
+	event hooks to refer to the same lock objects regardless of how the server is deployed.
+	"""
+
+	def __init__(self, collection):
+		self.local       = KeyedLock()
+		self.distributed = LeaseLock(collection)
+
+	def impl(self):
+		if app.config.get('DISTRIBUTED_LOCKS'):
+			return self.distributed
+		return self.local
+
+	def acquire(self, keys):
+		return self.impl().acquire(keys)
+
+	def ensure_indices(self, db):
+		self.distributed.ensure_indices(db)
+
+def update_lock_keys(updates):
+	"""
+	Returns the keys that must be acquired in order to apply the given list of updates to a
+	virtual resource of ``tasks``, i.e. the ids in all of the 'targets' and 'values' lists. This
+	function is called before validation, so malformed updates are ignored here and reported by
+	the validator later.
+	"""
+
+	keys = []
+	if not isinstance(updates, list):
+		return keys
+
+	for update in updates:
+		if not isinstance(update, dict):
+			continue
+
+		for field in ['targets', 'values']:
+			ids = update.get(field)
+			if isinstance(ids, list):
+				keys.extend(ids)
+
+	return keys
+
+"""
+Held while adding continuations, since this may change the positions of tasks other than the ones
+whose locks are held (see ``topological_order.py``).
+"""
+topological_order_key = 'topological_order'
+
+def add_continuation_lock_keys(updates):
+	return update_lock_keys(updates) + [topological_order_key]
+
+task_locks = ConfiguredLock('task_locks')
+
+"""
+Registration and unregistration of workers are synchronized using a single key, since they are
+infrequent.
+"""
+registered_workers_lock = ConfiguredLock('registered_workers_locks')
+registered_workers_key  = 'registered_workers'
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.recovery
+----------------------
+
+Recovers the tasks claimed by workers that can no longer be reached. Each such worker is
+unregistered, and the current execution attempt of each of its tasks is ended with the exit status
+``abandoned_status``. The tasks are then handled as if the worker had reported an unsuccessful
+termination (see ``update_execution_data`` in ``event_hooks.py``):
+
+- Running tasks with attempts remaining are put back in the ``available`` state, with new execution
+  data for the next attempt.
+- Running tasks that have reached their maximum attempt count are terminated, and their
+  continuations are cancelled.
+- Tasks pending cancellation are cancelled, along with their continuations.
+
+All tasks of the worker are handled together, so the number of database operations does not depend
+on the number of tasks, except for the traversal of the continuations that are cancelled, which uses
+a constant number of operations per level (see ``continuations.cancel``).
+
+A worker is considered unreachable if it does not respond to the health checks made by
+``WorkerAvailabilityChecker``. Failing to deliver a message through ``WorkerNotifier`` is not
+enough, since the connection may only have carried a hint. Tasks whose leases have expired
+(see ``leases.py``) are recovered in the same way, but their workers are not unregistered, since
+they may still be running other tasks.
+"""
+
+import asyncio
+import sys
+
+from datetime import datetime
+from pymongo import UpdateOne
+from eve.utils import config
+
+from banyan.common import make_token
+from banyan.server.authentication import auth_cache
+from banyan.server.constants import lease_sweep_seconds
+from banyan.server.leases import leased_states
+from banyan.server.locks import task_locks, registered_workers_lock, registered_workers_key
+from banyan.server.dispatch import dispatcher
+import banyan.server.continuations as continuations
+
+abandoned_status = 'abandoned (worker unreachable)'
+
+task_projection = {
+	'state': True,
+	'attempt_count': True,
+	'max_attempt_count': True,
+	'execution_data_id': True,
+	'owner': True,
+	'continuations': True,
+	'requested_resources': True,
+	'lease': True
+}
+
+def lock_tasks(task_ids, db):
+	"""
+	Acquires the locks for the tasks in ``task_ids`` and their continuations, which is what a
+	request changing the states of the tasks would acquire (see
+	``acquire_task_locks_if_necessary`` in ``event_hooks.py``). Returns the lock guard along with
+	the tasks, which are read while the locks are held.
+	"""
+
+	keys   = [str(_id) for _id in task_ids]
+	guard  = None
+	locked = None
+
+	while True:
+		tasks = list(db.tasks.find({config.ID_FIELD: {'$in': task_ids}},
+			projection=task_projection))
+
+		conts = set(str(c) for task in tasks for c in task['continuations'])
+		if locked is not None and conts <= locked:
+			return guard, tasks
+
+		if guard is not None:
+			guard.release()
+		guard  = task_locks.acquire(keys + list(conts))
+		locked = conts
+
+def requeue(tasks, db):
+	"""
+	Starts a new execution attempt for each running task in ``tasks``, and puts it back in the
+	``available`` state.
+	"""
+
+	new_data = []
+
+	for task in tasks:
+		data = {
+			'task_id': task[config.ID_FIELD],
+			'attempt_count': task['attempt_count'] + 1,
+			'token': make_token()
+		}
+
+		if 'owner' in task:
+			data['owner'] = task['owner']
+		new_data.append(data)
+
+	data_ids = db.execution_info.insert_many(new_data).inserted_ids
+
+	db.tasks.bulk_write([
+		UpdateOne({config.ID_FIELD: task[config.ID_FIELD], 'state': 'running'}, {
+			'$inc': {'attempt_count': 1},
+			'$set': {'state': 'available', 'execution_data_id': data_id},
+			'$unset': {'lease': ''},
+			'$currentDate': {config.LAST_UPDATED: True}
+		}) for task, data_id in zip(tasks, data_ids)
+	], ordered=False)
+
+def set_state(tasks, state, new_state, db):
+	if len(tasks) == 0:
+		return
+
+	db.tasks.update_many({
+		config.ID_FIELD: {'$in': [task[config.ID_FIELD] for task in tasks]},
+		'state': state
+	}, {
+		'$set': {'state': new_state},
+		'$unset': {'lease': ''},
+		'$currentDate': {config.LAST_UPDATED: True}
+	})
+
+def abandon_attempts(attempts, db, expired_by=None):
+	"""
+	Ends the given execution attempts, and requeues, terminates, or cancels their tasks as
+	described above. This must be called from an application context, since it acquires the
+	locks in ``locks.py``.
+
+	Returns a dict with the number of tasks that were requeued, terminated, and cancelled.
+
+	Args:
+		attempts: Maps the id of each task to the id of the execution data for the attempt
+			to abandon.
+		db: Handle to the ``banyan`` database.
+		expired_by: If provided, then only the tasks whose leases expired before this time
+			are changed, so that leases renewed in the meantime are respected.
+	"""
+
+	counts = {'requeued': 0, 'terminated': 0, 'cancelled': 0}
+	if len(attempts) == 0:
+		return counts
+
+	guard, tasks = lock_tasks(list(attempts), db)
+
+	with guard:
+		# Attempts that the task has moved on from (e.g. because the worker reported its
+		# termination in the meantime) are not changed.
+		tasks = [task for task in tasks if task['state'] in leased_states and
+			task.get('execution_data_id') == attempts[task[config.ID_FIELD]]]
+
+		if expired_by is not None:
+			tasks = [task for task in tasks if 'lease' in task and
+				task['lease']['expires_at'] < expired_by]
+
+		if len(tasks) == 0:
+			return counts
+
+		db.execution_info.update_many({
+			config.ID_FIELD: {'$in': [task['execution_data_id'] for task in tasks]},
+			'exit_status': {'$exists': False}
+		}, {
+			'$set': {'exit_status': abandoned_status, 'time_terminated': datetime.utcnow()}
+		})
+
+		requeued, terminated, cancelled = [], [], []
+
+		for task in tasks:
+			if task['state'] == 'pending_cancellation':
+				cancelled.append(task)
+			elif task['attempt_count'] < task['max_attempt_count']:
+				requeued.append(task)
+			else:
+				terminated.append(task)
+
+		if len(requeued) != 0:
+			requeue(requeued, db)
+
+		set_state(terminated, 'running', 'terminated', db)
+		set_state(cancelled, 'pending_cancellation', 'cancelled', db)
+		continuations.cancel([child for task in terminated + cancelled
+			for child in task['continuations']], db)
+
+	dispatcher.tasks_available(requeued, db)
+
+	counts['requeued']   = len(requeued)
+	counts['terminated'] = len(terminated)
+	counts['cancelled']  = len(cancelled)
+	return counts
+
+def abandon_worker(worker_id, db):
+	"""
+	Unregisters the worker with id ``worker_id``, and abandons the tasks that it is running
+	using ``abandon_attempts``.
+	"""
+
+	with registered_workers_lock.acquire([registered_workers_key]):
+		res = db.registered_workers.delete_many({'worker_id': worker_id})
+
+	if res.deleted_count != 0:
+		auth_cache.invalidate(db)
+
+	attempts = {data['task_id']: data[config.ID_FIELD] for data in db.execution_info.find(
+		{'worker_id': worker_id, 'exit_status': {'$exists': False}},
+		projection={'task_id': True})}
+
+	return abandon_attempts(attempts, db)
+
+def reclaim_expired_leases(db):
+	"""
+	Abandons the current execution attempts of the tasks whose leases have expired, using
+	``abandon_attempts``.
+	"""
+
+	now = datetime.utcnow()
+	attempts = {task[config.ID_FIELD]: task['execution_data_id'] for task in db.tasks.find({
+		'lease.expires_at': {'$lt': now},
+		'state': {'$in': leased_states}
+	}, projection={'execution_data_id': True})}
+
+	return abandon_attempts(attempts, db, expired_by=now)
+
+class WorkerRecovery:
+	"""
+	Runs ``abandon_worker`` off the event loop shared with ``WorkerNotifier`` and
+	``WorkerAvailabilityChecker``, which reports the workers that miss their health checks by
+	calling ``worker_unreachable`` from the loop thread. If ``sweep_leases`` is called, then
+	``reclaim_expired_leases`` is also run every ``lease_sweep_seconds``. The loop must be given
+	the application (see ``EventLoopThread``).
+	"""
+
+	def __init__(self, event_loop, db):
+		self.event_loop = event_loop
+		self.db         = db
+
+		# Ids of the workers that are being recovered. Only accessed by the loop thread.
+		self.pending = set()
+
+	def log(self, msg):
+		print(msg, file=sys.stderr, flush=True)
+
+	def sweep_leases(self):
+		self.event_loop.call(self._start_sweeping)
+
+	def _start_sweeping(self):
+		self.event_loop.spawn(self._sweep())
+
+	def worker_unreachable(self, worker_id):
+		if worker_id in self.pending:
+			return
+
+		self.pending.add(worker_id)
+		self.event_loop.spawn(self._recover(worker_id))
+
+	async def _recover(self, worker_id):
+		try:
+			counts = await self.event_loop.run_blocking(abandon_worker, worker_id, self.db)
+			self.log("Unregistered worker '{}': requeued {}, terminated {}, and cancelled {} "
+				"of its tasks.".format(worker_id, counts['requeued'], counts['terminated'],
+				counts['cancelled']))
+		except Exception as e:
+			self.log("Error recovering tasks of worker '{}': {}".format(worker_id, repr(e)))
+		finally:
+			self.pending.discard(worker_id)
+
+	async def _sweep(self):
+		while True:
+			try:
+				counts = await self.event_loop.run_blocking(reclaim_expired_leases,
+					self.db)
+
+				if sum(counts.values()) != 0:
+					self.log("Reclaimed tasks with expired leases: requeued {}, "
+						"terminated {}, and cancelled {}.".format(counts['requeued'],
+						counts['terminated'], counts['cancelled']))
+			except Exception as e:
+				self.log("Error reclaiming expired leases: {}".format(repr(e)))
+
+			await asyncio.sleep(lease_sweep_seconds)
@@ -5,8 +5,17 @@ banyan.server.run
 -----------------
 
 Starts an instance of the Banyan application.
+
+By default, the server runs as a single process. If ``--processes`` is greater than one, then the
+server socket is shared by a pool of processes, each of which runs its own instance of the
+application. In this mode, the locks defined in ``locks.py`` are stored in MongoDB, so that the
+processes (or several hosts using the same database) can coordinate with each other.
 """
 
+from argparse import ArgumentParser
+from pprint import pprint
+from multiprocessing import Process
+from werkzeug.serving import make_server
 from eve import Eve
 import socket
 
@@ -17,18 +26,122 @@ sys.path.insert(1, os.path.join(sys.path[0], '../..'))
 
 from banyan.server.validation import Validator
 from banyan.server.virtual_blueprints import blueprints
+from banyan.server.locks import task_locks, registered_workers_lock
+from banyan.server.event_loop import EventLoopThread
+from banyan.server.worker_notifier import WorkerNotifier
+from banyan.server.worker_availability_checker import WorkerAvailabilityChecker
+from banyan.server.recovery import WorkerRecovery
+from banyan.server.dispatch import dispatcher
 import banyan.server.event_hooks as event_hooks
+import banyan.server.continuations as continuations
+import banyan.server.indices as indices
+import banyan.server.fair_share as fair_share
+import banyan.server.topological_order as topological_order
+import banyan.server.critical_path as critical_path
 
 from config.settings import banyan_port
 
 def get_public_ip():
 	return socket.gethostbyname(socket.gethostname())
 
-if __name__ == '__main__':
+def parse_args():
+	ap = ArgumentParser(description="Starts the Banyan server.")
+	ap.add_argument('--processes', type=int, default=1, help="Number of server processes.")
+	ap.add_argument('--distributed-locks', action='store_true', help="Store locks in "
+		"MongoDB even if only one process is used. This is required when several hosts "
+		"share the same database.")
+	ap.add_argument('--rebuild-parents', action='store_true', help="Recompute the 'parents' "
+		"field of all tasks from their continuation lists before starting. Only needed for "
+		"databases created by older versions of the server.")
+	ap.add_argument('--rebuild-topological-order', action='store_true', help="Recompute the "
+		"positions of all tasks in the topological order before starting. Only needed for "
+		"databases created by older versions of the server.")
+	ap.add_argument('--rebuild-critical-paths', action='store_true', help="Recompute the "
+		"critical path lengths of all tasks before starting. Only needed for databases "
+		"created by older versions of the server.")
+	ap.add_argument('--index-report', action='store_true', help="Print the declared indexes "
+		"that are missing and the existing indexes that are unused, and exit.")
+
+	args = ap.parse_args()
+	if args.processes < 1:
+		raise ValueError("Argument '--processes' must be positive.")
+	return args
+
+def make_app(distributed_locks=False, check_availability=True):
 	app = Eve(validator=Validator)
+	app.config['DISTRIBUTED_LOCKS'] = distributed_locks
 	event_hooks.register(app)
 
 	for blueprint in blueprints:
 		app.register_blueprint(blueprint)
 
-	app.run(host=get_public_ip(), port=banyan_port)
+	with app.app_context():
+		db = app.data.driver.db
+		indices.ensure_indices(db)
+		fair_share.FairShareUpdater(db)
+		event_loop = EventLoopThread(app)
+		recovery   = WorkerRecovery(event_loop, db)
+		notifier   = WorkerNotifier(event_loop)
+		dispatcher.start(notifier)
+
+		if check_availability:
+			WorkerAvailabilityChecker(notifier, recovery, db)
+			recovery.sweep_leases()
+
+		if distributed_locks:
+			for lock in [task_locks, registered_workers_lock]:
+				lock.ensure_indices(db)
+
+	return app
+
+def serve(sock, check_availability):
+	"""
+	Runs one server process of the pool. The application is created after the process is
+	forked, since the MongoDB client is not fork-safe. Only one process of the pool checks the
+	availability of the workers and reclaims expired leases.
+	"""
+
+	app = make_app(distributed_locks=True, check_availability=check_availability)
+	host, port = sock.getsockname()[:2]
+	make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	if args.index_report:
+		app = Eve(validator=Validator)
+		with app.app_context():
+			pprint(indices.index_report(app.data.driver.db))
+		sys.exit(0)
+
+	"""
+	The rebuilds only need the database, so they run on a bare application, without the
+	background services started by ``make_app``.
+	"""
+	if args.rebuild_parents or args.rebuild_topological_order or args.rebuild_critical_paths:
+		app = Eve(validator=Validator)
+		with app.app_context():
+			db = app.data.driver.db
+			indices.ensure_indices(db)
+
+			if args.rebuild_parents:
+				continuations.rebuild_parents(db)
+			if args.rebuild_topological_order:
+				topological_order.rebuild(db)
+			if args.rebuild_critical_paths:
+				critical_path.rebuild(db)
+
+	if args.processes == 1:
+		app = make_app(distributed_locks=args.distributed_locks)
+		app.run(host=get_public_ip(), port=banyan_port)
+	else:
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind((get_public_ip(), banyan_port))
+		sock.listen(socket.SOMAXCONN)
+
+		pool = [Process(target=serve, args=(sock, i == 0)) for i in range(args.processes)]
+		for proc in pool:
+			proc.start()
+		for proc in pool:
+			proc.join()
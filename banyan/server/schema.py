@@ -9,12 +9,16 @@ Resource schema definitions.
 
 from eve.utils import config
 
+import banyan.server.claims as claims
 import banyan.server.continuations as continuations
 import banyan.server.execution_data as execution_data_
+import banyan.server.graph_submission as graph_submission
+import banyan.server.leases as leases
 
-from banyan.server.locks import task_lock
+from banyan.server.locks import task_locks, update_lock_keys, add_continuation_lock_keys
 from banyan.server.constants import *
 from banyan.server.authentication import TokenAuth, RestrictCreationToProviders
+from config.settings import max_task_set_size
 
 """
 XXX: Don't use multiline strings to write comments inside of dicts, because the
@@ -82,6 +86,53 @@ resource_info = {
 	}
 }
 
+"""
+Used by the worker to describe the resources that it has available. The first three fields
+correspond to those of ``ResourceSummary`` in ``banyan/worker/resource_info.py``.
+"""
+worker_resource_info = {
+	'memory_bytes': {
+		'type': 'integer',
+		'min': 0,
+		'required': True
+	},
+
+	'cpu_cores': {
+		'type': 'integer',
+		'min': 0,
+		'required': True
+	},
+
+	'gpus': {
+		'type': 'integer',
+		'min': 0,
+		'required': True
+	},
+
+	# The total number of cores in the worker's resource set. This is used to convert the
+	# 'percent' field of a task's requested cores into a core count. If this is omitted, then
+	# 'cpu_cores' is used instead.
+	'total_cpu_cores': {
+		'type': 'integer',
+		'min': 0
+	},
+
+	'gpu_memory_bytes': {
+		'type': 'integer',
+		'min': 0
+	},
+
+	'gpu_compute_capability_major': {
+		'type': 'integer',
+		'min': 1
+	},
+
+	'gpu_compute_capability_minor': {
+		'type': 'integer',
+		'min': 0
+	}
+}
+
 """
 All fields are marked 'readonly`, because they can only be modified via the 'update_execution_info'
 virtual resource of the 'tasks' endpoint.
@@ -93,6 +144,14 @@ execution_data = {
 		'readonly': True
 	},
 
+	# Owner of the task, which is used to compute the usage of each provider for fair-share
+	# scheduling.
+	'owner': {
+		'type': 'objectid',
+		'data_relation': {'resource': 'users', 'field': config.ID_FIELD},
+		'readonly': True
+	},
+
 	# Describes which execution attempt that this record is associated with.
 	'attempt_count': {
 		'type': 'integer',
@@ -259,6 +318,73 @@ tasks = {
 			}
 		},
 
+		# Ids of the tasks that have this task as a continuation. This field is maintained
+		# by the server, so that the edges into a task can be found using an index rather
+		# than by scanning the continuation lists of all tasks.
+		'parents': {
+			'type': 'list',
+			'default': [],
+			'readonly': True,
+			'schema': {'type': 'objectid'}
+		},
+
+		# Position of the task in the topological order of the dependency graph, which is
+		# used to detect cyclic dependencies (see ``topological_order.py``).
+		'topological_order': {
+			'type': 'integer',
+			'readonly': True
+		},
+
+		# Tasks with higher priorities are offered to workers first. See ``fair_share.py``
+		# for how this is combined with the usage of the task's owner.
+		'priority': {
+			'type': 'integer',
+			'min': min_priority,
+			'max': max_priority,
+			'default': 0,
+			'mutable_iff_inactive': True
+		},
+
+		# Id of the provider that created the task.
+		'owner': {
+			'type': 'objectid',
+			'data_relation': {'resource': 'users', 'field': config.ID_FIELD},
+			'readonly': True
+		},
+
+		# Fair-share level of the owner when the effective priority was last computed.
+		'fair_share_level': {
+			'type': 'integer',
+			'readonly': True
+		},
+
+		# Combination of 'priority' and 'fair_share_level' used to order task offers.
+		'effective_priority': {
+			'type': 'integer',
+			'readonly': True
+		},
+
+		# Determines the order in which the task is offered to workers among the tasks with
+		# the same effective priority (see ``offered_tasks`` in ``claims.py``).
+		'offer_key': {
+			'type': 'integer',
+			'readonly': True
+		},
+
+		# Sum of the runtime estimates along the longest chain of continuations starting at
+		# this task, including the task itself (see ``critical_path.py``).
+		'critical_path_milliseconds': {
+			'type': 'integer',
+			'readonly': True
+		},
+
+		# Number of bits in 'critical_path_milliseconds'. Among the tasks with the same
+		# effective priority, tasks with higher levels are offered to workers first.
+		'critical_path_level': {
+			'type': 'integer',
+			'readonly': True
+		},
+
 		'requested_resources': {
 			'type': 'dict',
 			'dependencies': ['command'],
@@ -268,7 +394,7 @@ tasks = {
 
 		# This field is not required, and we don't enforce that the task terminates within
 		# the amount of time given below. Its purpose is to allow the user to compute time
-		# estimates for task chains.
+		# estimates for task chains. The server uses it to compute 'critical_path_milliseconds'.
 		'estimated_runtime_milliseconds': {
 			'type': 'integer',
 			'mutable_iff_inactive': True,
@@ -329,6 +455,17 @@ tasks = {
 			'type': 'objectid',
 			'data_relation': {'resource': 'execution_info', 'field': config.ID_FIELD},
 			'readonly': True
+		},
+
+		# Held by the worker running the task, which renews it using the ``renew_leases``
+		# virtual action. The task is reclaimed if the lease expires (see ``leases.py``).
+		'lease': {
+			'type': 'dict',
+			'readonly': True,
+			'schema': {
+				'worker_id': {'type': 'objectid'},
+				'expires_at': {'type': 'datetime'}
+			}
 		}
 	}
 }
@@ -375,6 +512,19 @@ users = {
 			'type': 'string',
 			'required': True,
 			'readonly': True
+		},
+
+		# Relative share of the workers that a provider is entitled to (see
+		# ``fair_share.py``).
+		'share': {
+			'type': 'float',
+			'min': 0,
+			'readonly': True
+		},
+
+		'fair_share_level': {
+			'type': 'integer',
+			'readonly': True
 		}
 	}
 }
@@ -418,6 +568,14 @@ registered_workers = {
 			}
 		},
 
+		# Total resources of the worker. If given, the worker is only notified of new
+		# available tasks that fit in them (see ``dispatch.py``).
+		'resources': {
+			'type': 'dict',
+			'createonly': True,
+			'schema': worker_resource_info
+		},
+
 		'permissions': {
 			'type': 'list',
 			'default': ['claim', 'report'],
@@ -464,6 +622,20 @@ target_schema = {
 	}
 }
 
+"""
+Used by the ``claim`` virtual resource. We omit the ``data_relation`` rule for the targets, because
+validating it would cost one query per target. Claims for tasks that do not exist fail in the same
+way as claims for tasks that are not available.
+"""
+claim_target_schema = {
+	'targets': {
+		'type': 'list',
+		'maxlength': max_item_list_length,
+		'allows_duplicates': False,
+		'schema': {'type': 'objectid'}
+	}
+}
+
 """
 XXX: If adding or removing virtual resources, don't forget to update the corresponding stubs in the
 physical resource definitions.
@@ -474,7 +646,8 @@ virtual_resources = {
 			'granularity': ['resource', 'item'],
 			'validator': continuations.AddContinuationValidator,
 			'on_update': continuations.make_additions,
-			'lock': task_lock,
+			'lock': task_locks,
+			'lock_keys': add_continuation_lock_keys,
 
 			'value_schema': {
 				'type': 'list',
@@ -494,7 +667,8 @@ virtual_resources = {
 			'granularity': ['resource', 'item'],
 			'validator': continuations.RemoveContinuationValidator,
 			'on_update': continuations.make_removals,
-			'lock': task_lock,
+			'lock': task_locks,
+			'lock_keys': update_lock_keys,
 
 			'value_schema': {
 				'type': 'list',
@@ -514,18 +688,180 @@ virtual_resources = {
 			'granularity': ['item'],
 			'validator': execution_data_.ExecutionDataValidator,
 			'on_update': execution_data_.make_update,
-			'lock': task_lock,
+			'lock': task_locks,
+			'lock_keys': update_lock_keys,
 
 			'value_schema': {
 				'type': 'dict',
 				'schema': execution_data
 			}
+		},
+
+		# Requests to this resource are authenticated as if they were PATCH requests,
+		# since claiming a task is an update to the task rather than the creation of a
+		# new one.
+		'claim': {
+			'granularity': ['resource'],
+			'validator': claims.ClaimValidator,
+			'on_update': claims.make_claims,
+			'auth_method': 'PATCH',
+			'target_schema': claim_target_schema,
+
+			'value_schema': {
+				'type': 'dict',
+				'schema': {
+					'worker_id': {
+						'type': 'objectid',
+						'required': True
+					},
+
+					'time_started': {'type': 'datetime'}
+				}
+			}
 		}
 	}
 }
 
 for parent_res, virtuals in virtual_resources.items():
 	for virtual_res, schema in virtuals.items():
-		schema['schema'] = dict(target_schema)
+		schema['schema'] = dict(schema.get('target_schema', target_schema))
 		schema['schema']['values'] = schema['value_schema']
 		globals()[parent_res]['schema'][virtual_res] = {'virtual_resource': True}
+
+"""
+Virtual action definitions.
+
+Virtual actions are like resource-level virtual resources, except that the payload is a single
+document describing the request, rather than a list of updates to target documents. This allows the
+server to decide which documents are affected by the request.
+"""
+"""
+Schema for the tasks submitted to ``tasks/submit_graph``. The fields managed by the server are
+omitted, and the continuations are given separately as edges between the temporary ids of the tasks.
+The uniqueness of names is checked by ``SubmitGraphValidator``, using one query for all tasks.
+"""
+submitted_task_schema = {
+	field: dict((k, v) for k, v in rules.items() if k != 'unique')
+	for field, rules in tasks['schema'].items()
+	if not rules.get('readonly') and field not in ['state', 'continuations']
+}
+
+submitted_task_schema.update({
+	'id': {
+		'type': 'string',
+		'empty': False,
+		'maxlength': max_name_string_length,
+		'required': True
+	},
+
+	'state': {
+		'type': 'string',
+		'allowed': ['inactive', 'available']
+	}
+})
+
+virtual_actions = {
+	'tasks': {
+		'submit_graph': {
+			'validator': graph_submission.SubmitGraphValidator,
+			'on_request': graph_submission.make_graph,
+			'auth_method': 'POST',
+			'lock': task_locks,
+			'lock_keys': graph_submission.graph_lock_keys,
+
+			'schema': {
+				'tasks': {
+					'type': 'list',
+					'required': True,
+					'maxlength': max_graph_task_count,
+					'schema': {
+						'type': 'dict',
+						'schema': submitted_task_schema
+					}
+				},
+
+				'edges': {
+					'type': 'list',
+					'maxlength': max_graph_edge_count,
+					'schema': {
+						'type': 'dict',
+						'schema': {
+							'parent': {'type': 'string', 'required': True},
+							'child': {'type': 'string', 'required': True}
+						}
+					}
+				}
+			}
+		},
+
+		'claim_by_resources': {
+			'validator': claims.ClaimByResourcesValidator,
+			'on_request': claims.make_claims_by_resources,
+			'auth_method': 'PATCH',
+
+			'schema': {
+				'resources': {
+					'type': 'dict',
+					'required': True,
+					'schema': worker_resource_info
+				},
+
+				'max_count': {
+					'type': 'integer',
+					'min': 1,
+					'max': max_task_set_size
+				},
+
+				'time_started': {'type': 'datetime'}
+			}
+		},
+
+		# Renews the leases of the running tasks of a worker using one request. The ids of
+		# the tasks whose leases could not be renewed are returned.
+		'renew_leases': {
+			'validator': leases.RenewLeasesValidator,
+			'on_request': leases.renew_leases,
+			'auth_method': 'PATCH',
+
+			'schema': {
+				'tasks': {
+					'type': 'list',
+					'required': True,
+					'maxlength': max_item_list_length,
+					'allows_duplicates': False,
+					'schema': {'type': 'objectid'}
+				}
+			}
+		},
+
+		'available_for': {
+			'on_request': claims.find_available_tasks,
+			'auth_method': 'GET',
+
+			'schema': {
+				'resources': {
+					'type': 'dict',
+					'required': True,
+					'schema': worker_resource_info
+				},
+
+				'max_count': {
+					'type': 'integer',
+					'min': 1,
+					'max': max_task_set_size
+				},
+
+				# Used by workers to refresh their task caches incrementally (see
+				# ``find_available_tasks`` in ``claims.py``).
+				'updated_since': {'type': 'datetime'},
+
+				'cached': {
+					'type': 'list',
+					'maxlength': max_task_set_size,
+					'allows_duplicates': False,
+					'schema': {'type': 'objectid'}
+				}
+			}
+		}
+	}
+}
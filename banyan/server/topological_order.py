@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.server.topological_order
+-------------------------------
+
+Maintains a topological order of the dependency graph, so that continuations can be added without
+creating cyclic dependencies. A cycle would never be run, since ``pending_dependency_count`` would
+never reach zero for any task in it.
+
+Each task stores its position in the order in the ``topological_order`` field, such that every task
+precedes its continuations. The order is maintained using the algorithm given by Pearce and Kelly in
+"A Dynamic Topological Sort Algorithm for Directed Acyclic Graphs" (2006). Suppose that we add an
+edge from ``u`` to ``v``.
+
+- If ``u`` already precedes ``v``, then the edge cannot create a cycle, and nothing needs to be
+  done. This requires only the positions of the two tasks.
+- Otherwise, we search forward from ``v``, visiting only the tasks that precede ``u``, and backward
+  from ``u``, visiting only the tasks that follow ``v``. The edge creates a cycle iff the forward
+  search reaches ``u``. If it does not, then only the tasks visited by the two searches are
+  reordered.
+
+New tasks are placed before all existing tasks, since a new task can only have existing tasks as
+its continuations.
+
+Changes to the order must be serialized. This is done by acquiring ``topological_order_key`` from
+``task_locks`` whenever continuations are added (see ``locks.py``). Creating tasks does not require
+the lock, since the positions of new tasks are allocated atomically.
+"""
+
+from collections import deque
+
+from pymongo import ReturnDocument, UpdateOne
+from eve.utils import config
+
+order_field = 'topological_order'
+
+def allocate(count, db):
+	"""
+	Returns ``count`` positions that precede all positions allocated so far.
+	"""
+
+	res = db.counters.find_one_and_update({config.ID_FIELD: order_field},
+		{'$inc': {'value': -count}}, upsert=True, return_document=ReturnDocument.AFTER)
+	return list(range(res['value'], res['value'] + count))
+
+class DependencyGraph:
+	"""
+	Used to check a batch of new edges for cycles, and to update the topological order so that it
+	remains valid once the edges are added.
+
+	The edges are only written to the database after the whole batch has been validated, so the
+	edges accepted so far are kept here, and included in the searches for the subsequent edges.
+	"""
+
+	def __init__(self, db):
+		self.db        = db
+		self.positions = {}
+		self.children  = {}
+		self.parents   = {}
+
+	def _load(self, ids):
+		ids = [id_ for id_ in ids if id_ not in self.positions]
+		if len(ids) == 0:
+			return
+
+		for task in self.db.tasks.find({config.ID_FIELD: {'$in': ids}},
+			projection={order_field: True}):
+
+			self.positions[task[config.ID_FIELD]] = task[order_field]
+
+	def _search(self, start, bound, forward):
+		"""
+		Returns a dict mapping the tasks reachable from ``start`` through tasks whose positions
+		satisfy the query ``bound`` to their positions. Continuations are followed if
+		``forward`` is true, and parents otherwise. Each level of the search uses one query.
+		"""
+
+		field    = 'continuations' if forward else 'parents'
+		pending  = self.children if forward else self.parents
+		visited  = {}
+		seen     = {start}
+		frontier = [start]
+
+		while len(frontier) != 0:
+			tasks = self.db.tasks.find({config.ID_FIELD: {'$in': frontier}, order_field: bound},
+				projection={field: True, order_field: True})
+			frontier = []
+
+			for task in tasks:
+				id_ = task[config.ID_FIELD]
+				visited[id_] = task[order_field]
+
+				for next_id in task.get(field, []) + pending.get(id_, []):
+					if next_id not in seen:
+						seen.add(next_id)
+						frontier.append(next_id)
+
+		return visited
+
+	def _reorder(self, backward, forward):
+		"""
+		Moves the tasks in ``backward`` before the tasks in ``forward``, reusing the positions
+		that they currently occupy. The relative order of the tasks within each set is kept.
+		"""
+
+		tasks = sorted(backward.items(), key=lambda t: t[1]) + \
+			sorted(forward.items(), key=lambda t: t[1])
+		pool  = sorted(pos for _, pos in tasks)
+		ops   = []
+
+		for (id_, old), new in zip(tasks, pool):
+			if old != new:
+				ops.append(UpdateOne({config.ID_FIELD: id_}, {'$set': {order_field: new}}))
+			if id_ in self.positions:
+				self.positions[id_] = new
+
+		if len(ops) != 0:
+			self.db.tasks.bulk_write(ops, ordered=False)
+
+	def add_edge(self, parent, child):
+		"""
+		Adds ``child`` as a continuation of ``parent``, updating the order if necessary. Returns
+		``False`` without adding the edge if doing so would create a cycle.
+		"""
+
+		self._load([parent, child])
+		lower, upper = self.positions[child], self.positions[parent]
+
+		if upper >= lower:
+			forward = self._search(child, {'$lte': upper}, forward=True)
+			if parent in forward:
+				return False
+
+			backward = self._search(parent, {'$gte': lower}, forward=False)
+			self._reorder(backward, forward)
+
+		self.children.setdefault(parent, []).append(child)
+		self.parents.setdefault(child, []).append(parent)
+		return True
+
+def rebuild(db):
+	"""
+	Recomputes the positions of all tasks from their continuation lists. This only needs to be
+	run once, on databases created before the ``topological_order`` field was introduced. It
+	assumes that the dependency graph is acyclic.
+	"""
+
+	children = {}
+	in_degree = {}
+
+	for task in db.tasks.find({}, projection={'continuations': True}):
+		id_ = task[config.ID_FIELD]
+		children[id_] = task.get('continuations', [])
+		in_degree.setdefault(id_, 0)
+
+		for child in children[id_]:
+			in_degree[child] = in_degree.get(child, 0) + 1
+
+	queue = deque(id_ for id_, n in in_degree.items() if n == 0)
+	ops   = []
+
+	while len(queue) != 0:
+		id_ = queue.popleft()
+		ops.append(UpdateOne({config.ID_FIELD: id_}, {'$set': {order_field: len(ops)}}))
+
+		for child in children.get(id_, []):
+			in_degree[child] -= 1
+			if in_degree[child] == 0:
+				queue.append(child)
+
+	assert len(ops) == len(in_degree), "Dependency graph contains a cycle."
+
+	if len(ops) != 0:
+		db.tasks.bulk_write(ops, ordered=False)
+
+	# New tasks are allocated positions before all of the ones assigned above.
+	db.counters.update_one({config.ID_FIELD: order_field}, {'$set': {'value': 0}}, upsert=True)
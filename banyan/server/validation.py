@@ -420,6 +420,42 @@ class BulkUpdateValidator(ValidatorBase):
 			return False
 		return self.validate_update_content(updates, original_ids, original_documents)
 
+class RequestValidator(ValidatorBase):
+	"""
+	A validator for the payloads of virtual actions. Unlike the payload sent to a virtual
+	resource, the payload sent to a virtual action is not a list of updates to existing
+	documents, so it is validated as a single document against the schema of the action.
+	"""
+
+	def __init__(self, schema, resource=None, allow_unknown=False,
+		transparent_schema_rules=False):
+
+		"""
+		The last two arguments are retained despite the fact that they are unused, in order
+		to maintain compatibility with Eve's validator interface.
+		"""
+
+		super().__init__(schema, resource)
+
+	def validate_request(self, document):
+		"""
+		Validates the payload of a request to a virtual action. If validation succeeds, the
+		deserialized payload is returned. Otherwise, ``None`` is returned.
+		"""
+
+		if not isinstance(document, dict):
+			self._error('payload', "Payload must be a JSON object.")
+			return None
+
+		"""
+		We bypass ``ValidatorBase.validate``, since the additional checks that it performs
+		only apply to tasks.
+		"""
+		document = serialize(document, schema=self.schema)
+		if not eve.io.mongo.Validator.validate(self, document):
+			return None
+		return document
+
 class Validator(ValidatorBase):
 	"""
 	Adds support for virtual resources to ``ValidatorBase``.
@@ -4,7 +4,8 @@
 banyan.server.virtual_blueprints
 --------------------------------
 
-Creates Flask Blueprints for the virtual resources based on the schema defined in ``schema.py``.
+Creates Flask Blueprints for the virtual resources and virtual actions based on the schema defined
+in ``schema.py``.
 """
 
 from werkzeug import exceptions
@@ -14,42 +15,77 @@ from eve.utils import config, debug_error_message
 from eve.validation import ValidationError
 from eve.methods.common import payload
 
-from banyan.server.schema import virtual_resources
-from banyan.server.validation import BulkUpdateValidator
+from banyan.server.schema import virtual_resources, virtual_actions
+from banyan.server.validation import BulkUpdateValidator, RequestValidator
+
+def authorize(parent_resource, auth_method=None):
+	"""
+	Checks that the request has access to ``parent_resource``. Returns ``None`` if this is the
+	case, and the response that should be sent to the client otherwise.
+
+	If ``auth_method`` is provided, then the request is authenticated as if it were made using
+	this method, rather than the actual method of the request.
+	"""
+
+	# Authentication code here adapted from ``auth.py`` in Eve.
+	resource = app.config['DOMAIN'].get(parent_resource)
+	method   = auth_method or request.method
+	public   = resource['public_methods']
+	roles    = list(resource['allowed_roles'])
+
+	if method in ['GET', 'HEAD', 'OPTIONS']:
+		roles += resource['allowed_read_roles']
+	else:
+		roles += resource['allowed_write_roles']
+
+	auth = resource_auth(parent_resource)
+	if method not in public:
+		if not auth.authorized(roles, parent_resource, method):
+			return auth.authenticate()
+
+	return None
+
+def make_response(issues, result=None):
+	response = {}
+
+	if len(issues) != 0:
+		response[config.ISSUES] = issues
+		response[config.STATUS] = config.STATUS_ERR
+		status = config.VALIDATION_ERROR_STATUS
+	else:
+		response[config.STATUS] = config.STATUS_OK
+		status = 200
+
+		if result:
+			response.update(result)
+
+	response = jsonify(response)
+	response.status_code = status
+	return response
 
 def make_resource_level_handler(parent_resource, virtual_resource, schema, validator_class,
-	on_update, lock):
+	on_update, lock, lock_keys, auth_method=None):
 
 	"""
 	Defines and returns a request handler for a virtual resource at resource-level granularity.
+	If ``on_update`` returns a ``dict``, then its contents are included in the response.
+
+	If ``lock`` is provided, then it should be a ``KeyedLock``. The keys returned by
+	``lock_keys(updates)`` are held while the request is processed.
 	"""
 
 	def handler(updates, skip_validation=False):
-		# Authentication code here adapted from ``auth.py`` in Eve.
-		resource = app.config['DOMAIN'].get(parent_resource)
-		public   = resource['public_methods']
-		roles    = list(resource['allowed_roles'])
-
-		if request.method in ['GET', 'HEAD', 'OPTIONS']:
-			roles += resource['allowed_read_roles']
-		else:
-			roles += resource['allowed_write_roles']
-
 		issues = {}
+		result = None
+		guard  = None
 
 		try:
 			if lock:
-				lock.acquire()
-
-			"""
-			The authenticator may need to access the ``registered_workers`` database, so
-			we need to acquire the lock first to prevent races with other requests that
-			make modifications to this database.
-			"""
-			auth = resource_auth(parent_resource)
-			if request.method not in public:
-				if not auth.authorized(roles, parent_resource, request.method):
-					return auth.authenticate()
+				guard = lock.acquire(lock_keys(updates))
+
+			failure = authorize(parent_resource, auth_method)
+			if failure:
+				return failure
 
 			if not skip_validation:
 				validator = validator_class(schema=schema, resource=parent_resource)
@@ -80,7 +116,7 @@ def make_resource_level_handler(parent_resource, virtual_resource, schema, valid
 				# XXX not implemented: resolving document version (see patch.py in
 				# Eve).
 
-				on_update(updates, app.data.driver.db)
+				result = on_update(updates, app.data.driver.db)
 
 				"""
 				XXX not implemented: etags (see patch.py in Eve). etags are obtained
@@ -104,33 +140,23 @@ def make_resource_level_handler(parent_resource, virtual_resource, schema, valid
 			abort(400, description=debug_error_message("An exception occurred: {}".
 				format(e)))
 		finally:
-			if lock:
-				lock.release()
-
-		response = {}
+			if guard:
+				guard.release()
 
-		if len(issues) != 0:
-			response[config.ISSUES] = issues
-			response[config.STATUS] = config.STATUS_ERR
-			status = config.VALIDATION_ERROR_STATUS
-		else:
-			response[config.STATUS] = config.STATUS_OK
-			status = 200
-
-		response = jsonify(response)
-		response.status_code = status
-		return response
+		return make_response(issues, result)
 
 	return handler
 
-def make_item_level_handler(parent_resource, virtual_resource, schema, validator, on_update, lock):
+def make_item_level_handler(parent_resource, virtual_resource, schema, validator, on_update, lock,
+	lock_keys, auth_method=None):
+
 	"""
 	Same as ``make_resource_level_handler``, but for virtual resources that work at item-level
 	granularity.
 	"""
 
 	handler = make_resource_level_handler(parent_resource, virtual_resource, schema, validator,
-		on_update, lock)
+		on_update, lock, lock_keys, auth_method)
 
 	def scaffold(target_id, values, skip_validation=False):
 		"""
@@ -147,6 +173,53 @@ def make_item_level_handler(parent_resource, virtual_resource, schema, validator
 
 	return scaffold
 
+def make_action_handler(parent_resource, action, schema, validator_class, on_request, lock,
+	lock_keys, auth_method=None):
+
+	"""
+	Defines and returns a request handler for a virtual action. Unlike virtual resources, which
+	apply a list of updates to a set of target documents, virtual actions accept a single
+	document describing the request, and the server decides which documents are affected. The
+	``dict`` returned by ``on_request`` is included in the response.
+	"""
+
+	def handler(document):
+		issues = {}
+		result = None
+		guard  = None
+
+		try:
+			if lock:
+				guard = lock.acquire(lock_keys(document))
+
+			failure = authorize(parent_resource, auth_method)
+			if failure:
+				return failure
+
+			validator = validator_class(schema=schema, resource=parent_resource)
+			document  = validator.validate_request(document)
+
+			if document is not None:
+				result = on_request(document, app.data.driver.db)
+			else:
+				issues = validator.errors
+				assert len(issues) != 0
+		except ValidationError as e:
+			issues['validator exception'] = str(e)
+		except exceptions.HTTPException as e:
+			raise e
+		except Exception as e:
+			app.logger.exception(e)
+			abort(400, description=debug_error_message("An exception occurred: {}".
+				format(e)))
+		finally:
+			if guard:
+				guard.release()
+
+		return make_response(issues, result)
+
+	return handler
+
 blueprints = []
 
 # XXX not implemented: rate limiting, pre-event (see patch.py in Eve).
@@ -155,6 +228,8 @@ def route(p_res, v_res, schema):
 	on_update     = schema['on_update']
 	validator     = schema.get('validator') or BulkUpdateValidator
 	lock          = schema.get('lock') or False
+	lock_keys     = schema.get('lock_keys')
+	auth_method   = schema.get('auth_method')
 
 	schema['handlers'] = {}
 	router = Blueprint(p_res + '/' + v_res, __name__)
@@ -162,7 +237,7 @@ def route(p_res, v_res, schema):
 
 	if 'resource' in schema['granularity']:
 		h1 = make_resource_level_handler(p_res, v_res, update_schema, validator, on_update,
-			lock)
+			lock, lock_keys, auth_method)
 		schema['handlers']['resource_level'] = h1
 
 		"""
@@ -176,7 +251,7 @@ def route(p_res, v_res, schema):
 
 	if 'item' in schema['granularity']:
 		h2 = make_item_level_handler(p_res, v_res, update_schema, validator, on_update,
-			lock)
+			lock, lock_keys, auth_method)
 		schema['handlers']['item_level'] = h2
 
 		"""
@@ -187,6 +262,28 @@ def route(p_res, v_res, schema):
 		def route_item_level(item_id):
 			return h2(item_id, payload())
 
+def route_action(p_res, action, schema):
+	on_request  = schema['on_request']
+	validator   = schema.get('validator') or RequestValidator
+	lock        = schema.get('lock') or False
+	lock_keys   = schema.get('lock_keys')
+	auth_method = schema.get('auth_method')
+
+	router = Blueprint(p_res + '/' + action, __name__)
+	blueprints.append(router)
+
+	handler = make_action_handler(p_res, action, schema['schema'], validator, on_request, lock,
+		lock_keys, auth_method)
+	schema['handler'] = handler
+
+	@router.route('/' + p_res + '/' + action, methods=['POST'])
+	def route_request():
+		return handler(payload())
+
 for parent_res, virtuals in virtual_resources.items():
 	for virtual_res, v_schema in virtuals.items():
 		route(parent_res, virtual_res, v_schema)
+
+for parent_res, actions in virtual_actions.items():
+	for action, a_schema in actions.items():
+		route_action(parent_res, action, a_schema)
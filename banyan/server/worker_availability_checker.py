@@ -5,70 +5,167 @@ banyan.server.worker_availability_checker
 -----------------------------------------
 
 Periodically checks that each worker in the set of registered workers is available. If we find that
-a given worker is no longer available, then we proceed to unregister it.
-"""
-
-import time
+a given worker is no longer available, then we proceed to unregister it and recover its tasks (see
+``recovery.py``).
 
-from datetime import datetime
-from timeit import default_timer as timer
-from threading import Thread
-from flask import current_app as app
+The checks run on the event loop shared with ``WorkerNotifier`` (see ``event_loop.py``), in rounds
+of ``usage_update_poll_period`` milliseconds. Each round uses a constant number of queries, however
+many workers are registered:
 
-from config.settings import usage_update_poll_period 
-from banyan.notification_protocol import resource_usage_request, format_message
-from banyan.server.locks import registered_workers_lock
-from banyan.server.mongo_common import find_by_id
+- The set of registered workers and their request tokens are read using two queries. The
+  ``registered_workers_lock`` is only held while the first one runs.
+- The time of the latest update from each worker is obtained using a single aggregation.
 
-class WorkerAvailabilityChecker:
-	def __init__(self, notifier):
-		self.notifier        = notifier
-		self.db              = app.data.driver.db
-		self.current_workers = set()
+A worker is considered unavailable if it is running tasks, but has not sent any update since a
+``resource_usage_request`` that was sent to it at least one period ago. The requests for the round
+are then spread evenly over the period, so that they are not sent in a burst.
+"""
 
-		Thread(target=self._poll_workers).start()
+import asyncio
+import sys
 
-	def _notify_worker(self, _id):
-		worker = find_by_id('users', _id, self.db, {'request_token': True})
-		msg = format_message(resource_usage_request, worker['request_token'])
-		self.notifier.notify(_id, msg)
+from collections import deque
+from datetime import datetime, timedelta
+from eve.utils import config
 
-	def _received_update(self, _id, cur_time):
-		return db.execution_info.find_one({
-			'worker_id': _id,
-			'last_update': {'$gt': cur_time}
-		}) == None
+from config.settings import usage_update_poll_period
+from banyan.notification_protocol import resource_usage_request, format_message
+from banyan.server.locks import registered_workers_lock, registered_workers_key
 
-	def _poll_workers(self):
-		sleep_time = usage_update_poll_period
+class WorkerAvailabilityChecker:
+	def __init__(self, notifier, recovery, db):
+		self.notifier   = notifier
+		self.recovery   = recovery
+		self.event_loop = notifier.event_loop
+		self.db         = db
+		self.period     = timedelta(milliseconds=usage_update_poll_period)
+
+		# Maps the id of each worker to the times at which the last two requests were sent.
+		self.request_times = {}
+
+		self.event_loop.call(self._start)
+
+	def log(self, msg):
+		print(msg, file=sys.stderr, flush=True)
+
+	def _start(self):
+		self.event_loop.spawn(self._run())
+
+	def _registered_workers(self):
+		"""
+		Returns the registered workers, along with their request tokens.
+		"""
+
+		with registered_workers_lock.acquire([registered_workers_key]):
+			workers = list(self.db.registered_workers.find({},
+				projection={'worker_id': True, 'address': True}))
+
+		tokens = {user[config.ID_FIELD]: user['request_token'] for user in
+			self.db.users.find({config.ID_FIELD: {'$in': [w['worker_id'] for w in workers]}},
+			projection={'request_token': True})}
+
+		for worker in workers:
+			worker['request_token'] = tokens.get(worker['worker_id'])
+		return workers
+
+	def _latest_updates(self, worker_ids, since):
+		"""
+		Returns a dict mapping the id of each worker in ``worker_ids`` that sent an update after
+		``since`` to the time of its latest update.
+		"""
+
+		pipeline = [
+			{'$match': {
+				'worker_id': {'$in': worker_ids},
+				'last_update': {'$gt': since}
+			}},
+			{'$group': {
+				config.ID_FIELD: '$worker_id',
+				'last_update': {'$max': '$last_update'}
+			}}
+		]
+
+		return {res[config.ID_FIELD]: res['last_update'] for res in
+			self.db.execution_info.aggregate(pipeline)}
+
+	def _evaluate(self, workers, request_times, now):
+		"""
+		Returns the ids of the workers that did not respond to a request sent at least one
+		period before ``now``.
+		"""
+
+		deadlines = {}
+
+		for worker in workers:
+			times = [t for t in request_times.get(worker['worker_id'], [])
+				if t <= now - self.period]
+			if len(times) != 0:
+				deadlines[worker['worker_id']] = times[-1]
+
+		if len(deadlines) == 0:
+			return []
+
+		latest = self._latest_updates(list(deadlines), min(deadlines.values()))
+		silent = [_id for _id, t in deadlines.items() if _id not in latest or latest[_id] <= t]
+
+		if len(silent) == 0:
+			return []
+
+		# Workers that are not running any tasks have nothing to report, so they are only
+		# considered unavailable if one of their execution attempts is still open.
+		return self.db.execution_info.distinct('worker_id', {
+			'worker_id': {'$in': silent},
+			'exit_status': {'$exists': False}
+		})
+
+	def _check(self, request_times):
+		"""
+		Runs the queries for one round, and returns the registered workers along with the ids
+		of the ones that are unavailable. This runs outside of the loop thread, so it is given
+		a copy of ``self.request_times``.
+		"""
+
+		workers = self._registered_workers()
+		return workers, self._evaluate(workers, request_times, datetime.utcnow())
+
+	def _request_usage(self, worker):
+		times = self.request_times.get(worker['worker_id'])
+		if times is None:
+			return
+
+		addr = (worker['address']['ip'], worker['address']['port'])
+		self.notifier.register(worker['worker_id'], addr)
+		self.notifier.notify(worker['worker_id'], format_message(resource_usage_request,
+			worker['request_token']))
+		times.append(datetime.utcnow())
+
+	async def _run(self):
+		period = self.period.total_seconds()
 
 		while True:
-			cur_time = datetime.now()
-			time.sleep(sleep_time)
-			start = timer()
-
-			"""
-			We need to use a lock here, so that we do not try to send a notification to
-			a worker before it has been registered with ``WorkerNotifier`` by the event
-			hook.
-			"""
-			with registered_workers_lock:
-				workers    = self.db.registered_workers.find()
-				worker_ids = set([worker['worker_id'] for worker in workers])
-
-				# Request newly-registered workers to send resource usage updates.
-				for _id in worker_ids - self.current_workers:
-					self._notify_worker(_id)
-
-				# Check that we have received updates from workers that have already
-				# been registered.
-				for _id in self.current_workers & worker_ids:
-					if not self._received_update(_id, cur_time):
-						# TODO cancel all tasks claimed by the worker
-					else:
-						self._notify_worker(_id)
-
-				self.current_workers = worker_ids
-
-			elapsed    = end() - start()
-			sleep_time = max(0, usage_update_poll_period - elapsed)
+			try:
+				request_times = {_id: list(t) for _id, t in self.request_times.items()}
+				workers, unavailable = await self.event_loop.run_blocking(self._check,
+					request_times)
+			except Exception as e:
+				self.log("Error checking worker availability: {}".format(repr(e)))
+				workers, unavailable = None, []
+
+			for _id in unavailable:
+				self.log("Worker '{}' did not respond to resource usage requests.".
+					format(_id))
+				self.notifier.unregister(_id)
+				self.recovery.worker_unreachable(_id)
+
+			if workers is not None:
+				workers = [w for w in workers if w['request_token'] is not None]
+				current = set(w['worker_id'] for w in workers)
+
+				self.request_times = {_id: self.request_times.get(_id, deque(maxlen=2))
+					for _id in current}
+
+				for i, worker in enumerate(workers):
+					self.event_loop.call_later(period * i / len(workers),
+						self._request_usage, worker)
+
+			await asyncio.sleep(period)
@@ -4,96 +4,128 @@
 banyan.server.worker_notifier
 -----------------------------
 
-Provides the event hooks that implement the server-side functionality.
+Maintains one TCP connection to each registered worker, over which the server sends the messages
+defined in ``notification_protocol.py``.
+
+Each connection is an ``asyncio`` stream on the loop provided by ``EventLoopThread``. Request
+threads never touch the connections: ``register``, ``unregister``, and ``notify`` schedule the
+corresponding operation on the loop, and return immediately.
+
+Each worker has a FIFO queue of messages, which is drained by a task that waits for the stream to
+accept each message before writing the next one (``StreamWriter.drain``), so a slow worker only
+holds up its own queue. Messages sent to a worker whose connection is still being established are
+queued. At most ``max_queued_messages`` messages are queued per worker; further messages are
+dropped until the worker catches up.
+
+If the connection to a worker cannot be established or fails while writing, the queued messages are
+dropped, and the worker is not contacted again for ``notice_retry_seconds``. This is not taken as a
+sign that the worker is gone: the messages are only hints (see ``dispatch.py``) or health checks,
+and a short network glitch should not cost the worker its running tasks. Whether a worker is
+unreachable is instead decided by ``WorkerAvailabilityChecker``, which notices missed health checks,
+and by the lease sweep (see ``recovery.py``).
 """
 
-import os
+import asyncio
 import sys
-import signalfd
-import socket
-import select
 
-from errno import EAGAIN, EWOULDBLOCK, ENOBUFS
-from signal import SIGHUP, SIGINT, SIGQUIT, SIGABRT, SIGTERM
-from signalfd import SFD_NONBLOCK, SFD_CLOEXEC, SIG_UNBLOCK
-from select import EPOLLIN, EPOLLOUT, EPOLLERR, EPOLLRDHUP, EPOLLHUP, EPOLLONESHOT, EPOLL_CLOEXEC
+from collections import deque
+from time import monotonic
 
-from flask import request
-from threading import Thread, Lock
-
-shutdown_signals = {SIGHUP, SIGINT, SIGQUIT, SIGABRT, SIGTERM}
-
-def close_connection(conn, how=socket.SHUT_RDWR):
-	"""
-	Closes ``conn`` after calling ``shutdown``, so that processes using the other end know that
-	we are no longer listening.
-	"""
-
-	if conn is None:
-		return
-
-	try:
-		conn.shutdown(how)
-	except:
-		pass
-
-	conn.close()
+from banyan.server.constants import notice_retry_seconds, max_queued_messages, \
+	worker_connect_timeout_seconds
 
 class WorkerQueue:
-	def __init__(self, _id, conn):
+	def __init__(self, _id, addr):
 		self._id              = _id
-		self.conn             = conn
-		self.msg_queue        = []
+		self.addr             = addr
+		self.msg_queue        = deque()
+		self.ready            = asyncio.Event()
 		self.pending_shutdown = False
+		self.task             = None
+
+	def __len__(self):
+		return len(self.msg_queue)
+
+	def append(self, msg):
+		if len(self.msg_queue) >= max_queued_messages:
+			return False
 
-	def apppend(self, msg):
 		self.msg_queue.append(msg)
+		self.ready.set()
+		return True
 
-	def drain(self):
+	def shutdown(self):
+		self.pending_shutdown = True
+		self.ready.set()
+
+	async def drain(self, writer):
 		"""
-		Sends as many messages as possible before the socket would block again. Returns the
-		length of the internal message queue after this process.
+		Writes the queued messages in order, until the queue is empty and ``shutdown`` has been
+		called.
 		"""
 
-		while len(self) != 0:
-			msg = self.msg_queue[-1]
+		while True:
+			if len(self.msg_queue) == 0:
+				if self.pending_shutdown:
+					return
 
-			try:
-				self.conn.send(msg)
-			except OSError as e:
-				if e.errno in {EAGAIN, EWOULDBLOCK, ENOBUFS}:
-					return len(self.msg_queue)
-				raise
+				self.ready.clear()
+				await self.ready.wait()
+				continue
 
-			self.msg_queue.pop()
-		return 0
+			writer.write(self.msg_queue.popleft())
+			await writer.drain()
+
+async def wait_for_hangup(reader):
+	"""
+	Returns once the worker closes its end of the connection. Workers do not send anything over
+	the connection, so anything that we read is discarded.
+	"""
+
+	while len(await reader.read(4096)) != 0:
+		pass
 
 class WorkerNotifier:
-	conn_event_bitmask = EPOLLOUT | EPOLLRDHUP | EPOLLONESHOT
+	"""
+	The ``_id`` arguments can be any hashable values that identify the workers; the server uses
+	the ids of the workers' ``users`` entries.
+	"""
 
-	def __init__(self):
-		signalfd.sigprocmask(SIG_UNBLOCK, shutdown_signals)
-		self.sig_fd = signalfd.signalfd(-1, shutdown_signals, SFD_CLOEXEC | SFD_NONBLOCK)
+	def __init__(self, event_loop):
+		"""
+		Args:
+			event_loop: The ``EventLoopThread`` on which the connections are managed.
+		"""
 
-		self.lock     = Lock()
-		self.fd_to_wq = {}
-		self.id_to_fd = {}
+		self.event_loop = event_loop
+
+		# The following are only accessed by the loop thread, except as noted.
+		self.id_to_wq = {}
+
+		"""
+		Maps the ids of the workers that we recently failed to reach to the times after which
+		we may try again.
+		"""
+		self.retry_times = {}
 
-		self.epoll = select.epoll(flags=EPOLL_CLOEXEC)
-		self.epoll.register(self.sig_fd, EPOLLIN)
-		Thread(target=self._poll_events).start()
+		"""
+		Replaced rather than modified, so that ``is_registered`` can read it from other
+		threads.
+		"""
+		self.registered_ids = frozenset()
 
-	def log(msg):
+	def log(self, msg):
 		print(msg, file=sys.stderr, flush=True)
 
-	def _id_to_wq(self, _id):
-		return self.fd_to_wq[self.id_to_fd[_id]]
+	def is_registered(self, _id):
+		return _id in self.registered_ids
 
 	def register(self, _id, addr):
 		"""
-		Registers a worker so that we can send notifications to it in the future. If a
-		worker with the given id is already registered with this queue, then a
-		``RuntimeError`` is raised.
+		Registers a worker so that we can send notifications to it in the future. The
+		connection is established asynchronously. Registering a worker that is already
+		registered has no effect, and so does registering a worker that we failed to reach
+		less than ``notice_retry_seconds`` ago.
 
 		Args:
 			_id: The id of the worker.
@@ -101,108 +133,104 @@ class WorkerNotifier:
 			id ``_id``.
 		"""
 
-		try:
-			conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			conn.connect(addr)
-			conn.setblocking(False)
+		self.event_loop.call(self._register, _id, addr)
 
-			with self.lock:
-				if _id in self.id_to_fd:
-					raise RuntimeError("Worker '{}' is already registered.".
-						format(_id))
+	def unregister(self, _id):
+		"""
+		Initiates the shutdown process for the message queue associated with the worker with
+		id ``_id``. The messages that were already queued are still sent.
+		"""
+
+		self.event_loop.call(self._unregister, _id)
 
-				self.epoll.register(conn, self.conn_event_bitmask)
-				fd = conn.fileno()
-				wq = WorkerQueue(_id, conn)
+	def notify(self, _id, msg):
+		"""
+		Queues ``msg`` to be sent to the worker with id ``_id``. The message is dropped if the
+		worker is not registered or is being unregistered by the time the loop processes it.
+		"""
 
-				self.id_to_fd[_id] = fd
-				self.fd_to_wq[fd] = wq
-		except:
-			close_connection(conn)
-			raise
+		self.event_loop.call(self._notify, _id, msg)
 
-	def unregister(self, _id):
+	def close(self):
 		"""
-		Initiates the shutdown process for the message queue associated with the worker with
-		id ``_id``.
+		Closes all connections.
 		"""
 
-		with self.lock:
-			if _id not in self.id_to_fd:
-				return
+		self.event_loop.call(self._close)
 
-			wq = self._id_to_wq(id)
-			wq.pending_shutdown = True
-			self.epoll.modify(wq.conn, self.conn_event_bitmask)
+	def _update_registered_ids(self):
+		self.registered_ids = frozenset(_id for _id, wq in self.id_to_wq.items()
+			if not wq.pending_shutdown)
 
-	def notify(self, _id, msg):
-		with self.lock:
-			if _id not in self.id_to_fd or self._id_to_wq(_id).pending_shutdown:
-				return False
+	def _register(self, _id, addr):
+		if _id in self.id_to_wq or self.retry_times.get(_id, 0) > monotonic():
+			return
 
-			wq = self._id_to_wq(_id)
-			wq.append(msg)
-			self.epoll.modify(wq.conn, self.conn_event_bitmask)
+		wq = WorkerQueue(_id, addr)
+		wq.task = self.event_loop.spawn(self._serve(wq))
+		self.id_to_wq[_id] = wq
+		self._update_registered_ids()
 
-	def _shutdown_queue(self, wq):
-		close_connection(wq.conn)
-		self.fd_to_wq.pop(wq.conn.fileno())
-		self.id_to_fd.pop(wq._id)
+	def _unregister(self, _id):
+		wq = self.id_to_wq.get(_id)
+		if wq is None or wq.pending_shutdown:
+			return
 
-	def _check_queue(self, fd, event):
-		if event & (EPOLLOUT | EPOLLERR | EPOLLRDHUP | EPOLLHUP):
-			wq = self.fd_to_wq[fd]
-			assert fd == wq.conn.fileno()
+		wq.shutdown()
+		self._update_registered_ids()
 
-			try:
-				rem = wq.drain()
-			except OSError as e:
-				self.log("Error notifying worker '{}': {}".format(wq._id, repr(e)))
-				self._shutdown_queue(wq)
-				# TODO cancel all tasks claimed by this worker
-
-			if rem == 0 and not wq.pending_shutdown:
-				return
-			elif rem == 0 and wq.pending_shutdown:
-				self._shutdown_queue(wq)
-			elif rem != 0:
-				self.epoll.modify(fd, self.conn_event_bitmask)
-		else:
-			self.log("Unexpected event {:#x} for connection FD.".format(event))
+	def _notify(self, _id, msg):
+		wq = self.id_to_wq.get(_id)
+		if wq is None or wq.pending_shutdown:
 			return
 
-	def _shutdown(self):
-		self.epoll.close()
-		os.close(self.sig_fd)
+		if not wq.append(msg):
+			self.log("Dropped message for worker '{}', whose queue is full.".format(_id))
 
-		for wq in self.fd_to_wq.values():
-			close_connection(wq.conn)
+	def _close(self):
+		for wq in list(self.id_to_wq.values()):
+			wq.task.cancel()
 
-		request.environ.get('werkzeug.server.shutdown')()
+	async def _serve(self, wq):
+		"""
+		Connects to the worker, and sends the queued messages until the queue is shut down or
+		the connection fails.
+		"""
 
-	def _check_signal(self, event):
-		if event & EPOLLIN:
-			info = signalfd.read_siginfo(self.sig_fd)
-			sig = info.ssi_signo
+		writer = None
+		failed = True
 
-			if sig not in shutdown_signals:
-				self.log("Unexpected signal {}.".format(sig))
-			else:
-				self.log("Terminated by signal {}.".format(sig))
-				self._shutdown()
-		else:
-			self.log("Unexpected event {:#x} for signal FD.".format(event))
-
-	def _process_event(self, fd, event):
-		if fd in self.fd_to_wq:
-			self._check_queue(fd, event)
-		elif fd == self.sig_fd:
-			self._check_signal(event)
-
-	def _poll_events(self):
-		while True:
-			events = self.epoll.poll()
+		try:
+			reader, writer = await asyncio.wait_for(asyncio.open_connection(*wq.addr),
+				worker_connect_timeout_seconds)
 
-			with self.lock:
-				for fd, event in events:
-					self._process_event(fd, event)
+			drain  = self.event_loop.spawn(wq.drain(writer))
+			hangup = self.event_loop.spawn(wait_for_hangup(reader))
+
+			try:
+				await asyncio.wait([drain, hangup], return_when=asyncio.FIRST_COMPLETED)
+			finally:
+				drain.cancel()
+				hangup.cancel()
+
+			# A connection reset reported by the reader is treated as a hangup.
+			if hangup.done() and not hangup.cancelled():
+				hangup.exception()
+
+			if drain.done() and not drain.cancelled():
+				# Raises the exception if writing failed.
+				drain.result()
+				failed = False
+			else:
+				self.log("Worker '{}' closed its connection.".format(wq._id))
+		except (OSError, asyncio.TimeoutError) as e:
+			self.log("Error notifying worker '{}': {}".format(wq._id, repr(e)))
+		finally:
+			if writer is not None:
+				writer.close()
+
+			if failed:
+				self.retry_times[wq._id] = monotonic() + notice_retry_seconds
+
+			self.id_to_wq.pop(wq._id, None)
+			self._update_registered_ids()
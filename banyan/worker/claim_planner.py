@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.claim_planner
+---------------------------
+
+Decides which of the cached tasks the worker should claim, so that they can all run at the same time
+using the free resources of the worker. Memory, cores, and GPUs are consumed by each task that is
+selected, whereas the GPU memory and compute capability describe each of the free GPUs, so they only
+determine which tasks are eligible. Packing the tasks is a multi-dimensional knapsack problem, so we
+use one of the following heuristics, selected by ``claim_strategy`` in ``settings.py``:
+
+- ``first_fit_decreasing``: Considers the tasks in order of decreasing GPU count, core count, and
+  memory, and selects each one that still fits. This is the strategy described in
+  ``notes/worker.md``.
+- ``dominant_resource``: Considers the tasks in order of decreasing dominant share, i.e. the largest
+  fraction of any one of the free resources that they require, as in dominant resource fairness.
+  Tasks that would exhaust a scarce resource are placed first, so that they are not starved by
+  smaller tasks that use the same resource.
+- ``best_fit``: Repeatedly selects the task that fills the remaining resources the most, with each
+  resource weighted by the inverse of the amount that remains. Resources that are almost exhausted
+  therefore dominate the choice, which tends to leave fewer resources stranded.
+
+The planner only deals with ``Demand`` and ``FreeResources`` tuples, which are computed by
+``TaskCache`` (see ``task_cache.py``), so it can be used without the rest of the worker by
+``bench/bench_planner.py``.
+"""
+
+from collections import namedtuple
+
+"""
+Resources required by a task. ``gpu_memory_bytes`` and ``gpu_compute_capability`` are the
+requirements for each of the GPUs used by the task, and the latter is a ``(major, minor)`` pair, or
+``None`` if the task does not have any requirements.
+"""
+Demand = namedtuple('Demand', ['task_id', 'memory_bytes', 'cpu_cores', 'gpus',
+	'gpu_memory_bytes', 'gpu_compute_capability'])
+
+FreeResourcesBase = namedtuple('FreeResourcesBase', ['memory_bytes', 'cpu_cores', 'gpus',
+	'gpu_memory_bytes', 'gpu_compute_capability'])
+
+class FreeResources(FreeResourcesBase):
+	"""
+	Free resources of the worker. ``gpu_memory_bytes`` and ``gpu_compute_capability`` describe
+	the weakest GPU of the worker, and are ``None`` if they are unknown, in which case the
+	corresponding requirements of the tasks are not checked.
+	"""
+
+	def __new__(cls, memory_bytes=0, cpu_cores=0, gpus=0, gpu_memory_bytes=None,
+		gpu_compute_capability=None):
+
+		return super().__new__(cls, memory_bytes, cpu_cores, gpus, gpu_memory_bytes,
+			gpu_compute_capability)
+
+def fits(demand, free):
+	"""
+	Returns whether a task with the given ``Demand`` fits in ``free``. This applies the same
+	constraints as ``task_fits`` in ``banyan/server/claims.py``.
+	"""
+
+	if demand.memory_bytes > free.memory_bytes or demand.cpu_cores > free.cpu_cores or \
+		demand.gpus > free.gpus:
+		return False
+
+	if free.gpu_memory_bytes is not None and \
+		demand.gpu_memory_bytes > free.gpu_memory_bytes:
+		return False
+
+	if free.gpu_compute_capability is not None and \
+		demand.gpu_compute_capability is not None and \
+		demand.gpu_compute_capability > free.gpu_compute_capability:
+		return False
+
+	return True
+
+def subtract(free, demand):
+	return free._replace(memory_bytes=free.memory_bytes - demand.memory_bytes,
+		cpu_cores=free.cpu_cores - demand.cpu_cores, gpus=free.gpus - demand.gpus)
+
+def fraction(used, available):
+	return used / available if available != 0 else 0.
+
+def pack(demands, free, key):
+	"""
+	Considers the tasks in order of decreasing ``key``, and selects each one that still fits.
+	Returns the ids of the selected tasks.
+	"""
+
+	selected = []
+
+	for demand in sorted(demands, key=key, reverse=True):
+		# A task that requests no cores still needs a core that is not reserved.
+		if free.cpu_cores == 0:
+			break
+
+		if fits(demand, free):
+			selected.append(demand.task_id)
+			free = subtract(free, demand)
+
+	return selected
+
+def first_fit_decreasing(demands, free):
+	return pack(demands, free, key=lambda d: (d.gpus, d.cpu_cores, d.memory_bytes))
+
+def dominant_resource(demands, free):
+	def dominant_share(d):
+		return max(fraction(d.memory_bytes, free.memory_bytes),
+			fraction(d.cpu_cores, free.cpu_cores), fraction(d.gpus, free.gpus))
+
+	return pack(demands, free, key=dominant_share)
+
+def best_fit(demands, free):
+	def fill(d):
+		return fraction(d.memory_bytes, free.memory_bytes) + \
+			fraction(d.cpu_cores, free.cpu_cores) + fraction(d.gpus, free.gpus)
+
+	candidates = [d for d in demands if fits(d, free)]
+	selected   = []
+
+	while free.cpu_cores != 0 and len(candidates) != 0:
+		best = max(candidates, key=fill)
+		selected.append(best.task_id)
+		free = subtract(free, best)
+		candidates = [d for d in candidates if d is not best and fits(d, free)]
+
+	return selected
+
+strategies = {
+	'first_fit_decreasing': first_fit_decreasing,
+	'dominant_resource': dominant_resource,
+	'best_fit': best_fit
+}
+
+def plan(demands, free, strategy='first_fit_decreasing'):
+	"""
+	Returns the ids of the tasks to claim, in the order in which they were selected.
+
+	Args:
+		demands: List of the ``Demand`` of each candidate task. Ties are broken in favor of
+			the tasks that come first.
+		free: ``FreeResources`` of the worker.
+		strategy: Name of one of the ``strategies``.
+	"""
+
+	return strategies[strategy](demands, free)
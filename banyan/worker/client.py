@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.client
+--------------------
+
+HTTP client used by the worker to communicate with the server. Requests are sent from a pool of
+``client_threads`` threads, and each method returns a ``concurrent.futures.Future`` for the
+response, so the main loop of the worker (see ``run.py``) never waits for the network. Each thread
+of the pool keeps its own ``requests.Session``, whose connections to the server are kept alive
+between requests.
+"""
+
+import json
+import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from banyan.common import authorization_key, make_url
+from banyan.worker.settings import client_threads, request_timeout_seconds
+
+class ServerClient:
+	def __init__(self, entry_point, token):
+		self.entry_point = entry_point
+		self.headers     = {
+			'Content-Type': 'application/json',
+			'Authorization': 'Basic ' + authorization_key(token)
+		}
+
+		self.pool  = ThreadPoolExecutor(max_workers=client_threads)
+		self.local = threading.local()
+
+	def _session(self):
+		session = getattr(self.local, 'session', None)
+
+		if session is None:
+			session = requests.Session()
+			session.headers.update(self.headers)
+			self.local.session = session
+		return session
+
+	def _request(self, method, url, doc):
+		return self._session().request(method, url, data=json.dumps(doc),
+			timeout=request_timeout_seconds)
+
+	def post(self, doc, resource, item=None, virtual_subresource=None):
+		url = make_url(self.entry_point, resource, item, virtual_subresource)
+		return self.pool.submit(self._request, 'POST', url, doc)
+
+	def patch(self, update, resource, item, virtual_subresource=None):
+		url = make_url(self.entry_point, resource, item, virtual_subresource)
+		return self.pool.submit(self._request, 'PATCH', url, update)
+
+	def close(self):
+		self.pool.shutdown(wait=False)
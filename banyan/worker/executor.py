@@ -5,10 +5,22 @@ banyan.worker.executor
 ----------------------
 
 Agent responsible for managing tasks and providing cumulative resource utilization information.
+
+The exits of the tasks are detected using an ``ExitWatcher`` when pidfds are supported, so ``poll``
+only calls ``Task.status`` for the tasks that have exited, and for the ones that are waiting to be
+killed after being sent SIGTERM. Otherwise, ``poll`` calls ``Task.status`` once for each running
+task. The tasks in ``running`` have not been reaped, so their processes still exist, even if they
+have exited since the last call to ``poll``.
+
+The usage of the running tasks is served from the latest sample taken by ``UsageSampler``, which
+covers the whole process tree of each task.
 """
 
+from banyan.worker.exit_watcher import make_exit_watcher
 from banyan.worker.resource_info import ResourceSummary
+from banyan.worker.settings import usage_sample_period_ms
 from banyan.worker.task import ResourceUsage
+from banyan.worker.usage_sampler import UsageSampler
 
 class Executor:
 	def __init__(self, resource_set):
@@ -16,26 +28,82 @@ class Executor:
 		self.running      = []
 		self.terminated   = []
 
+		self.exits   = make_exit_watcher()
+		self.sampler = UsageSampler(usage_sample_period_ms / 1000)
+
+		# Tasks whose exits are not reported by ``exits``, because their pidfds could not be
+		# opened (e.g. because we ran out of file descriptors).
+		self.unwatched = []
+
+	def fileno(self):
+		"""
+		Returns a file descriptor that becomes readable when a task exits, or ``None`` if exits
+		are not watched, in which case ``poll`` must be called periodically.
+		"""
+
+		return self.exits.fileno() if self.exits is not None else None
+
 	def submit(self, task):
 		task.run(self.resource_set)
 		self.running.append(task)
+		self.sampler.watch(task.proc.pid)
+
+		if self.exits is None:
+			return
+
+		try:
+			self.exits.add(task.proc.pid, task)
+		except OSError:
+			self.unwatched.append(task)
 
 	def poll(self):
 		"""
 		Updates the ``running`` and ``terminated`` task lists.
 		"""
 
-		new_running = [t for t in self.running if t.status() is None]
-		self.terminated.extend([t for t in self.running if t.status() is not None])
-		self.running = new_running
+		if self.exits is None:
+			exited = [t for t in self.running if t.status() is not None]
+		else:
+			"""
+			This sends SIGKILL to the tasks that have not exited in time after SIGTERM. It is
+			done first, since ``status`` reaps the tasks that have exited, and the exits of
+			these tasks must then be reported below.
+			"""
+			for t in self.running:
+				if t.waiting_for_sigterm:
+					t.status()
+
+			exited = self.exits.exited()
+			for t in exited:
+				# This reaps the process, which is known to have exited.
+				assert t.status() is not None
+
+			exited += [t for t in self.unwatched if t.status() is not None]
+
+		if len(exited) == 0:
+			return
+
+		for t in exited:
+			self.sampler.unwatch(t.proc.pid)
+
+		done = set(exited)
+		self.running    = [t for t in self.running if t not in done]
+		self.unwatched  = [t for t in self.unwatched if t not in done]
+		self.terminated.extend(exited)
 
 	def usage(self):
 		"""
 		Returns the sum of the resources used by all running tasks.
 		"""
 
-		return sum([t.usage() for t in self.running if t.status() is None],
-			ResourceUsage())
+		return sum([self.task_usage(t) for t in self.running], ResourceUsage())
+
+	def task_usage(self, task):
+		"""
+		Returns the resources used by the processes of ``task``, which must be running.
+		"""
+
+		return self.sampler.usage(task.proc.pid)
 
 	def resources_claimed(self):
 		"""
@@ -50,10 +118,7 @@ class Executor:
 		claimed_gpus   = 0
 
 		for task in self.running:
-			if task.status() is not None:
-				continue
-
-			usage = task.usage()
+			usage = self.task_usage(task)
 			reserved = task.reserved_resources
 
 			claimed_memory = claimed_memory + max(reserved.memory_bytes,
@@ -83,7 +148,7 @@ class Executor:
 		assert claimed.gpus <= self.resource_set.gpus
 
 		return ResourceSummary(
-			max(0, claimed.memory_bytes - self.resource_set.memory_bytes),
+			max(0, self.resource_set.memory_bytes - claimed.memory_bytes),
 			self.resource_set.cpu_cores - claimed.cpu_cores,
 			self.resource_set.gpus - claimed.gpus
 		)
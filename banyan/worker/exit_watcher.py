@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.exit_watcher
+--------------------------
+
+Detects the exits of child processes without polling each of them. A pidfd (see ``pidfd_open(2)``)
+is opened for each process and registered with an epoll instance, and becomes readable once the
+process exits. Finding the processes that have exited therefore costs one ``epoll_wait`` call, plus
+constant work for each exit, however many processes are running. The epoll instance can itself be
+waited upon (e.g. using ``selectors``), so that exits are acted upon as soon as they happen.
+
+A pidfd can be opened for a process that has exited but has not been reaped yet, so there is no race
+with processes that exit right after they are started. The processes are still reaped by
+``Popen.poll``, which is only called for the processes that are known to have exited.
+"""
+
+import os
+import select
+
+class ExitWatcher:
+	def __init__(self):
+		self.epoll  = select.epoll()
+		self.pidfds = {}
+
+	def fileno(self):
+		return self.epoll.fileno()
+
+	def add(self, pid, obj):
+		"""
+		Starts watching the process with id ``pid``. ``obj`` is returned by ``exited`` once the
+		process exits. Raises ``OSError`` if the pidfd cannot be opened.
+		"""
+
+		fd = os.pidfd_open(pid)
+		self.epoll.register(fd, select.EPOLLIN)
+		self.pidfds[fd] = obj
+
+	def exited(self):
+		"""
+		Returns the objects associated with the processes that have exited since the last call,
+		and stops watching them.
+		"""
+
+		result = []
+
+		for fd, _ in self.epoll.poll(0):
+			result.append(self.pidfds.pop(fd))
+			self.epoll.unregister(fd)
+			os.close(fd)
+
+		return result
+
+	def close(self):
+		for fd in self.pidfds:
+			os.close(fd)
+
+		self.pidfds.clear()
+		self.epoll.close()
+
+def make_exit_watcher():
+	"""
+	Returns an ``ExitWatcher``, or ``None`` if pidfds are not supported (they require Linux 5.3
+	and Python 3.9).
+	"""
+
+	if not hasattr(os, 'pidfd_open') or not hasattr(select, 'epoll'):
+		return None
+
+	try:
+		os.close(os.pidfd_open(os.getpid()))
+	except OSError:
+		return None
+
+	return ExitWatcher()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.notices
+---------------------
+
+Receives the notifications sent by the server (see ``notification_protocol.py``). Each server
+process that has something to tell the worker connects to the address at which the worker was
+registered, and keeps the connection open (see ``WorkerNotifier``). The connections are read by a
+background thread, and the messages are handed to the main loop of the worker through a queue. A
+byte is also written to a pipe for each message, so that the main loop can wait for messages along
+with other events, using the file descriptor returned by ``fileno``.
+"""
+
+import os
+import queue
+import select
+import selectors
+import socket
+import sys
+
+from threading import Thread
+
+from banyan.notification_protocol import msg_len, parse_message, ProtocolError
+
+class NoticeListener:
+	def __init__(self, port, request_token):
+		self.request_token = request_token
+		self.messages      = queue.Queue()
+		self.buffers       = {}
+
+		self.wakeup_r, self.wakeup_w = os.pipe()
+		os.set_blocking(self.wakeup_r, False)
+		os.set_blocking(self.wakeup_w, False)
+
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(('', port))
+		self.listener.listen(socket.SOMAXCONN)
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.listener, selectors.EVENT_READ)
+
+		Thread(target=self._run, daemon=True).start()
+
+	def log(self, msg):
+		print(msg, file=sys.stderr, flush=True)
+
+	def _wake(self):
+		try:
+			os.write(self.wakeup_w, b'\0')
+		except BlockingIOError:
+			# The pipe is full, so the main loop will be woken up anyway.
+			pass
+
+	def _close(self, conn):
+		self.selector.unregister(conn)
+		self.buffers.pop(conn, None)
+		conn.close()
+
+	def _read(self, conn):
+		try:
+			data = conn.recv(4096)
+		except OSError:
+			data = b''
+
+		if len(data) == 0:
+			self._close(conn)
+			return
+
+		buf = self.buffers[conn] + data
+
+		while len(buf) >= msg_len:
+			try:
+				token, msg_type, msg_data = parse_message(buf[:msg_len])
+			except (ProtocolError, UnicodeDecodeError) as e:
+				self.log("Closing connection after malformed message: {}".format(repr(e)))
+				self._close(conn)
+				return
+
+			buf = buf[msg_len:]
+
+			# Messages that are not from the server are ignored.
+			if token == self.request_token:
+				self.messages.put((msg_type, msg_data))
+				self._wake()
+
+		self.buffers[conn] = buf
+
+	def _run(self):
+		while True:
+			for key, _ in self.selector.select():
+				if key.fileobj is self.listener:
+					conn, _ = self.listener.accept()
+					self.selector.register(conn, selectors.EVENT_READ)
+					self.buffers[conn] = b''
+				else:
+					self._read(key.fileobj)
+
+	def fileno(self):
+		return self.wakeup_r
+
+	def take(self):
+		"""
+		Returns the messages that have been received, without waiting.
+		"""
+
+		# The pipe is drained first, so that a message queued after we return still wakes
+		# up the main loop.
+		try:
+			while len(os.read(self.wakeup_r, 4096)) != 0:
+				pass
+		except BlockingIOError:
+			pass
+
+		messages = []
+
+		while True:
+			try:
+				messages.append(self.messages.get_nowait())
+			except queue.Empty:
+				return messages
+
+	def wait(self, timeout):
+		"""
+		Returns the messages that have been received, waiting for at most ``timeout`` seconds
+		for the first one.
+		"""
+
+		select.select([self.wakeup_r], [], [], timeout)
+		return self.take()
@@ -89,3 +89,19 @@ def total_resources():
 	avail_gpus = max(0, total_gpus - usage_limits['gpus']['min_unused_count'])
 
 	return ResourceSummary(memory_bytes=usable_memory, cpu_cores=avail_cores, gpus=avail_gpus)
+
+def gpu_capabilities():
+	"""
+	Returns the memory and compute capability of the weakest GPU on this machine, as a pair in
+	which the compute capability is a ``(major, minor)`` pair. Returns ``(None, None)`` if the
+	machine does not have any GPUs. The GPUs are treated as interchangeable, so a task whose
+	requirements are met by the weakest GPU can run on any of them.
+	"""
+
+	if len(gpu_info.gpus) == 0:
+		return None, None
+
+	memory = min(gpu['total_memory_bytes'] for gpu in gpu_info.gpus)
+	cc     = min((gpu['compute_capability'].major, gpu['compute_capability'].minor)
+		for gpu in gpu_info.gpus)
+	return memory, cc
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.run
+-----------------
+
+Starts a worker. The worker must already have been registered with the server by a provider, using
+the address and port given to this program, so that the server can send it notifications.
+
+The main loop follows the procedure described in ``notes/worker.md``. Each iteration only does local
+work: it polls the executor, starts requests to the server, and handles the responses to the
+requests that have completed. The requests are sent by ``ServerClient`` from a pool of threads, so a
+slow claim or report never delays the detection of terminated tasks, or the escalation from SIGTERM
+to SIGKILL in ``Task.status``. At most one request of each kind that concerns the whole worker
+(cache refresh, claim, and lease renewal) is outstanding at any time.
+
+Between iterations, the loop waits for a notification from the server (received in the background
+by ``NoticeListener``) or for a task to exit (see ``exit_watcher.py``), for at most
+``task_poll_period`` milliseconds. Both are therefore acted upon right away. The task cache is
+refreshed incrementally (see ``task_cache.py``), so a ``tasks_available_notice`` is cheap to act
+upon.
+"""
+
+import selectors
+import signal
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from requests import RequestException
+from time import monotonic
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '../..'))
+
+from banyan.common import EntryPoint
+from banyan.worker.claim_planner import FreeResources, plan
+from banyan.notification_protocol import cancellation_notice, deregistration_notice, \
+	resource_usage_request, tasks_available_notice
+from banyan.worker.client import ServerClient
+from banyan.worker.executor import Executor
+from banyan.worker.notices import NoticeListener
+from banyan.worker.task import Task, normalize_request
+from banyan.worker.task_cache import TaskCache
+from banyan.worker.settings import task_cache_size, task_cache_update_period_ms, \
+	task_cache_full_refresh_period_ms, task_poll_period, lease_renewal_period_ms, claim_strategy
+import banyan.worker.resource_info as resource_info
+
+def format_date(dt):
+	"""
+	Formats a naive UTC ``datetime`` in the format expected by the server.
+	"""
+
+	return format_datetime(dt.replace(tzinfo=timezone.utc), usegmt=True)
+
+def exit_status(returncode):
+	if returncode == 0:
+		return 'success'
+	if returncode < 0:
+		return 'failure ({})'.format(signal.Signals(-returncode).name)
+	return 'failure'
+
+class ClaimedTask:
+	"""
+	What the worker knows about a task that it has claimed.
+	"""
+
+	def __init__(self, task_id, token, task):
+		self.task_id          = task_id
+		self.token            = token
+		self.task             = task
+		self.cancel_requested = False
+		self.lease_lost       = False
+
+class Worker:
+	def __init__(self, client, notices, worker_id):
+		self.client    = client
+		self.notices   = notices
+		self.worker_id = worker_id
+		self.executor  = Executor(resource_info.total_resources())
+
+		self.gpu_memory_bytes, self.gpu_compute_capability = resource_info.gpu_capabilities()
+
+		# The available tasks that fit in our resource set, and the time returned by the server
+		# with the last refresh of the cache, which is passed back with the next one.
+		self.cache     = TaskCache(self.executor.resource_set, task_cache_size)
+		self.last_seen = None
+
+		# Maps the ``Task`` objects and execution tokens of the claimed tasks to their
+		# ``ClaimedTask`` objects.
+		self.claimed    = {}
+		self.by_token   = {}
+		self.unreported = []
+
+		# Pairs of outstanding requests and the functions that handle their responses.
+		self.requests = []
+		self.busy     = set()
+
+		self.next_refresh      = 0
+		self.next_full_refresh = 0
+		self.next_renewal      = 0
+		self.draining          = False
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.notices, selectors.EVENT_READ)
+		if self.executor.fileno() is not None:
+			self.selector.register(self.executor, selectors.EVENT_READ)
+
+	def log(self, msg):
+		print(msg, file=sys.stderr, flush=True)
+
+	def _send(self, kind, future, handler):
+		"""
+		Registers ``handler`` to be called by the main loop with the response to ``future``.
+		If ``kind`` is not ``None``, then no other request of the same kind is sent until this
+		one completes.
+		"""
+
+		if kind is not None:
+			self.busy.add(kind)
+		self.requests.append((kind, future, handler))
+
+	def _handle_responses(self):
+		pending = []
+
+		for kind, future, handler in self.requests:
+			if not future.done():
+				pending.append((kind, future, handler))
+				continue
+
+			self.busy.discard(kind)
+
+			try:
+				resp = future.result()
+			except RequestException as e:
+				self.log("Request to server failed: {}".format(repr(e)))
+				resp = None
+
+			try:
+				handler(resp)
+			except ValueError as e:
+				self.log("Malformed response from server: {}".format(repr(e)))
+
+		self.requests = pending
+
+	def total_resources(self):
+		total = self.executor.resource_set
+		resources = {
+			'memory_bytes': total.memory_bytes,
+			'cpu_cores': total.cpu_cores,
+			'gpus': total.gpus
+		}
+
+		if self.gpu_memory_bytes is not None:
+			resources['gpu_memory_bytes'] = self.gpu_memory_bytes
+			resources['gpu_compute_capability_major'] = self.gpu_compute_capability[0]
+			resources['gpu_compute_capability_minor'] = self.gpu_compute_capability[1]
+		return resources
+
+	def free_resources(self):
+		free = self.executor.resources_unclaimed()
+		return FreeResources(free.memory_bytes, free.cpu_cores, free.gpus,
+			self.gpu_memory_bytes, self.gpu_compute_capability)
+
+	def _handle_notices(self):
+		for msg_type, data in self.notices.take():
+			if msg_type == tasks_available_notice:
+				self.next_refresh = 0
+			elif msg_type == cancellation_notice:
+				claimed = self.by_token.get(data)
+				if claimed is not None:
+					claimed.cancel_requested = True
+					claimed.task.cancel()
+			elif msg_type == resource_usage_request:
+				self._report_usage()
+			elif msg_type == deregistration_notice:
+				self.log("Unregistered by the server; no more tasks will be claimed.")
+				self.draining = True
+
+	def _refresh_cache(self):
+		"""
+		Requests the available tasks that fit in our resource set, rather than in the free
+		resources, so that the tasks that do not fit yet are already in the cache once they do.
+		After the first refresh, only the tasks that have been updated since the previous one
+		are requested, along with the ids of the cached tasks that are no longer available.
+		The cache is rebuilt every ``task_cache_full_refresh_period_ms``, since changes to the
+		effective priorities of the tasks (see ``fair_share.py``) are not picked up otherwise.
+		"""
+
+		if 'refresh' in self.busy or self.draining or monotonic() < self.next_refresh:
+			return
+
+		self.next_refresh = monotonic() + task_cache_update_period_ms / 1000
+		request = {'resources': self.total_resources(), 'max_count': task_cache_size}
+		full    = self.last_seen is None or monotonic() >= self.next_full_refresh
+
+		if full:
+			self.next_full_refresh = monotonic() + task_cache_full_refresh_period_ms / 1000
+		else:
+			request['updated_since'] = self.last_seen
+			if len(self.cache) != 0:
+				request['cached'] = self.cache.ids()
+
+		def handle(resp):
+			if resp is None or resp.status_code != 200:
+				return
+
+			body = resp.json()
+
+			if full:
+				self.cache.clear()
+			else:
+				for task_id in body['withdrawn']:
+					self.cache.remove(task_id)
+
+			for task in body['tasks']:
+				self.cache.add(task)
+			self.last_seen = body['as_of']
+
+		self._send('refresh', self.client.post(request, 'tasks', 'available_for'), handle)
+
+	def _select(self):
+		"""
+		Selects the cached tasks to claim using ``claim_strategy`` (see ``claim_planner.py``),
+		and removes them from the cache. The cache is first checked for a task that fits, so
+		that the planner is not run when nothing fits, which is usually the case while the
+		worker is busy.
+		"""
+
+		free = self.free_resources()
+
+		# A task that requests no cores still needs a core that is not reserved.
+		if free.cpu_cores == 0 or self.cache.largest_fitting(free) is None:
+			return []
+
+		selected = plan(self.cache.demands(), free, claim_strategy)
+
+		for task_id in selected:
+			self.cache.remove(task_id)
+		return selected
+
+	def _claim_tasks(self):
+		if 'claim' in self.busy or self.draining or len(self.cache) == 0:
+			return
+
+		selected = self._select()
+		if len(selected) == 0:
+			return
+
+		def handle(resp):
+			# A refresh made while the claim was outstanding may have added the tasks back.
+			for task_id in selected:
+				self.cache.remove(task_id)
+
+			if resp is None or resp.status_code != 200:
+				return
+
+			for result in resp.json()['claimed']:
+				self._start(result)
+
+			# Other workers may have claimed some of the tasks first.
+			if len(resp.json()['unclaimed']) != 0:
+				self.next_refresh = 0
+
+		self._send('claim', self.client.post([{'targets': selected,
+			'values': {'worker_id': self.worker_id}}], 'tasks', 'claim'), handle)
+
+	def _start(self, result):
+		requested = normalize_request(result.get('requested_resources', {}))
+		task = Task(result['command'], requested,
+			float(result.get('estimated_runtime_milliseconds', 0)) / 1000,
+			float(result.get('max_shutdown_time_milliseconds', 0)) / 1000)
+
+		try:
+			self.executor.submit(task)
+		except Exception as e:
+			# We never renew the lease of the task, so the server eventually reclaims it.
+			self.log("Failed to start task '{}': {}".format(result['_id'], repr(e)))
+			return
+
+		claimed = ClaimedTask(result['_id'], result['token'], task)
+		self.claimed[task] = claimed
+		self.by_token[result['token']] = claimed
+
+	def _report_terminated(self):
+		while len(self.executor.terminated) != 0:
+			task    = self.executor.terminated.pop(0)
+			claimed = self.claimed.pop(task)
+			self.by_token.pop(claimed.token)
+
+			# The server has already reclaimed tasks whose leases were lost.
+			if not claimed.lease_lost:
+				self.unreported.append(claimed)
+
+		unreported, self.unreported = self.unreported, []
+
+		for claimed in unreported:
+			task = claimed.task
+			update = {
+				'state': 'cancelled' if claimed.cancel_requested else 'terminated',
+				'update_execution_data': {
+					'exit_status': exit_status(task.proc.returncode),
+					'time_terminated': format_date(task.time_terminated),
+					'token': claimed.token
+				}
+			}
+
+			def handle(resp, claimed=claimed):
+				# Reports that failed because of the network or the server are retried.
+				if resp is None or resp.status_code >= 500:
+					self.unreported.append(claimed)
+				elif resp.status_code != 200:
+					self.log("Report for task '{}' was rejected: {}".format(
+						claimed.task_id, resp.text))
+
+			self._send(None, self.client.patch(update, 'tasks', claimed.task_id), handle)
+
+	def _report_usage(self):
+		now = format_date(datetime.utcnow())
+
+		for claimed in self.claimed.values():
+			usage = self.executor.task_usage(claimed.task)
+			update = {
+				'token': claimed.token,
+				'last_update': now,
+				'memory': {
+					'resident_memory_bytes': usage.resident_memory_bytes,
+					'virtual_memory_bytes': usage.virtual_memory_bytes
+				},
+				'cpu_usage': {'utilization_percent': float(usage.cpu_utilization_percent)}
+			}
+
+			self._send(None, self.client.patch(update, 'tasks', claimed.task_id,
+				'update_execution_data'), lambda resp: None)
+
+	def _renew_leases(self):
+		if 'renewal' in self.busy or len(self.claimed) == 0 or \
+			monotonic() < self.next_renewal:
+			return
+
+		self.next_renewal = monotonic() + lease_renewal_period_ms / 1000
+		by_id = {c.task_id: c for c in self.claimed.values()}
+
+		def handle(resp):
+			if resp is None or resp.status_code != 200:
+				return
+
+			for task_id in resp.json()['lost']:
+				claimed = by_id[task_id]
+				self.log("Lost lease for task '{}'; stopping it.".format(task_id))
+				claimed.lease_lost = True
+				claimed.task.cancel()
+
+		self._send('renewal', self.client.post({'tasks': list(by_id)}, 'tasks',
+			'renew_leases'), handle)
+
+	def shutdown(self):
+		"""
+		Cancels the running tasks. Their terminations are reported by the main loop.
+		"""
+
+		self.draining = True
+		for claimed in self.claimed.values():
+			claimed.task.cancel()
+
+	def done(self):
+		return self.draining and len(self.claimed) == 0 and len(self.unreported) == 0 and \
+			len(self.requests) == 0
+
+	def run(self):
+		while not self.done():
+			self._handle_responses()
+			self._refresh_cache()
+			self._claim_tasks()
+			self.executor.poll()
+			self._report_terminated()
+			self._renew_leases()
+
+			self.selector.select(task_poll_period / 1000)
+			self._handle_notices()
+
+def parse_args():
+	ap = ArgumentParser(description="Starts a Banyan worker.")
+	ap.add_argument('--server', default=None, help="IP address of the server. Defaults to "
+		"the address of this host.")
+	ap.add_argument('--worker-id', required=True, help="Id of the worker's user entry.")
+	ap.add_argument('--token', required=True, help="Token used to authenticate with the "
+		"server.")
+	ap.add_argument('--request-token', required=True, help="Token used by the server to "
+		"authenticate its notifications.")
+	ap.add_argument('--port', type=int, required=True, help="Port on which to receive "
+		"notifications from the server, as given at registration.")
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	client  = ServerClient(EntryPoint(args.server), args.token)
+	notices = NoticeListener(args.port, args.request_token)
+	worker  = Worker(client, notices, args.worker_id)
+
+	for signum in [signal.SIGTERM, signal.SIGINT]:
+		signal.signal(signum, lambda *args: worker.shutdown())
+
+	try:
+		worker.run()
+	finally:
+		client.close()
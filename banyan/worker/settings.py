@@ -20,5 +20,26 @@ task_cache_size = max_task_set_size
 # How often to refresh the local task cache.
 task_cache_update_period_ms = 10 * 1000
 
+# How often to rebuild the local task cache, instead of only fetching the tasks that have changed.
+task_cache_full_refresh_period_ms = 5 * 60 * 1000
+
+# Heuristic used to select the cached tasks to claim (see ``claim_planner.py``).
+claim_strategy = 'first_fit_decreasing'
+
 # How often the statuses of running tasks should be polled.
 task_poll_period = 1000
+
+# How often to sample the resources used by the running tasks (see ``usage_sampler.py``).
+usage_sample_period_ms = 1000
+
+"""
+How often to renew the leases of the running tasks. This should be well below the lease period of
+the server (``task_lease_seconds``), so that a lease is not lost if a renewal fails.
+"""
+lease_renewal_period_ms = 30 * 1000
+
+# Number of threads used to send requests to the server (see ``client.py``).
+client_threads = 8
+
+# Requests to the server that take longer than this are abandoned and retried later.
+request_timeout_seconds = 30
@@ -15,11 +15,11 @@ from datetime import datetime
 from timeit import default_timer as timer
 
 from subprocess import Popen, DEVNULL
-from psutil import Process
 
 from banyan.worker.resource_info import ResourceSummary
 
-ResourceUsageBase = namedtuple('ResourceUsageBase', ['resident_memory_bytes', 'cpu_cores', 'gpus'])
+ResourceUsageBase = namedtuple('ResourceUsageBase', ['resident_memory_bytes',
+	'virtual_memory_bytes', 'cpu_utilization_percent'])
 
 class ResourceUsage(ResourceUsageBase):
 	def __new__(cls, resident_memory_bytes=0, virtual_memory_bytes=0,
@@ -39,6 +39,17 @@ class ResourceUsage(ResourceUsageBase):
 				other.cpu_utilization_percent,
 		)
 
+def normalize_request(requested_resources):
+	"""
+	Returns a copy of the ``requested_resources`` field of a task received from the server, with
+	the default values from the server's schema filled in for the fields that are omitted.
+	"""
+
+	cores = dict({'count': 0, 'percent': 0.}, **requested_resources.get('cpu_cores', {}))
+	return dict(requested_resources, cpu_cores=cores,
+		cpu_memory_bytes=requested_resources.get('cpu_memory_bytes', 128 * 2 ** 20),
+		gpu_count=requested_resources.get('gpu_count', 0))
+
 def reserved_resources(requested_resources, resource_set):
 	"""
 	Given the ``requested_resources`` field associated with a given task, this function
@@ -84,30 +95,25 @@ class Task:
 		self.estimated_runtime   = estimated_runtime
 		self.max_shutdown_time   = max_shutdown_time
 		self.waiting_for_sigterm = False
+		self.time_terminated     = None
 
 	def run(self, resource_set):
 		self.proc = Popen(self.command, shell=True, stdout=DEVNULL, stderr=DEVNULL)
-		self.proc_info = Process(self.proc.pid)
-		self.time_started = datetime.now()
+		self.time_started = datetime.utcnow()
 		self.reserved_resources = reserved_resources(self.requested_resources, resource_set)
 
-		# When used asychronously, ``cpu_percent`` uses the time since
-		# the last call as the polling interval. Hence, the first call
-		# will always return 0. To ensure that ``usage`` reports useful
-		# information, we call this function in advance.
-		self.proc_info.cpu_percent()
-
 	def cancel(self):
-		if self.sent_sigterm:
+		if self.waiting_for_sigterm or self.proc.returncode is not None:
 			return
 
-		self.terminate()
+		self.proc.terminate()
 		self.sigterm_start = timer()
 		self.waiting_for_sigterm = True
 
 	def status(self):
 		if self.proc.poll() is not None:
-			self.time_terminated = datetime.now()
+			if self.time_terminated is None:
+				self.time_terminated = datetime.utcnow()
 			return self.proc.returncode
 
 		if not self.waiting_for_sigterm:
@@ -116,13 +122,3 @@ class Task:
 		if timer() - self.sigterm_start > self.max_shutdown_time:
 			self.proc.kill()
 			self.waiting_for_sigterm = False
-
-	def usage(self):
-		info = self.proc_info
-		mem = info.memory_info()
-
-		return ResourceUsage(
-			resident_memory_bytes=mem[0],
-			virtual_memory_bytes=mem[1],
-			cpu_utilization_percent=info.cpu_percent()
-		)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.task_cache
+------------------------
+
+Local cache of the available tasks that fit in the resource set of the worker (see
+``find_available_tasks`` in ``banyan/server/claims.py``). The cache is refreshed incrementally by
+the main loop of the worker (see ``run.py``): after the first request, only the tasks that have
+been updated since the previous request are fetched, and the tasks in the cache that are no longer
+available (e.g. because other workers have claimed them) are evicted.
+
+The tasks are grouped by shape, i.e. the memory, cores, and GPUs that would be reserved for them
+(see ``reserved_resources`` in ``task.py``). The distinct GPU counts, core counts, and memory
+amounts are kept in sorted lists, nested in that order, so that the largest task that fits in a
+given amount of free resources can be found by binary search, without scanning the tasks. The cost
+of a lookup only depends on the number of distinct shapes, which is usually much smaller than the
+number of tasks.
+"""
+
+from bisect import bisect_right, insort
+
+from banyan.worker.claim_planner import Demand
+from banyan.worker.task import normalize_request, reserved_resources
+
+def remove_sorted(values, value):
+	i = bisect_right(values, value) - 1
+	assert values[i] == value
+	del values[i]
+
+class TaskCache:
+	def __init__(self, resource_set, capacity):
+		self.resource_set = resource_set
+		self.capacity     = capacity
+
+		# Maps the id of each task to the pair of its ``Demand`` and its fields.
+		self.tasks = {}
+
+		# Maps each shape to the tasks with that shape, in the order in which they were added.
+		self.buckets = {}
+
+		# Sorted lists of the distinct GPU counts, the core counts for each GPU count, and the
+		# memory amounts for each pair of GPU and core counts.
+		self.gpu_levels    = []
+		self.core_levels   = {}
+		self.memory_levels = {}
+
+	def __len__(self):
+		return len(self.tasks)
+
+	def __contains__(self, task_id):
+		return task_id in self.tasks
+
+	def ids(self):
+		return list(self.tasks)
+
+	def demand(self, task):
+		"""
+		Returns the ``Demand`` of ``task``, using the resources that would be reserved for it.
+		"""
+
+		req = normalize_request(task.get('requested_resources', {}))
+		res = reserved_resources(req, self.resource_set)
+		cc  = None
+
+		if 'gpu_compute_capability_major' in req:
+			cc = (req['gpu_compute_capability_major'],
+				req.get('gpu_compute_capability_minor', 0))
+
+		return Demand(task['_id'], res.memory_bytes, res.cpu_cores, res.gpus,
+			req.get('gpu_memory_bytes', 0), cc)
+
+	def demand_of(self, task_id):
+		return self.tasks[task_id][0]
+
+	def demands(self):
+		"""
+		Returns the ``Demand`` of each task in the cache, in the order in which the tasks were
+		added.
+		"""
+
+		return [demand for demand, _ in self.tasks.values()]
+
+	def add(self, task):
+		"""
+		Adds ``task`` to the cache, replacing the previous version of the task if there is one.
+		Returns ``False`` if the task could not be added because the cache is full.
+		"""
+
+		self.remove(task['_id'])
+
+		if len(self.tasks) >= self.capacity:
+			return False
+
+		demand = self.demand(task)
+		shape  = (demand.gpus, demand.cpu_cores, demand.memory_bytes)
+		self.tasks[task['_id']] = (demand, task)
+
+		bucket = self.buckets.get(shape)
+		if bucket is not None:
+			bucket[task['_id']] = task
+			return True
+
+		self.buckets[shape] = {task['_id']: task}
+		gpus, cores, memory = shape
+
+		if gpus not in self.core_levels:
+			insort(self.gpu_levels, gpus)
+			self.core_levels[gpus] = []
+		if (gpus, cores) not in self.memory_levels:
+			insort(self.core_levels[gpus], cores)
+			self.memory_levels[(gpus, cores)] = []
+
+		insort(self.memory_levels[(gpus, cores)], memory)
+		return True
+
+	def remove(self, task_id):
+		"""
+		Removes the task with id ``task_id`` from the cache, and returns its fields, or ``None``
+		if the task is not in the cache.
+		"""
+
+		entry = self.tasks.pop(task_id, None)
+		if entry is None:
+			return None
+
+		demand, task = entry
+		shape  = (demand.gpus, demand.cpu_cores, demand.memory_bytes)
+		bucket = self.buckets[shape]
+		del bucket[task_id]
+
+		if len(bucket) != 0:
+			return task
+
+		del self.buckets[shape]
+		gpus, cores, memory = shape
+
+		memory_levels = self.memory_levels[(gpus, cores)]
+		remove_sorted(memory_levels, memory)
+		if len(memory_levels) != 0:
+			return task
+
+		del self.memory_levels[(gpus, cores)]
+		core_levels = self.core_levels[gpus]
+		remove_sorted(core_levels, cores)
+		if len(core_levels) != 0:
+			return task
+
+		del self.core_levels[gpus]
+		remove_sorted(self.gpu_levels, gpus)
+		return task
+
+	def clear(self):
+		self.tasks.clear()
+		self.buckets.clear()
+		self.gpu_levels.clear()
+		self.core_levels.clear()
+		self.memory_levels.clear()
+
+	def largest_fitting(self, free):
+		"""
+		Returns the id of a task with the largest shape that fits in ``free``, or ``None`` if no
+		task fits. Among the tasks with the same shape, the one that was added first is
+		returned. Only the memory, cores, and GPUs of ``free`` are taken into account.
+		"""
+
+		i = bisect_right(self.gpu_levels, free.gpus)
+
+		while i != 0:
+			i -= 1
+			gpus  = self.gpu_levels[i]
+			cores = self.core_levels[gpus]
+			j     = bisect_right(cores, free.cpu_cores)
+
+			while j != 0:
+				j -= 1
+				memory = self.memory_levels[(gpus, cores[j])]
+				k      = bisect_right(memory, free.memory_bytes)
+
+				if k != 0:
+					bucket = self.buckets[(gpus, cores[j], memory[k - 1])]
+					return next(iter(bucket))
+
+		return None
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+banyan.worker.usage_sampler
+---------------------------
+
+Samples the resources used by all running tasks at once. Each task is run by a shell, which may
+start several processes, so the usage of a task is the sum of the usage of the processes in the
+tree rooted at its shell. Rather than querying each process separately, ``UsageSampler.sample``
+reads the ``stat`` file of every process in ``/proc`` once, builds the process tree, and totals the
+usage of each task's subtree. The cost of a sample therefore depends on the number of processes on
+the machine, and not on the number of tasks. On systems without ``/proc``, the same information is
+obtained from ``psutil.process_iter``, which is also a single pass.
+
+The totals are stored in ``UsageTable``, whose columns are arrays with one row per task, and
+``Executor`` serves ``usage`` and ``resources_claimed`` from the latest sample, taking a new one at
+most every ``usage_sample_period_ms``.
+
+The CPU time of a process includes the time of its descendants that have exited and been waited
+for, so the CPU time of a tree does not decrease when processes in it exit. Processes that escape
+the tree by being orphaned (e.g. daemons) are no longer counted.
+"""
+
+import os
+import psutil
+
+from array import array
+from collections import defaultdict
+from time import monotonic
+
+from banyan.worker.task import ResourceUsage
+
+page_size  = os.sysconf('SC_PAGE_SIZE')
+clock_tick = os.sysconf('SC_CLK_TCK')
+
+def read_proc():
+	"""
+	Returns a list with the id, parent id, resident and virtual memory in bytes, and CPU time in
+	seconds of each process, read from ``/proc``.
+	"""
+
+	procs = []
+
+	for name in os.listdir('/proc'):
+		if not name.isdigit():
+			continue
+
+		try:
+			with open('/proc/' + name + '/stat', 'rb') as f:
+				stat = f.read()
+		except OSError:
+			# The process has exited since the directory was listed.
+			continue
+
+		"""
+		The second field is the name of the executable in parentheses, which may itself contain
+		spaces and parentheses, so the remaining fields are the ones after the last closing
+		parenthesis. See ``proc(5)`` for the meaning of the fields.
+		"""
+		fields = stat[stat.rindex(b')') + 2:].split()
+		cpu    = int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])
+
+		procs.append((int(name), int(fields[1]), int(fields[21]) * page_size,
+			int(fields[20]), cpu / clock_tick))
+
+	return procs
+
+def read_psutil():
+	procs = []
+
+	for p in psutil.process_iter():
+		try:
+			with p.oneshot():
+				mem, cpu = p.memory_info(), p.cpu_times()
+				procs.append((p.pid, p.ppid(), mem.rss, mem.vms, cpu.user + cpu.system +
+					cpu.children_user + cpu.children_system))
+		except psutil.Error:
+			continue
+
+	return procs
+
+read_processes = read_proc if os.path.exists('/proc/self/stat') else read_psutil
+
+class UsageTable:
+	"""
+	Usage of each task as of the latest sample, stored in parallel arrays. Each task occupies a
+	row, which is found using the id of the root process of the task. The rows of the tasks that
+	are removed are reused.
+	"""
+
+	def __init__(self):
+		self.rows      = {}
+		self.free_rows = []
+
+		self.resident_memory_bytes   = array('Q')
+		self.virtual_memory_bytes    = array('Q')
+		self.cpu_seconds             = array('d')
+		self.cpu_utilization_percent = array('d')
+
+		# Whether the row has been sampled since it was added.
+		self.sampled = array('B')
+
+	def add(self, pid):
+		if len(self.free_rows) != 0:
+			row = self.free_rows.pop()
+		else:
+			row = len(self.sampled)
+			for column in [self.resident_memory_bytes, self.virtual_memory_bytes,
+				self.cpu_seconds, self.cpu_utilization_percent, self.sampled]:
+				column.append(0)
+
+		self.resident_memory_bytes[row]   = 0
+		self.virtual_memory_bytes[row]    = 0
+		self.cpu_seconds[row]             = 0.
+		self.cpu_utilization_percent[row] = 0.
+		self.sampled[row]                 = False
+		self.rows[pid] = row
+
+	def remove(self, pid):
+		self.free_rows.append(self.rows.pop(pid))
+
+	def usage(self, pid):
+		row = self.rows[pid]
+
+		return ResourceUsage(
+			resident_memory_bytes=self.resident_memory_bytes[row],
+			virtual_memory_bytes=self.virtual_memory_bytes[row],
+			cpu_utilization_percent=self.cpu_utilization_percent[row]
+		)
+
+class UsageSampler:
+	def __init__(self, period):
+		self.period      = period
+		self.table       = UsageTable()
+		self.last_sample = None
+
+	def watch(self, pid):
+		"""
+		Starts sampling the tree of processes rooted at ``pid``.
+		"""
+
+		self.table.add(pid)
+
+	def unwatch(self, pid):
+		self.table.remove(pid)
+
+	def usage(self, pid):
+		"""
+		Returns the usage of the tree rooted at ``pid`` as of the latest sample, taking a new
+		one first if the latest one is older than ``period`` seconds, or was taken before the
+		tree was watched.
+		"""
+
+		if self.last_sample is None or monotonic() - self.last_sample >= self.period or \
+			not self.table.sampled[self.table.rows[pid]]:
+			self.sample()
+		return self.table.usage(pid)
+
+	def sample(self):
+		table = self.table
+		if len(table.rows) == 0:
+			return
+
+		now     = monotonic()
+		elapsed = now - self.last_sample if self.last_sample is not None else 0.
+		self.last_sample = now
+
+		info     = {}
+		children = defaultdict(list)
+
+		for proc in read_processes():
+			info[proc[0]] = proc
+			children[proc[1]].append(proc[0])
+
+		for root, row in table.rows.items():
+			resident, virtual, cpu = 0, 0, 0.
+			stack = [root]
+
+			while len(stack) != 0:
+				proc = info.get(stack.pop())
+				if proc is None:
+					continue
+
+				resident += proc[2]
+				virtual  += proc[3]
+				cpu      += proc[4]
+				stack.extend(children.get(proc[0], ()))
+
+			"""
+			The utilization is computed from the CPU time used since the previous sample, so
+			it is zero for the first sample of each task, as with ``psutil.cpu_percent``.
+			"""
+			if table.sampled[row] and elapsed > 0:
+				percent = max(0., cpu - table.cpu_seconds[row]) / elapsed * 100
+			else:
+				percent = 0.
+
+			table.resident_memory_bytes[row]   = resident
+			table.virtual_memory_bytes[row]    = virtual
+			table.cpu_seconds[row]             = cpu
+			table.cpu_utilization_percent[row] = percent
+			table.sampled[row]                 = True
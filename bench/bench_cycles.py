@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.bench_cycles
+------------------
+
+Measures the cost of checking new continuations for cyclic dependencies using the topological order
+maintained by ``DependencyGraph``, and compares it to the cost of a full search for the parent from
+the child.
+
+A random acyclic dependency graph is written to a scratch database, and its topological order is
+computed using ``topological_order.rebuild``. Random edges are then checked for cycles using both
+methods. The edges that do not create cycles are added to the graph, as ``make_additions`` would.
+
+This benchmark requires a MongoDB server running on the default port.
+"""
+
+import random
+
+from argparse import ArgumentParser
+from pymongo import MongoClient, UpdateOne
+from timeit import default_timer as timer
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from banyan.server.topological_order import DependencyGraph, rebuild
+
+def make_graph(db, task_count, edge_count, rng):
+	"""
+	Creates ``task_count`` tasks and ``edge_count`` random edges, such that the graph is acyclic.
+	The edges respect a hidden random order, which is unrelated to the order of creation.
+	"""
+
+	db.drop_collection('tasks')
+	db.drop_collection('counters')
+
+	ids = db.tasks.insert_many([{'continuations': [], 'parents': []}
+		for _ in range(task_count)]).inserted_ids
+
+	hidden = list(ids)
+	rng.shuffle(hidden)
+	children = {}
+
+	while sum(len(c) for c in children.values()) < edge_count:
+		i, j = sorted(rng.sample(range(task_count), 2))
+		children.setdefault(hidden[i], set()).add(hidden[j])
+
+	ops = []
+	parents = {}
+
+	for parent, c in children.items():
+		ops.append(UpdateOne({'_id': parent}, {'$set': {'continuations': list(c)}}))
+		for child in c:
+			parents.setdefault(child, []).append(parent)
+
+	for child, p in parents.items():
+		ops.append(UpdateOne({'_id': child}, {'$set': {'parents': p}}))
+
+	db.tasks.bulk_write(ops, ordered=False)
+	rebuild(db)
+	return ids
+
+def full_search(db, parent, child):
+	"""
+	Returns ``True`` iff ``parent`` is reachable from ``child``, by searching over all of the
+	descendants of ``child``.
+	"""
+
+	seen = {child}
+	frontier = [child]
+
+	while len(frontier) != 0:
+		tasks = db.tasks.find({'_id': {'$in': frontier}}, projection={'continuations': True})
+		frontier = []
+
+		for task in tasks:
+			for next_id in task['continuations']:
+				if next_id == parent:
+					return True
+				if next_id not in seen:
+					seen.add(next_id)
+					frontier.append(next_id)
+
+	return False
+
+def add_edge(db, parent, child):
+	db.tasks.update_one({'_id': parent}, {'$addToSet': {'continuations': child}})
+	db.tasks.update_one({'_id': child}, {'$addToSet': {'parents': parent}})
+
+def parse_args():
+	ap = ArgumentParser(description="Benchmarks cycle detection for new continuations.")
+	ap.add_argument('--tasks', type=int, default=20000)
+	ap.add_argument('--edges', type=int, default=100000)
+	ap.add_argument('--checks', type=int, default=1000)
+	ap.add_argument('--seed', type=int, default=0)
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	rng  = random.Random(args.seed)
+	db   = MongoClient()['banyan_bench']
+
+	start = timer()
+	ids = make_graph(db, args.tasks, args.edges, rng)
+	print("Created graph with {} tasks and {} edges in {:.1f} s.".format(args.tasks,
+		args.edges, timer() - start))
+
+	incremental_time = 0
+	full_time        = 0
+	cycles           = 0
+
+	for _ in range(args.checks):
+		parent, child = rng.sample(ids, 2)
+
+		start = timer()
+		accepted = DependencyGraph(db).add_edge(parent, child)
+		incremental_time += timer() - start
+
+		start = timer()
+		cyclic = full_search(db, parent, child)
+		full_time += timer() - start
+
+		assert accepted != cyclic
+
+		if accepted:
+			add_edge(db, parent, child)
+		else:
+			cycles += 1
+
+	print("{} of {} edges would have created cycles.".format(cycles, args.checks))
+	print("{:>12} {:>16}".format("method", "time/edge (ms)"))
+	print("{:>12} {:>16.3f}".format("incremental", 1000 * incremental_time / args.checks))
+	print("{:>12} {:>16.3f}".format("full search", 1000 * full_time / args.checks))
+
+	db.client.drop_database('banyan_bench')
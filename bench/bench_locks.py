@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.bench_locks
+-----------------
+
+Compares the request throughput obtained using a single global lock for all tasks against the
+throughput obtained using ``KeyedLock``, as the number of request threads increases.
+
+Each simulated request locks a parent task and its continuations in one of several independent task
+chains, and then sleeps for a fixed amount of time while holding the locks, in order to simulate the
+database operations performed while processing the request.
+"""
+
+import random
+import time
+
+from argparse import ArgumentParser
+from threading import Lock, Thread
+from timeit import default_timer as timer
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from banyan.server.locks import KeyedLock
+
+class GlobalLock:
+	"""
+	Adapts a single ``Lock`` to the interface of ``KeyedLock``.
+	"""
+
+	def __init__(self):
+		self.lock = Lock()
+
+	def acquire(self, keys):
+		self.lock.acquire()
+		return self
+
+	def release(self):
+		self.lock.release()
+
+def run(lock, thread_count, request_count, chain_count, fanout, latency):
+	def worker(seed):
+		rng = random.Random(seed)
+
+		for _ in range(request_count // thread_count):
+			chain  = rng.randrange(chain_count)
+			parent = rng.randrange(1000)
+			keys   = ['{}:{}'.format(chain, parent + i) for i in range(fanout + 1)]
+
+			guard = lock.acquire(keys)
+			time.sleep(latency)
+			guard.release()
+
+	threads = [Thread(target=worker, args=(i,)) for i in range(thread_count)]
+	start = timer()
+
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	return (request_count // thread_count) * thread_count / (timer() - start)
+
+def parse_args():
+	ap = ArgumentParser(description="Benchmarks task lock throughput versus thread count.")
+	ap.add_argument('--requests', type=int, default=2048)
+	ap.add_argument('--chains', type=int, default=64)
+	ap.add_argument('--fanout', type=int, default=4)
+	ap.add_argument('--latency-ms', type=float, default=1.)
+	ap.add_argument('--max-threads', type=int, default=64)
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	latency = args.latency_ms / 1000
+
+	print("{:>8} {:>16} {:>16}".format("threads", "global (req/s)", "keyed (req/s)"))
+
+	thread_count = 1
+	while thread_count <= args.max_threads:
+		results = [run(lock, thread_count, args.requests, args.chains, args.fanout, latency)
+			for lock in [GlobalLock(), KeyedLock()]]
+
+		print("{:>8} {:>16.1f} {:>16.1f}".format(thread_count, *results), flush=True)
+		thread_count *= 2
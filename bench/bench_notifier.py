@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.bench_notifier
+--------------------
+
+Load test for ``WorkerNotifier``. A single process plays the part of many workers: it accepts
+the connections made by the notifier on one listening socket, and reads the messages sent over all
+of them using ``selectors``. Each simulated worker is identified by the token in its messages.
+
+Several threads, standing in for request threads, send a sequence of ``tasks_available_notice``
+messages to each worker, numbered consecutively. We check that every message arrives, and that the
+messages to each worker arrive in order, and report the time taken to establish the connections and
+to deliver the messages.
+
+Each simulated worker uses two file descriptors, so the limit on open files is raised as far as
+possible.
+"""
+
+import resource
+import selectors
+import socket
+
+from argparse import ArgumentParser
+from threading import Thread
+from timeit import default_timer as timer
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from banyan.notification_protocol import tasks_available_notice, msg_len, format_message, \
+	parse_message
+from banyan.server.event_loop import EventLoopThread
+from banyan.server.worker_notifier import WorkerNotifier
+
+def worker_token(i):
+	return '{:016d}'.format(i)
+
+class Receiver:
+	"""
+	Accepts the connections from the notifier, and records the messages received for each
+	worker.
+	"""
+
+	def __init__(self, expected_messages):
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(socket.SOMAXCONN)
+		self.listener.setblocking(False)
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.listener, selectors.EVENT_READ)
+
+		self.expected_messages = expected_messages
+		self.connections       = 0
+		self.received          = 0
+		self.out_of_order      = 0
+		self.last_seen         = {}
+		self.buffers           = {}
+
+	def address(self):
+		return self.listener.getsockname()
+
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self.listener.accept()
+			except BlockingIOError:
+				return
+
+			conn.setblocking(False)
+			self.selector.register(conn, selectors.EVENT_READ)
+			self.buffers[conn] = b''
+			self.connections += 1
+
+	def _read(self, conn):
+		data = conn.recv(65536)
+		if len(data) == 0:
+			self.selector.unregister(conn)
+			conn.close()
+			return
+
+		buf = self.buffers[conn] + data
+		while len(buf) >= msg_len:
+			token, _, seq = parse_message(buf[:msg_len])
+			buf = buf[msg_len:]
+
+			if seq != self.last_seen.get(token, -1) + 1:
+				self.out_of_order += 1
+			self.last_seen[token] = seq
+			self.received += 1
+
+		self.buffers[conn] = buf
+
+	def run(self, worker_count, timeout):
+		"""
+		Returns the times at which all connections were accepted and all messages were
+		received, or ``None`` for the events that did not happen within ``timeout`` seconds.
+		"""
+
+		start = timer()
+		connected_at, received_at = None, None
+
+		while timer() - start < timeout:
+			for key, _ in self.selector.select(timeout=0.1):
+				if key.fileobj is self.listener:
+					self._accept()
+				else:
+					self._read(key.fileobj)
+
+			if connected_at is None and self.connections == worker_count:
+				connected_at = timer()
+			if self.received == self.expected_messages:
+				received_at = timer()
+				break
+
+		return connected_at, received_at
+
+def send_messages(notifier, worker_ids, message_count):
+	for seq in range(message_count):
+		for i in worker_ids:
+			notifier.notify(i, format_message(tasks_available_notice, worker_token(i), seq))
+
+def parse_args():
+	ap = ArgumentParser(description="Load test for the worker notifier.")
+	ap.add_argument('--workers', type=int, default=5000)
+	ap.add_argument('--messages', type=int, default=20, help="Messages per worker.")
+	ap.add_argument('--threads', type=int, default=8, help="Number of sending threads.")
+	ap.add_argument('--timeout', type=float, default=120)
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+
+	_, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+	receiver = Receiver(args.workers * args.messages)
+	notifier = WorkerNotifier(EventLoopThread())
+
+	start = timer()
+	for i in range(args.workers):
+		notifier.register(i, receiver.address())
+	register_time = timer() - start
+
+	# Each worker is assigned to one sending thread, so that its messages have a well-defined
+	# order.
+	senders = [Thread(target=send_messages, args=(notifier,
+		range(t, args.workers, args.threads), args.messages)) for t in range(args.threads)]
+
+	start = timer()
+	for sender in senders:
+		sender.start()
+
+	connected_at, received_at = receiver.run(args.workers, args.timeout)
+
+	for sender in senders:
+		sender.join()
+	notifier.close()
+
+	print("Queued {} registrations in {:.3f} s.".format(args.workers, register_time))
+
+	if connected_at is None:
+		print("Only {} of {} connections were established.".format(receiver.connections,
+			args.workers))
+	else:
+		print("All connections established after {:.3f} s.".format(connected_at - start))
+
+	if received_at is None:
+		print("Only {} of {} messages were received.".format(receiver.received,
+			receiver.expected_messages))
+	else:
+		elapsed = received_at - start
+		print("Received {} messages in {:.3f} s ({:.0f} messages/s).".format(
+			receiver.received, elapsed, receiver.received / elapsed))
+
+	print("{} messages arrived out of order.".format(receiver.out_of_order))
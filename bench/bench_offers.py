@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.bench_offers
+------------------
+
+Simulates many workers polling for available tasks at the same time, and reports the fraction of
+claim attempts that fail because another worker claimed the task first. Two policies for offering
+tasks are compared:
+
+- ``first page``: every worker is offered the first tasks in insertion order.
+- ``sharded``: every worker is offered the tasks in order of ``offer_key``, starting from an offset
+  derived from its id (see ``offered_tasks`` in ``banyan/server/claims.py``).
+
+In each round, all workers obtain their offers from the same snapshot of the available tasks, and
+then attempt to claim tasks from their offers in a random interleaving, until each worker has
+claimed ``capacity`` tasks or exhausted its offer. Claimed tasks are then replaced by new ones.
+"""
+
+import bisect
+import random
+
+from argparse import ArgumentParser
+from bson import ObjectId
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from banyan.server.claims import make_offer_key, offer_offset
+
+def first_page(tasks, keys, worker_id, window):
+	return tasks[:window]
+
+def sharded(tasks, keys, worker_id, window):
+	start = bisect.bisect_left(keys, offer_offset(worker_id))
+	offer = tasks[start:start + window]
+	return offer + tasks[:window - len(offer)]
+
+def run(policy, worker_ids, task_count, window, capacity, rounds, rng):
+	available = {i: make_offer_key() for i in range(task_count)}
+	next_task = task_count
+	attempts  = 0
+	conflicts = 0
+
+	for _ in range(rounds):
+		by_key = sorted(available.items(), key=lambda t: t[1])
+		tasks  = [t for t, _ in by_key]
+		keys   = [k for _, k in by_key]
+
+		offers  = {w: iter(policy(tasks, keys, w, window)) for w in worker_ids}
+		counts  = {w: 0 for w in worker_ids}
+		active  = list(worker_ids)
+		claimed = set()
+
+		while len(active) != 0:
+			rng.shuffle(active)
+			still_active = []
+
+			for w in active:
+				task = next(offers[w], None)
+				if task is None:
+					continue
+
+				attempts += 1
+				if task in claimed:
+					conflicts += 1
+				else:
+					claimed.add(task)
+					counts[w] += 1
+
+				if counts[w] < capacity:
+					still_active.append(w)
+
+			active = still_active
+
+		for task in claimed:
+			del available[task]
+			available[next_task] = make_offer_key()
+			next_task += 1
+
+	return attempts, conflicts
+
+def parse_args():
+	ap = ArgumentParser(description="Benchmarks claim conflicts for task offering policies.")
+	ap.add_argument('--workers', type=int, default=500)
+	ap.add_argument('--tasks', type=int, default=50000)
+	ap.add_argument('--window', type=int, default=128)
+	ap.add_argument('--capacity', type=int, default=4)
+	ap.add_argument('--rounds', type=int, default=10)
+	ap.add_argument('--seed', type=int, default=0)
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	worker_ids = [ObjectId() for _ in range(args.workers)]
+
+	print("{:>12} {:>10} {:>10} {:>14}".format("policy", "attempts", "conflicts",
+		"conflict rate"))
+
+	for name, policy in [('first page', first_page), ('sharded', sharded)]:
+		attempts, conflicts = run(policy, worker_ids, args.tasks, args.window,
+			args.capacity, args.rounds, random.Random(args.seed))
+
+		print("{:>12} {:>10} {:>10} {:>14.4f}".format(name, attempts, conflicts,
+			conflicts / attempts))
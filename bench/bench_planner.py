@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.bench_planner
+-------------------
+
+Replays a job trace on a cluster of identical workers, and reports the makespan, the mean time that
+jobs wait before they start, and the average utilization of each resource for each strategy in
+``banyan/worker/claim_planner.py``.
+
+Jobs become available at their submission times. Whenever a job arrives or terminates, each worker
+plans claims from the first ``window`` available jobs (as if they were its task cache), using the
+resources that it has left, and starts the selected jobs right away. Network delays and claim
+conflicts are not modeled (see ``bench_offers.py`` for the latter).
+
+The trace is either generated at random, or read from a CSV file with the columns
+``submit_seconds``, ``runtime_seconds``, ``memory_bytes``, ``cpu_cores``, and ``gpus``.
+"""
+
+import csv
+import heapq
+import math
+import random
+
+from argparse import ArgumentParser
+from collections import namedtuple
+
+# Allows us to import the 'banyan' module.
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from banyan.worker.claim_planner import Demand, FreeResources, strategies, subtract
+
+Job = namedtuple('Job', ['submit', 'runtime', 'demand'])
+
+def make_demand(job_id, memory_bytes, cpu_cores, gpus):
+	return Demand(job_id, memory_bytes, cpu_cores, gpus, 0, None)
+
+def random_trace(count, workers, capacity, load, rng):
+	"""
+	Generates ``count`` jobs that fit in a worker with the resources ``capacity``, with Poisson
+	arrivals. The arrival rate is chosen so that the jobs would keep the cores of ``workers``
+	such workers busy ``load`` times over if they were packed perfectly.
+	"""
+
+	jobs = []
+
+	for i in range(count):
+		cores  = rng.choice([1, 1, 2, 4, 8])
+		memory = int(2 ** rng.uniform(28, math.log2(capacity.memory_bytes / 2)))
+		gpus   = rng.choice([1, 2]) if rng.random() < 0.2 else 0
+
+		jobs.append((rng.expovariate(1 / 60), make_demand(i, memory, min(cores,
+			capacity.cpu_cores), min(gpus, capacity.gpus))))
+
+	core_seconds = sum(runtime * demand.cpu_cores for runtime, demand in jobs)
+	rate = load * capacity.cpu_cores * workers * count / core_seconds
+	t    = 0.
+	trace = []
+
+	for runtime, demand in jobs:
+		t += rng.expovariate(rate)
+		trace.append(Job(t, runtime, demand))
+
+	return trace
+
+def read_trace(path):
+	with open(path, newline='') as f:
+		rows = sorted(csv.DictReader(f), key=lambda row: float(row['submit_seconds']))
+
+	# The id of each job is its index in the trace.
+	return [Job(float(row['submit_seconds']), float(row['runtime_seconds']),
+		make_demand(i, int(row['memory_bytes']), int(row['cpu_cores']), int(row['gpus'])))
+		for i, row in enumerate(rows)]
+
+def run(strategy, trace, workers, capacity, window):
+	"""
+	Returns the makespan, the mean waiting time, and the average utilization of the memory,
+	cores, and GPUs of the cluster.
+	"""
+
+	free     = [capacity] * workers
+	running  = []
+	pending  = []
+	arrived  = 0
+	finished = 0
+	now      = 0.
+	waiting  = 0.
+
+	# Integrals of the memory, cores, and GPUs in use over time.
+	used  = [0, 0, 0]
+	usage = [0., 0., 0.]
+
+	while finished != len(trace):
+		times = []
+		if arrived != len(trace):
+			times.append(trace[arrived].submit)
+		if len(running) != 0:
+			times.append(running[0][0])
+
+		if len(times) == 0:
+			raise RuntimeError("Some jobs do not fit in the workers.")
+
+		t = min(times)
+		for i in range(3):
+			usage[i] += used[i] * (t - now)
+		now = t
+
+		while len(running) != 0 and running[0][0] <= now:
+			_, _, worker, demand = heapq.heappop(running)
+			free[worker] = free[worker]._replace(
+				memory_bytes=free[worker].memory_bytes + demand.memory_bytes,
+				cpu_cores=free[worker].cpu_cores + demand.cpu_cores,
+				gpus=free[worker].gpus + demand.gpus)
+			used = [used[0] - demand.memory_bytes, used[1] - demand.cpu_cores,
+				used[2] - demand.gpus]
+			finished += 1
+
+		while arrived != len(trace) and trace[arrived].submit <= now:
+			pending.append(arrived)
+			arrived += 1
+
+		for worker in range(workers):
+			if len(pending) == 0:
+				break
+
+			demands  = [trace[j].demand for j in pending[:window]]
+			selected = set(strategy(demands, free[worker]))
+
+			for j in selected:
+				demand = trace[j].demand
+				free[worker] = subtract(free[worker], demand)
+				used = [used[0] + demand.memory_bytes, used[1] + demand.cpu_cores,
+					used[2] + demand.gpus]
+				waiting += now - trace[j].submit
+				heapq.heappush(running, (now + trace[j].runtime, j, worker, demand))
+
+			pending = [j for j in pending if j not in selected]
+
+	totals = [capacity.memory_bytes * workers, capacity.cpu_cores * workers,
+		capacity.gpus * workers]
+	utilization = [usage[i] / (totals[i] * now) if totals[i] != 0 else 0. for i in range(3)]
+	return now, waiting / len(trace), utilization
+
+def parse_args():
+	ap = ArgumentParser(description="Benchmarks claim planning strategies on a job trace.")
+	ap.add_argument('--trace', default=None, help="CSV file with the trace to replay. A random "
+		"trace is generated if this is omitted.")
+	ap.add_argument('--jobs', type=int, default=5000)
+	ap.add_argument('--load', type=float, default=1.2)
+	ap.add_argument('--workers', type=int, default=16)
+	ap.add_argument('--memory-gib', type=int, default=64)
+	ap.add_argument('--cores', type=int, default=16)
+	ap.add_argument('--gpus', type=int, default=4)
+	ap.add_argument('--window', type=int, default=128)
+	ap.add_argument('--seed', type=int, default=0)
+	return ap.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	capacity = FreeResources(args.memory_gib * 2 ** 30, args.cores, args.gpus)
+
+	if args.trace is not None:
+		trace = read_trace(args.trace)
+	else:
+		trace = random_trace(args.jobs, args.workers, capacity, args.load,
+			random.Random(args.seed))
+
+	print("{:>22} {:>12} {:>10} {:>8} {:>8} {:>8}".format("strategy", "makespan (s)",
+		"wait (s)", "memory", "cores", "gpus"))
+
+	for name, strategy in strategies.items():
+		makespan, wait, utilization = run(strategy, trace, args.workers, capacity,
+			args.window)
+
+		print("{:>22} {:>12.1f} {:>10.1f} {:>8.3f} {:>8.3f} {:>8.3f}".format(name, makespan,
+			wait, *utilization))
@@ -7,8 +7,11 @@ test.test_server
 Tests functionality that is implemented completely on the server-side.
 """
 
+import time
 import unittest
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+from bson import ObjectId
 from pymongo import MongoClient
 
 # Allows us to import the 'banyan' module.
@@ -17,6 +20,9 @@ import sys
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
 from banyan.common import *
+from banyan.notification_protocol import tasks_available_notice, msg_len, parse_message
+from banyan.server.constants import max_item_list_length, lease_sweep_seconds
+from banyan.server.fair_share import usage_by_owner
 import banyan.auth.access as access
 
 class Credentials():
@@ -38,6 +44,18 @@ class Credentials():
 		self.provider_key = authorization_key(self.provider_token)
 		self.worker_key = authorization_key(self.worker_token)
 
+		"""
+		Address at which the worker can be registered. The connections made by the server to
+		notify the worker are completed by the kernel even though they are never accepted, so
+		the worker is never considered unreachable.
+		"""
+		self.worker_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.worker_listener.bind((socket.gethostbyname(socket.gethostname()), 0))
+		self.worker_listener.listen(socket.SOMAXCONN)
+
+		ip, port = self.worker_listener.getsockname()
+		self.worker_address = {'ip': ip, 'port': port}
+
 	def revoke(self):
 		access.remove_user('test_provider', self.db)
 		access.remove_user('test_worker', self.db)
@@ -53,6 +71,7 @@ def scoped_credentials(db):
 	c = Credentials(db)
 	yield c
 	c.revoke()
+	c.worker_listener.close()
 
 def drop_tasks(db):
 	db.drop_collection('tasks')
@@ -493,6 +512,126 @@ class TestTaskCreation(unittest.TestCase):
 			self.assertEqual(resp.json()['state'], 'inactive')
 			self.assertEqual(resp.json()['pending_dependency_count'], 0)
 
+	def test_cyclic_dependencies(self):
+		"""
+		Checks that continuations that would create cyclic dependencies are rejected, both
+		when the tasks are linked in the order in which they were created, and in the reverse
+		order (which requires the topological order to be updated).
+		"""
+
+		drop_tasks(self.db)
+
+		ids = []
+		insert_tasks(self, [{'name': 'task {}'.format(i)} for i in range(4)], id_list=ids)
+
+		# Creates the chain 3 -> 2 -> 1 -> 0, against the order of creation.
+		for i in range(3):
+			resp = add_continuations(self, [ids[i]], ids[i + 1])
+			self.assertEqual(resp.status_code, requests.codes.ok)
+
+		for i in range(3):
+			resp = add_continuations(self, [ids[3]], ids[i])
+			self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		# Adding a shortcut along the chain is fine.
+		resp = add_continuations(self, [ids[0]], ids[3])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		# Reversing an existing edge should also be rejected.
+		resp = post([
+			{'targets': [ids[0]], 'values': [ids[1]]}
+		], self.entry, self.cred.provider_key, 'tasks', 'add_continuations')
+		self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		# A cycle formed by edges in the same request should also be rejected.
+		new_ids = []
+		insert_tasks(self, [{'name': 'task {}'.format(i)} for i in range(4, 6)],
+			id_list=new_ids)
+
+		resp = post([
+			{'targets': [new_ids[0]], 'values': [new_ids[1]]},
+			{'targets': [new_ids[1]], 'values': [new_ids[0]]}
+		], self.entry, self.cred.provider_key, 'tasks', 'add_continuations')
+		self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		resp = get(self.entry, self.cred.provider_key, 'tasks', new_ids[0])
+		self.assertEqual(resp.json()['continuations'], [])
+
+	def test_submit_graph(self):
+		"""
+		Submits a graph in which a group task created in the 'available' state releases one of
+		its continuations immediately, and checks that the states and dependency counts agree
+		with the ones that would result from creating the tasks individually.
+		"""
+
+		drop_tasks(self.db)
+
+		graph = {
+			'tasks': [
+				{'id': 'group', 'state': 'available'},
+				{'id': 'a', 'command': 'a', 'requested_resources': {}},
+				{'id': 'b', 'command': 'b', 'requested_resources': {}},
+				{'id': 'c', 'command': 'c', 'requested_resources': {}, 'name': 'c'}
+			],
+
+			'edges': [
+				{'parent': 'group', 'child': 'a'},
+				{'parent': 'group', 'child': 'b'},
+				{'parent': 'a', 'child': 'c'},
+				{'parent': 'b', 'child': 'c'}
+			]
+		}
+
+		resp = post(graph, self.entry, self.cred.provider_key, 'tasks', 'submit_graph')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		ids = resp.json()['ids']
+
+		expected = {
+			'group': ('terminated', 0, 2),
+			'a': ('available', 0, 1),
+			'b': ('available', 0, 1),
+			'c': ('inactive', 2, 0)
+		}
+
+		for local_id, (state, count, cont_count) in expected.items():
+			resp = get(self.entry, self.cred.provider_key, 'tasks', ids[local_id])
+			self.assertEqual(resp.json()['state'], state)
+			self.assertEqual(resp.json()['pending_dependency_count'], count)
+			self.assertEqual(len(resp.json()['continuations']), cont_count)
+
+		resp = get(self.entry, self.cred.provider_key, 'tasks', ids['c'])
+		self.assertEqual(set(resp.json()['parents']), {ids['a'], ids['b']})
+
+		# Names must be unique across the graph and the existing tasks.
+		resp = post({'tasks': [{'id': 'd', 'name': 'c'}]}, self.entry,
+			self.cred.provider_key, 'tasks', 'submit_graph')
+		self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		resp = post({
+			'tasks': [{'id': 'd'}, {'id': 'e'}],
+			'edges': [{'parent': 'd', 'child': 'e'}, {'parent': 'e', 'child': 'd'}]
+		}, self.entry, self.cred.provider_key, 'tasks', 'submit_graph')
+		self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		# Each task can have at most as many continuations and parents as through 'tasks'.
+		leaves = ['leaf {}'.format(i) for i in range(max_item_list_length + 1)]
+		tasks  = [{'id': 'hub'}] + [{'id': leaf} for leaf in leaves]
+
+		for edges in [[{'parent': 'hub', 'child': leaf} for leaf in leaves],
+			[{'parent': leaf, 'child': 'hub'} for leaf in leaves]]:
+			resp = post({'tasks': tasks, 'edges': edges}, self.entry,
+				self.cred.provider_key, 'tasks', 'submit_graph')
+			self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+			resp = post({'tasks': tasks, 'edges': edges[1:]}, self.entry,
+				self.cred.provider_key, 'tasks', 'submit_graph')
+			self.assertEqual(resp.status_code, requests.codes.ok)
+
+		# Workers cannot create tasks.
+		resp = post({'tasks': [{'id': 'd'}]}, self.entry, self.cred.worker_key, 'tasks',
+			'submit_graph')
+		self.assertEqual(resp.status_code, requests.codes.unauthorized)
+
 class TestWorkerRegistration(unittest.TestCase):
 	"""
 	Tests that registration and unregistration of workers functions as expected.
@@ -527,13 +666,152 @@ class TestWorkerRegistration(unittest.TestCase):
 		reg_worker_id = resp.json()['_id']
 		self.assertEqual(resp.status_code, requests.codes.created)
 
+		resp = get(self.entry, self.cred.worker_key, 'tasks')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
 		resp = delete(self.entry, self.cred.provider_key, 'registered_workers',
 			str(reg_worker_id))
 		self.assertEqual(resp.status_code, requests.codes.no_content)
 
+		# The cached credentials of the worker should be invalidated by unregistration.
+		resp = get(self.entry, self.cred.worker_key, 'tasks')
+		self.assertEqual(resp.status_code, requests.codes.unauthorized)
+
 		resp = post(entry_2, self.entry, self.cred.provider_key, 'registered_workers')
 		self.assertEqual(resp.status_code, requests.codes.created)
 
+	def test_tasks_available_notice(self):
+		"""
+		Checks that a registered worker is notified when a task becomes available because its
+		dependencies have terminated.
+		"""
+
+		drop_tasks(self.db)
+		drop_registered_workers(self.db)
+
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind((self.entry.ip, 0))
+		listener.listen(1)
+		listener.settimeout(5)
+
+		entry = {
+			'worker_id': self.cred.worker_id,
+			'address': {'ip': self.entry.ip, 'port': listener.getsockname()[1]}
+		}
+
+		resp = post(entry, self.entry, self.cred.provider_key, 'registered_workers')
+		self.assertEqual(resp.status_code, requests.codes.created)
+
+		child_ids = []
+		insert_tasks(self, [{'name': 'child', 'command': 'ls'}], id_list=child_ids)
+		insert_tasks(self, [{
+			'name': 'parent',
+			'state': 'available',
+			'continuations': child_ids
+		}])
+
+		conn, _ = listener.accept()
+		conn.settimeout(5)
+		msg = b''
+
+		while len(msg) < msg_len:
+			msg += conn.recv(msg_len - len(msg))
+
+		self.assertEqual(parse_message(msg),
+			(self.cred.worker_token, tasks_available_notice, 1))
+
+		conn.close()
+		listener.close()
+		drop_registered_workers(self.db)
+
+	def test_unreachable_worker(self):
+		"""
+		Checks that failing to deliver a notice to a worker does not cause its tasks to be
+		recovered, and that the tasks whose leases expire are requeued or terminated depending
+		on their remaining attempts.
+		"""
+
+		drop_tasks(self.db)
+		drop_registered_workers(self.db)
+
+		# Connections to the port are refused once the socket is closed.
+		closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		closed.bind((self.entry.ip, 0))
+		port = closed.getsockname()[1]
+		closed.close()
+
+		entry = {
+			'worker_id': self.cred.worker_id,
+			'address': {'ip': self.entry.ip, 'port': port}
+		}
+
+		resp = post(entry, self.entry, self.cred.provider_key, 'registered_workers')
+		self.assertEqual(resp.status_code, requests.codes.created)
+		reg_worker_id = resp.json()['_id']
+
+		after_ids = []
+		insert_tasks(self, [{'name': 'after'}], id_list=after_ids)
+
+		task_ids = []
+		insert_tasks(self, [
+			{'name': 'retried', 'command': 'ls', 'state': 'available',
+				'max_attempt_count': 2, 'requested_resources': {}},
+			{'name': 'exhausted', 'command': 'ls', 'state': 'available',
+				'max_attempt_count': 1, 'requested_resources': {},
+				'continuations': after_ids}
+		], id_list=task_ids)
+
+		for task_id in task_ids:
+			resp = patch({
+				'state': 'running',
+				'update_execution_data': {'worker_id': self.cred.worker_id}
+			}, self.entry, self.cred.worker_key, 'tasks', task_id)
+			self.assertEqual(resp.status_code, requests.codes.ok)
+
+		# The server fails to notify the worker when the child becomes available.
+		child_ids = []
+		insert_tasks(self, [{'name': 'child', 'command': 'ls'}], id_list=child_ids)
+		insert_tasks(self, [{
+			'name': 'parent',
+			'state': 'available',
+			'continuations': child_ids
+		}])
+
+		def find_task(task_id):
+			return self.db.tasks.find_one({'_id': ObjectId(task_id)})
+
+		time.sleep(1)
+		self.assertEqual(self.db.registered_workers.count(), 1)
+		for task_id in task_ids:
+			self.assertEqual(find_task(task_id)['state'], 'running')
+
+		# The tasks are recovered by the lease sweep once their leases expire.
+		self.db.tasks.update_many({'_id': {'$in': [ObjectId(i) for i in task_ids]}},
+			{'$set': {'lease.expires_at': datetime.utcnow() - timedelta(seconds=1)}})
+
+		deadline = time.monotonic() + lease_sweep_seconds + 10
+		while find_task(task_ids[1])['state'] == 'running' and time.monotonic() < deadline:
+			time.sleep(0.1)
+
+		retried = find_task(task_ids[0])
+		self.assertEqual(retried['state'], 'available')
+		self.assertEqual(retried['attempt_count'], 2)
+		self.assertEqual(find_task(task_ids[1])['state'], 'terminated')
+		self.assertEqual(find_task(after_ids[0])['state'], 'cancelled')
+
+		for task_id in task_ids:
+			data = self.db.execution_info.find_one({'task_id': ObjectId(task_id),
+				'attempt_count': 1})
+			self.assertEqual(data['exit_status'], 'abandoned (worker unreachable)')
+
+		# The remaining tests require the worker to be registered at a reachable address.
+		resp = delete(self.entry, self.cred.provider_key, 'registered_workers', reg_worker_id)
+		self.assertEqual(resp.status_code, requests.codes.no_content)
+
+		entry['address'] = self.cred.worker_address
+		resp = post(entry, self.entry, self.cred.provider_key, 'registered_workers')
+		self.assertEqual(resp.status_code, requests.codes.created)
+
 class TestExecutionInfo(unittest.TestCase):
 	"""
 	Tests the behavior of the ``execution_data`` endpoint.
@@ -723,11 +1001,13 @@ class TestCancellation(unittest.TestCase):
 			resp = get(self.entry, self.cred.provider_key, 'tasks', child_id)
 			self.assertEqual(len(resp.json()['continuations']), 4)
 			self.assertEqual(resp.json()['pending_dependency_count'], 2)
+			self.assertEqual(set(resp.json()['parents']), set(parent_ids))
 
 		for grandchild_id in grandchild_ids:
 			resp = get(self.entry, self.cred.provider_key, 'tasks', grandchild_id)
 			self.assertEqual(len(resp.json()['continuations']), 0)
 			self.assertEqual(resp.json()['pending_dependency_count'], 2)
+			self.assertEqual(set(resp.json()['parents']), set(child_ids))
 
 		"""
 		Now we cancel just one parent, and verify that **all** continuations were cancelled
@@ -747,12 +1027,14 @@ class TestCancellation(unittest.TestCase):
 			self.assertEqual(resp.json()['state'], 'cancelled')
 			self.assertEqual(resp.json()['pending_dependency_count'], 2)
 			self.assertEqual(len(resp.json()['continuations']), 0)
+			self.assertEqual(resp.json()['parents'], [])
 
 		for grandchild_id in grandchild_ids:
 			resp = get(self.entry, self.cred.provider_key, 'tasks', grandchild_id)
 			self.assertEqual(resp.json()['state'], 'cancelled')
 			self.assertEqual(resp.json()['pending_dependency_count'], 2)
 			self.assertEqual(len(resp.json()['continuations']), 0)
+			self.assertEqual(resp.json()['parents'], [])
 
 class TestTermination(unittest.TestCase):
 	"""
@@ -1010,6 +1292,56 @@ class TestTermination(unittest.TestCase):
 			self.assertEqual(resp.json()['state'], 'cancelled')
 			self.assertEqual(resp.json()['pending_dependency_count'], 1)
 
+	def test_release_through_groups(self):
+		"""
+		Verifies that when a task terminates, continuations further down the graph are
+		released through intermediate tasks that have no command.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [
+			{'name': 'parent', 'command': 'ls', 'requested_resources': {}},
+			{'name': 'group 1'},
+			{'name': 'group 2'},
+			{'name': 'child', 'command': 'ls', 'requested_resources': {}}
+		]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		add_continuations(self, task_ids[1:3], task_ids[0])
+		add_continuations(self, [task_ids[3]], task_ids[1])
+		add_continuations(self, [task_ids[3]], task_ids[2])
+
+		resp = patch({'state': 'available'}, self.entry, self.cred.provider_key, 'tasks',
+			task_ids[0])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		resp = patch({
+			'state': 'running',
+			'update_execution_data': {'worker_id': self.cred.worker_id}
+		}, self.entry, self.cred.worker_key, 'tasks', task_ids[0])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		resp = patch({
+			'state': 'terminated',
+			'update_execution_data': {
+				'exit_status': 'success',
+				'time_terminated': 'Tue, 02 Apr 2013 10:29:13 GMT',
+				'token': resp.json()['token']
+			}
+		}, self.entry, self.cred.worker_key, 'tasks', task_ids[0])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		for task_id in task_ids[1:3]:
+			resp = get(self.entry, self.cred.provider_key, 'tasks', task_id)
+			self.assertEqual(resp.json()['state'], 'terminated')
+
+		resp = get(self.entry, self.cred.provider_key, 'tasks', task_ids[3])
+		self.assertEqual(resp.json()['state'], 'available')
+		self.assertEqual(resp.json()['pending_dependency_count'], 0)
+
 	def test_dependency_count(self):
 		drop_tasks(self.db)
 
@@ -1039,6 +1371,407 @@ class TestTermination(unittest.TestCase):
 		resp = get(self.entry, self.cred.provider_key, 'tasks', child_ids[0])
 		self.assertEqual(resp.json()['state'], 'terminated')
 
+class TestClaim(unittest.TestCase):
+	"""
+	Verifies the behavior of the ``claim`` virtual resource.
+	"""
+
+	def __init__(self, entry, db, cred, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.entry = entry
+		self.db = db
+		self.cred = cred
+
+	def _claim(self, task_ids, key=None, worker_id=None):
+		update = [{
+			'targets': task_ids,
+			'values': {'worker_id': worker_id or self.cred.worker_id}
+		}]
+		return post(update, self.entry, key or self.cred.worker_key, 'tasks', 'claim')
+
+	def test_claim(self):
+		drop_tasks(self.db)
+
+		tasks = [
+			{'name': 'task 1', 'command': 'ls', 'requested_resources': {}},
+			{'name': 'task 2', 'command': 'ls', 'state': 'available',
+				'requested_resources': {}},
+			{'name': 'task 3', 'command': 'ls', 'state': 'available',
+				'requested_resources': {}}
+		]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		# Only workers can claim tasks, and only on their own behalf.
+		resp = self._claim(task_ids[1:], key=self.cred.provider_key)
+		self.assertEqual(resp.status_code, requests.codes.forbidden)
+		resp = self._claim(task_ids[1:], worker_id=self.cred.provider_id)
+		self.assertEqual(resp.status_code, requests.codes.unprocessable_entity)
+
+		resp = self._claim(task_ids)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(resp.json()['unclaimed'], task_ids[:1])
+
+		claimed = resp.json()['claimed']
+		self.assertEqual([c['_id'] for c in claimed], task_ids[1:])
+		for c in claimed:
+			self.assertEqual(c['command'], 'ls')
+			self.assertEqual(len(c['token']), 16)
+
+		# Claiming tasks that are already running should fail.
+		resp = self._claim(task_ids[1:])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(resp.json()['claimed'], [])
+
+		for task_id in task_ids[1:]:
+			resp = get(self.entry, self.cred.provider_key, 'tasks', task_id)
+			self.assertEqual(resp.json()['state'], 'running')
+			self.assertEqual(resp.json()['attempt_count'], 1)
+
+		# The token returned by the claim should allow the worker to report termination.
+		term_update = {
+			'state': 'terminated',
+			'update_execution_data': {
+				'exit_status': 'success',
+				'time_terminated': 'Tue, 02 Apr 2013 10:29:13 GMT',
+				'token': claimed[0]['token']
+			}
+		}
+
+		resp = patch(term_update, self.entry, self.cred.worker_key, 'tasks', task_ids[1])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+	def test_fair_share_usage(self):
+		"""
+		Checks that the server records the start time of an attempt when the worker does not
+		provide it, so that the attempt counts towards the fair-share usage of the owner.
+		"""
+
+		drop_tasks(self.db)
+		self.db.drop_collection('execution_info')
+
+		tasks = [{'name': 'task 1', 'command': 'ls', 'state': 'available',
+			'requested_resources': {}}]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		resp = self._claim(task_ids)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(len(resp.json()['claimed']), 1)
+
+		time.sleep(0.1)
+		now   = datetime.utcnow()
+		usage = usage_by_owner(self.db, now - timedelta(hours=1), now)
+		self.assertGreater(usage.get(ObjectId(self.cred.provider_id), 0), 0)
+
+	def test_leases(self):
+		"""
+		Checks that claimed tasks are leased to the worker, that the worker can renew its
+		leases using one request, and that the lease is released when the task terminates.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [
+			{'name': 'task 1', 'command': 'ls', 'state': 'available',
+				'requested_resources': {}},
+			{'name': 'task 2', 'command': 'ls', 'state': 'available',
+				'requested_resources': {}}
+		]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		resp = self._claim(task_ids[:1])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		token = resp.json()['claimed'][0]['token']
+
+		def find_lease(task_id):
+			return self.db.tasks.find_one({'_id': ObjectId(task_id)}).get('lease')
+
+		lease = find_lease(task_ids[0])
+		self.assertEqual(str(lease['worker_id']), self.cred.worker_id)
+		self.assertIsNone(find_lease(task_ids[1]))
+
+		resp = post({'tasks': task_ids}, self.entry, self.cred.provider_key, 'tasks',
+			'renew_leases')
+		self.assertEqual(resp.status_code, requests.codes.forbidden)
+
+		resp = post({'tasks': task_ids}, self.entry, self.cred.worker_key, 'tasks',
+			'renew_leases')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(resp.json()['renewed'], task_ids[:1])
+		self.assertEqual(resp.json()['lost'], task_ids[1:])
+		self.assertGreaterEqual(find_lease(task_ids[0])['expires_at'], lease['expires_at'])
+
+		term_update = {
+			'state': 'terminated',
+			'update_execution_data': {
+				'exit_status': 'success',
+				'time_terminated': 'Tue, 02 Apr 2013 10:29:13 GMT',
+				'token': token
+			}
+		}
+
+		resp = patch(term_update, self.entry, self.cred.worker_key, 'tasks', task_ids[0])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertIsNone(find_lease(task_ids[0]))
+
+	def test_claim_by_resources(self):
+		drop_tasks(self.db)
+
+		def make_task(name, cores, gpus=0):
+			return {
+				'name': name,
+				'command': 'ls',
+				'state': 'available',
+				'requested_resources': {
+					'cpu_memory_bytes': 2 ** 30,
+					'cpu_cores': {'count': cores},
+					'gpu_count': gpus
+				}
+			}
+
+		tasks = [
+			make_task('small 1', 2),
+			make_task('small 2', 2),
+			make_task('small 3', 2),
+			make_task('large', 4),
+			make_task('gpu', 1, gpus=1)
+		]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		request = {
+			'resources': {'memory_bytes': 4 * 2 ** 30, 'cpu_cores': 4, 'gpus': 0},
+			'max_count': 8
+		}
+
+		def claim_by_resources():
+			resp = post(request, self.entry, self.cred.worker_key, 'tasks',
+				'claim_by_resources')
+			self.assertEqual(resp.status_code, requests.codes.ok)
+			return [c['_id'] for c in resp.json()['claimed']]
+
+		# The task with the largest requirements should be claimed first.
+		self.assertEqual(claim_by_resources(), [task_ids[3]])
+		self.assertEqual(len(claim_by_resources()), 2)
+		self.assertEqual(len(claim_by_resources()), 1)
+
+		# The task that requires a GPU should never be claimed.
+		self.assertEqual(claim_by_resources(), [])
+
+		resp = post(request, self.entry, self.cred.provider_key, 'tasks',
+			'claim_by_resources')
+		self.assertEqual(resp.status_code, requests.codes.forbidden)
+
+	def test_available_for(self):
+		drop_tasks(self.db)
+
+		def make_task(name, memory, cores, gpus=0):
+			return {
+				'name': name,
+				'command': 'ls',
+				'state': 'available',
+				'requested_resources': {
+					'cpu_memory_bytes': memory,
+					'cpu_cores': cores,
+					'gpu_count': gpus
+				}
+			}
+
+		tasks = [
+			make_task('fits', 2 ** 30, {'count': 2}),
+			make_task('too much memory', 8 * 2 ** 30, {'count': 1}),
+			make_task('too many cores', 2 ** 30, {'count': 8}),
+			make_task('too many cores by percent', 2 ** 30, {'percent': 100}),
+			make_task('gpu', 2 ** 30, {'count': 1}, gpus=1)
+		]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		request = {
+			'resources': {
+				'memory_bytes': 4 * 2 ** 30,
+				'cpu_cores': 4,
+				'total_cpu_cores': 8,
+				'gpus': 0
+			}
+		}
+
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		available = resp.json()['tasks']
+		self.assertEqual([t['_id'] for t in available], [task_ids[0]])
+
+		# Only the projected fields should be returned.
+		self.assertEqual(set(available[0].keys()), {'_id', 'effective_priority',
+			'requested_resources', 'max_shutdown_time_milliseconds'})
+
+	def test_incremental_refresh(self):
+		"""
+		Checks that a worker refreshing its task cache with ``updated_since`` only receives
+		the tasks that have changed, and learns which of its cached tasks were claimed.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [{
+			'name': name,
+			'command': 'ls',
+			'state': 'available',
+			'requested_resources': {'cpu_cores': {'count': 1}}
+		} for name in ['unchanged', 'claimed']]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		# Tasks updated within ``updated_since_margin`` of a request are returned again by the
+		# next one, so we wait for the margin to pass.
+		time.sleep(3)
+
+		request = {
+			'resources': {'memory_bytes': 4 * 2 ** 30, 'cpu_cores': 4, 'gpus': 0}
+		}
+
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(set(t['_id'] for t in resp.json()['tasks']), set(task_ids))
+		as_of = resp.json()['as_of']
+
+		resp = self._claim([task_ids[1]])
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		new_ids = []
+		insert_tasks(self, [dict(tasks[0], name='new')], id_list=new_ids)
+
+		request.update({'updated_since': as_of, 'cached': task_ids})
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual([t['_id'] for t in resp.json()['tasks']], new_ids)
+		self.assertEqual(resp.json()['withdrawn'], [task_ids[1]])
+
+	def test_priority(self):
+		"""
+		Checks that tasks with higher priorities are offered and claimed first, regardless of
+		the order in which they were created.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [{
+			'name': 'priority {}'.format(p),
+			'command': 'ls',
+			'state': 'available',
+			'priority': p,
+			'requested_resources': {'cpu_cores': {'count': 1}}
+		} for p in [0, 2, 1]]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		request = {
+			'resources': {'memory_bytes': 4 * 2 ** 30, 'cpu_cores': 4, 'gpus': 0}
+		}
+
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual([t['_id'] for t in resp.json()['tasks']],
+			[task_ids[1], task_ids[2], task_ids[0]])
+
+		request['max_count'] = 1
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'claim_by_resources')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual([c['_id'] for c in resp.json()['claimed']], [task_ids[1]])
+
+		resp = get(self.entry, self.cred.provider_key, 'tasks', task_ids[1])
+		self.assertEqual(resp.json()['owner'], self.cred.provider_id)
+
+	def test_offer_group_limit(self):
+		"""
+		Checks that the tasks are offered from at most ``max_offer_groups`` (see ``claims.py``)
+		distinct priorities per request, starting with the highest.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [{
+			'name': 'priority {}'.format(p),
+			'command': 'ls',
+			'state': 'available',
+			'priority': p,
+			'requested_resources': {'cpu_cores': {'count': 1}}
+		} for p in range(10)]
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+
+		request = {
+			'resources': {'memory_bytes': 4 * 2 ** 30, 'cpu_cores': 4, 'gpus': 0}
+		}
+
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual([t['_id'] for t in resp.json()['tasks']], task_ids[:1:-1])
+
+	def test_critical_path(self):
+		"""
+		Checks that critical path lengths are maintained as continuations are added and
+		removed, and that the tasks on the longest remaining path are offered first.
+		"""
+
+		drop_tasks(self.db)
+
+		tasks = [{
+			'name': name,
+			'command': 'ls',
+			'estimated_runtime_milliseconds': runtime,
+			'requested_resources': {'cpu_cores': {'count': 1}}
+		} for name, runtime in [('short', 5000), ('head', 1000), ('tail', 100000)]]
+		tasks[0]['state'] = 'available'
+
+		task_ids = []
+		insert_tasks(self, tasks, id_list=task_ids)
+		short_id, head_id, tail_id = task_ids
+
+		def length(task_id):
+			resp = get(self.entry, self.cred.provider_key, 'tasks', task_id)
+			return resp.json()['critical_path_milliseconds']
+
+		resp = add_continuations(self, [tail_id], head_id)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(length(head_id), 101000)
+
+		resp = post([tail_id], self.entry, self.cred.provider_key, 'tasks', head_id,
+			'remove_continuations')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(length(head_id), 1000)
+
+		resp = add_continuations(self, [tail_id], head_id)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		resp = patch({'estimated_runtime_milliseconds': 200000}, self.entry,
+			self.cred.provider_key, 'tasks', tail_id)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual(length(head_id), 201000)
+
+		resp = patch({'state': 'available'}, self.entry, self.cred.provider_key, 'tasks',
+			head_id)
+		self.assertEqual(resp.status_code, requests.codes.ok)
+
+		request = {
+			'resources': {'memory_bytes': 4 * 2 ** 30, 'cpu_cores': 4, 'gpus': 0}
+		}
+
+		resp = post(request, self.entry, self.cred.worker_key, 'tasks', 'available_for')
+		self.assertEqual(resp.status_code, requests.codes.ok)
+		self.assertEqual([t['_id'] for t in resp.json()['tasks']], [head_id, short_id])
+
 class TestFilterQuery(unittest.TestCase):
 	"""
 	Tests that queries used to select tasks satisfying certain resource requirements work as
@@ -1188,6 +1921,7 @@ if __name__ == '__main__':
 		suite.addTest(make_suite(TestExecutionInfo, entry=entry, cred=cred, db=db))
 		suite.addTest(make_suite(TestCancellation, entry=entry, cred=cred, db=db))
 		suite.addTest(make_suite(TestTermination, entry=entry, cred=cred, db=db))
+		suite.addTest(make_suite(TestClaim, entry=entry, cred=cred, db=db))
 		suite.addTest(make_suite(TestFilterQuery, entry=entry, cred=cred, db=db))
 		unittest.TextTestRunner().run(suite)
 
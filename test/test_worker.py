@@ -7,6 +7,10 @@ test.test_worker
 Tests functionality that is implemented completely on the worker-side.
 """
 
+import select
+import signal
+import socket
+import time
 import unittest
 
 # Allows us to import the 'banyan' module.
@@ -16,7 +20,12 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
 from banyan.worker.task import Task
 from banyan.worker.executor import Executor
+from banyan.worker.claim_planner import Demand, FreeResources, plan, strategies
+from banyan.worker.notices import NoticeListener
+from banyan.worker.task_cache import TaskCache
 from banyan.worker.resource_info import ResourceSummary
+from banyan.notification_protocol import format_message, cancellation_notice, \
+	resource_usage_request
 
 import banyan.worker.resource_info as resource_info
 
@@ -56,5 +65,147 @@ class TestExecutor(unittest.TestCase):
 		for t in e.terminated:
 			self.assertEqual(t.status(), 0)
 
+	def test_exit_notification(self):
+		e = Executor(self.total_res)
+		if e.fileno() is None:
+			self.skipTest("pidfds are not supported.")
+
+		tasks = [Task('sleep {}'.format(0.1 * i), requested_resources=self.req_res,
+			estimated_runtime=1000., max_shutdown_time=10.) for i in range(5)]
+		for t in tasks:
+			e.submit(t)
+
+		while len(e.running) != 0:
+			select.select([e], [], [], 5)
+			e.poll()
+
+		self.assertEqual(set(e.terminated), set(tasks))
+		self.assertEqual(len(e.exits.pidfds), 0)
+
+	def test_cancel(self):
+		e = Executor(self.total_res)
+
+		t = Task('trap "" TERM; sleep 30', requested_resources=self.req_res,
+			estimated_runtime=1000., max_shutdown_time=0.2)
+		e.submit(t)
+
+		# Gives the shell time to install the trap.
+		time.sleep(0.2)
+		t.cancel()
+
+		while len(e.running) != 0:
+			e.poll()
+
+		self.assertEqual(e.terminated, [t])
+		self.assertEqual(t.status(), -signal.SIGKILL)
+
+	def test_process_tree_usage(self):
+		"""
+		Checks that the memory used by all of the processes started by a task is counted.
+		"""
+
+		e = Executor(self.total_res)
+
+		child = '{} -c "import time; x = bytearray(64 * 2 ** 20); time.sleep(2)"'.format(
+			sys.executable)
+		t = Task('{} & {} & wait'.format(child, child), requested_resources=self.req_res,
+			estimated_runtime=1000., max_shutdown_time=10.)
+		e.submit(t)
+
+		time.sleep(1)
+		e.sampler.sample()
+		self.assertGreaterEqual(e.task_usage(t).resident_memory_bytes, 128 * 2 ** 20)
+		self.assertEqual(e.usage(), e.task_usage(t))
+
+		while len(e.running) != 0:
+			e.poll()
+
+		self.assertEqual(len(e.sampler.table.rows), 0)
+
+class TestTaskCache(unittest.TestCase):
+	def make_task(self, _id, memory, cores, gpus=0):
+		return {'_id': _id, 'requested_resources': {
+			'cpu_memory_bytes': memory,
+			'cpu_cores': {'count': cores},
+			'gpu_count': gpus
+		}}
+
+	def test_largest_fitting(self):
+		total = ResourceSummary(memory_bytes=16 * 2 ** 30, cpu_cores=8, gpus=2)
+		cache = TaskCache(total, capacity=4)
+
+		for task in [self.make_task('small', 2 ** 30, 1),
+			self.make_task('large', 8 * 2 ** 30, 4),
+			self.make_task('gpu', 2 ** 30, 1, gpus=1),
+			self.make_task('cores', 2 ** 30, 6)]:
+			self.assertTrue(cache.add(task))
+
+		self.assertFalse(cache.add(self.make_task('full', 2 ** 30, 1)))
+
+		free = ResourceSummary(memory_bytes=4 * 2 ** 30, cpu_cores=8, gpus=1)
+		self.assertEqual(cache.largest_fitting(free), 'gpu')
+
+		cache.remove('gpu')
+		self.assertEqual(cache.largest_fitting(free), 'cores')
+
+		free = ResourceSummary(memory_bytes=4 * 2 ** 30, cpu_cores=4, gpus=0)
+		self.assertEqual(cache.largest_fitting(free), 'small')
+
+		# Replacing a task moves it to the bucket for its new shape.
+		cache.add(self.make_task('small', 2 ** 30, 2))
+		self.assertEqual(cache.demand_of('small').cpu_cores, 2)
+
+		free = ResourceSummary(memory_bytes=4 * 2 ** 30, cpu_cores=1, gpus=0)
+		self.assertIsNone(cache.largest_fitting(free))
+
+		for task_id in cache.ids():
+			cache.remove(task_id)
+
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.gpu_levels, [])
+
+class TestClaimPlanner(unittest.TestCase):
+	def test_strategies(self):
+		free = FreeResources(memory_bytes=8, cpu_cores=4, gpus=1, gpu_memory_bytes=4,
+			gpu_compute_capability=(6, 0))
+
+		demands = [
+			Demand('memory', 6, 1, 0, 0, None),
+			Demand('cores', 1, 3, 0, 0, None),
+			Demand('gpu', 1, 1, 1, 2, (5, 2)),
+			Demand('old gpu', 1, 1, 1, 8, None),
+			Demand('new gpu', 1, 1, 1, 0, (7, 0))
+		]
+
+		self.assertEqual(plan(demands, free), ['gpu', 'cores'])
+		self.assertEqual(plan(demands, free, 'dominant_resource'), ['gpu', 'memory'])
+
+		# Once the GPU task is selected, the memory task fills more of the remaining
+		# resources than the cores task does.
+		self.assertEqual(plan(demands, free, 'best_fit'), ['gpu', 'memory'])
+
+		for strategy in strategies:
+			selected = plan(demands, free._replace(cpu_cores=0), strategy)
+			self.assertEqual(selected, [])
+
+class TestNoticeListener(unittest.TestCase):
+	def test_token(self):
+		n = NoticeListener(0, 'a' * 16)
+
+		with socket.create_connection(('localhost', n.listener.getsockname()[1])) as conn:
+			# The second message is split across two writes.
+			msgs = format_message(cancellation_notice, 'a' * 16, 'b' * 16) + \
+				format_message(resource_usage_request, 'c' * 16) + \
+				format_message(resource_usage_request, 'a' * 16)
+			conn.sendall(msgs[:50])
+			conn.sendall(msgs[50:])
+
+			received = []
+			while len(received) < 2:
+				received.extend(n.wait(5))
+
+		self.assertEqual(received, [(cancellation_notice, 'b' * 16),
+			(resource_usage_request, None)])
+
 if __name__ == '__main__':
 	unittest.main()